@@ -21,7 +21,10 @@ cachedir = string(default='/var/lib/jens/cache')
 hashprefix = string(default='commit/')
 directory_environments = boolean(default=False)
 common_hieradata_items = list(default=list())
+environments_workers = integer(min=1, default=4)
+atomic_environments = boolean(default=False)
 mode = option('POLL', 'ONDEMAND', default='POLL')
+clonemode = option('CLONE', 'WORKTREE', 'STORE', default='CLONE')
 [lock]
 type = option('DISABLED', 'FILE', default='FILE')
 name = string(default='jens')
@@ -29,8 +32,13 @@ name = string(default='jens')
 lockdir = string(default='/run/lock/jens')
 [messaging]
 queuedir = string(default='/var/spool/jens-update')
+pendingdir = string(default='/var/spool/jens-update-pending')
+accept_pickled_hints = boolean(default=True)
 [git]
 ssh_cmd_path = string(default=None)
+pool_size = integer(min=0, default=16)
+remote_fingerprints = boolean(default=True)
+max_concurrent_clones = integer(min=1, default=4)
 [gitlabproducer]
 secret_token = string(default=None)
 """
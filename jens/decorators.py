@@ -15,6 +15,7 @@ import git.exc
 
 from jens.errors import JensGitError
 from jens.settings import Settings
+from jens.git_pool import get_repository, release_repository
 
 def timed(func):
     @wraps(func)
@@ -38,20 +39,37 @@ def git_exec(func):
         args = w_kwargs["args"]
         kwargs = w_kwargs["kwargs"]
         name = w_kwargs["name"]
+        # If a repository path is given the function gets a (pooled)
+        # git.Repo object as first positional argument
+        repository_path = w_kwargs.get("repository_path", None)
 
         logging.debug("Executing git %s %s %s", name, args, kwargs)
 
         try:
-            res = func(*args, **kwargs)
+            if repository_path is not None:
+                repo = get_repository(repository_path)
+                res = func(repo, *args, **kwargs)
+            else:
+                res = func(*args, **kwargs)
         except (git.exc.GitCommandError, git.exc.GitCommandNotFound) as error:
+            _release(repository_path)
             raise JensGitError("Couldn't execute %s (%s)" %
                                (error.command, error.stderr))
         except git.exc.NoSuchPathError as error:
+            _release(repository_path)
             raise JensGitError("No such path %s" % error)
         except git.exc.InvalidGitRepositoryError as error:
+            _release(repository_path)
             raise JensGitError("Not a git repository: %s" % error)
         except AssertionError as error:
+            _release(repository_path)
             raise JensGitError("Git operation failed: %s" % error)
         return res
 
     return wrapper
+
+# Whatever failed might have left the persistent processes of
+# the repository in a bad state, so it's better to start afresh.
+def _release(repository_path):
+    if repository_path is not None:
+        release_repository(repository_path)
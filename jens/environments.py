@@ -11,83 +11,219 @@ import logging
 import yaml
 import shutil
 import re
+import base64
+import uuid
+import pickle
+from multiprocessing import Pool
 
 from configobj import ConfigObj
 
-from jens.git_wrapper import hash_object
+from jens.git_wrapper import hash_blob, hash_object
+from jens.git_wrapper import get_head, ls_tree, has_local_changes
 from jens.decorators import timed
-from jens.errors import JensEnvironmentsError
+from jens.errors import JensEnvironmentsError, JensGitError
 from jens.tools import refname_to_dirname
 from jens.settings import Settings
 
 DIRECTORY_ENVIRONMENTS_CONF_FILENAME = "environment.conf"
 DIRECTORY_ENVIRONMENTS_CONF_PARSER_VALUES = ('current', 'future')
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Environment definitions are read several times per run (look-ahead of
+# the repositories, delta, creation and refresh of the environments), so
+# they're parsed only once per content. Entries are indexed by path and
+# carry the blob hash of the file they were parsed from.
+_definitions = {}
+
+_shared_arguments = {}
+
+# Environments being built aside (atomic mode), by name
+_staging_paths = {}
+
+# Relative paths to CLONEDIR, by depth (see _get_clonedir_prefix)
+_clonedir_prefixes = {}
+
 @timed
 def refresh_environments(repositories_deltas, inventory):
+    settings = Settings()
+    metadata_head = _get_metadata_head()
+    # Runs triggered by hints only have to get new commits into the
+    # clones, which the environments are linked to already. The
+    # environments are left alone unless their definitions changed or
+    # repositories were added or removed. Polling runs always go
+    # through all of them.
+    if settings.MODE == 'ONDEMAND' and \
+            _environments_up_to_date(metadata_head, repositories_deltas):
+        logging.info("Environments metadata still at %s and no repositories "
+                     "added or removed, nothing to refresh", metadata_head)
+        return
+    _collect_staging_garbage()
     logging.debug("Calculating delta...")
-    delta = _calculate_delta()
+    delta = _calculate_delta(metadata_head)
     logging.info("New environments: %s", delta['new'])
     logging.info("Existing and changed environments: %s", delta['changed'])
     logging.debug("Existing but not changed environments: %s", delta['notchanged'])
     logging.info("Deleted environments: %s", delta['deleted'])
 
+    index = _read_environments_index()
+
     logging.info("Creating new environments...")
-    _create_new_environments(delta['new'], inventory)
+    _process_environments(_create_new_environment, delta['new'],
+                          inventory=inventory)
     logging.info("Purging deleted environments...")
     _purge_deleted_environments(delta['deleted'])
     logging.info("Recreating changed environments...")
-    _recreate_changed_environments(delta['changed'], inventory)
+    _process_environments(_recreate_changed_environment, delta['changed'],
+                          inventory=inventory,
+                          repositories_deltas=repositories_deltas)
     logging.info("Refreshing not changed environments...")
-    _refresh_notchanged_environments(delta['notchanged'], repositories_deltas)
+    affected = _get_affected_environments(index, repositories_deltas)
+    notchanged = affected.intersection(delta['notchanged'])
+    logging.debug("Not changed environments affected by the repositories "
+                  "delta: %s", notchanged)
+    _process_environments(_refresh_notchanged_environment, notchanged,
+                          repositories_deltas=repositories_deltas)
+
+    _update_environments_index(index, set(delta['new']).union(
+        delta['changed'], delta['deleted']))
+    _write_environments_index(index)
+    _write_processed_metadata_head(metadata_head)
+
+# Environments are independent from each other so they're processed
+# by a pool of workers. The arguments are shared via a global set
+# before forking, so they're inherited by the workers instead of
+# being pickled for every environment.
+def _process_environments(function, environments, **kwargs):
+    settings = Settings()
+    environments = sorted(environments)
+    workers = min(settings.ENVIRONMENTS_WORKERS, len(environments))
+    if workers <= 1:
+        for environment in environments:
+            function(environment, **kwargs)
+        return
+    _shared_arguments.update(kwargs, function=function)
+    pool = Pool(processes=workers)
+    try:
+        pool.map(_process_environment, environments, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _shared_arguments.clear()
+
+def _process_environment(environment):
+    kwargs = dict(_shared_arguments)
+    function = kwargs.pop('function')
+    function(environment, **kwargs)
+
+def _refresh_notchanged_environment(environment, repositories_deltas):
+    logging.debug("Refreshing environment '%s'...", environment)
+    try:
+        definition = read_environment_definition(environment)
+    except JensEnvironmentsError as error:
+        logging.error("Unable to read and parse '%s' definition (%s). Skipping",
+                      environment, error)
+        return
 
-def _refresh_notchanged_environments(environments, repositories_deltas):
-    for environment in environments:
-        logging.debug("Refreshing environment '%s'...", environment)
+    if definition.get('default', None) is None:
+        logging.debug("Environment '%s' won't get new modules (no default)",
+                      environment)
+    else:
+        for module in repositories_deltas['modules']['new']:
+            try:
+                _link_module(module, environment, definition)
+            except JensEnvironmentsError as error:
+                logging.error("Failed to link module '%s' in enviroment '%s' (%s)",
+                              module, environment, error)
+
+    for module in repositories_deltas['modules']['deleted']:
+        logging.debug("Deleting module '%s' from environment '%s'",
+                      module, environment)
+        _unlink_module(module, environment)
+
+    if definition.get('default', None) is None:
+        logging.debug("Environment '%s' won't get new hostgroups (no default)",
+                      environment)
+    else:
+        for hostgroup in repositories_deltas['hostgroups']['new']:
+            try:
+                _link_hostgroup(hostgroup, environment, definition)
+            except JensEnvironmentsError as error:
+                logging.error("Failed to link hostgroup '%s' in enviroment '%s' (%s)",
+                              hostgroup, environment, error)
+
+    for hostgroup in repositories_deltas['hostgroups']['deleted']:
+        logging.debug("Deleting hostgroup '%s' from environment '%s'",
+                      hostgroup, environment)
+        _unlink_hostgroup(hostgroup, environment)
+
+def _recreate_changed_environment(environment, inventory, repositories_deltas):
+    settings = Settings()
+    _, previous = _read_environment_annotation(environment)
+    try:
+        definition = read_environment_definition(environment)
+    except JensEnvironmentsError:
+        # Recreating it will report the problem and get rid of it
+        definition = None
+    if settings.ATOMIC_ENVIRONMENTS and definition is not None:
+        logging.info("Rebuilding environment '%s'", environment)
+        _create_new_environment(environment, inventory)
+        return
+    if previous is not None and definition is not None:
+        logging.info("Updating environment '%s'", environment)
         try:
-            definition = read_environment_definition(environment)
-        except JensEnvironmentsError as error:
-            logging.error("Unable to read and parse '%s' definition (%s). Skipping",
-                          environment, error)
+            _update_environment(environment, previous, definition,
+                                inventory, repositories_deltas)
+            _annotate_environment(environment, definition)
             return
-
-        if definition.get('default', None) is None:
-            logging.debug("Environment '%s' won't get new modules (no default)",
-                          environment)
-        else:
-            for module in repositories_deltas['modules']['new']:
-                try:
-                    _link_module(module, environment, definition)
-                except JensEnvironmentsError as error:
-                    logging.error("Failed to link module '%s' in enviroment '%s' (%s)",
-                                  module, environment, error)
-
-        for module in repositories_deltas['modules']['deleted']:
-            logging.debug("Deleting module '%s' from environment '%s'",
-                          module, environment)
-            _unlink_module(module, environment)
-
-        if definition.get('default', None) is None:
-            logging.debug("Environment '%s' won't get new hostgroups (no default)",
-                          environment)
-        else:
-            for hostgroup in repositories_deltas['hostgroups']['new']:
-                try:
-                    _link_hostgroup(hostgroup, environment, definition)
-                except JensEnvironmentsError as error:
-                    logging.error("Failed to link hostgroup '%s' in enviroment '%s' (%s)",
-                                  hostgroup, environment, error)
-
-        for hostgroup in repositories_deltas['hostgroups']['deleted']:
-            logging.debug("Deleting hostgroup '%s' from environment '%s'",
-                          hostgroup, environment)
-            _unlink_hostgroup(hostgroup, environment)
-
-def _recreate_changed_environments(environments, inventory):
-    for environment in environments:
-        logging.info("Recreating environment '%s'", environment)
-        _purge_deleted_environment(environment)
-        _create_new_environment(environment, inventory)
+        except (JensEnvironmentsError, OSError) as error:
+            logging.warning("Unable to update environment '%s' (%s)",
+                            environment, error)
+    logging.info("Recreating environment '%s'", environment)
+    _purge_deleted_environment(environment)
+    _create_new_environment(environment, inventory)
+
+# Only the links of the elements whose branch changed between the
+# definition the environment was built from and the new one are
+# touched. Unchanged links are left alone and the rest are replaced
+# atomically.
+def _update_environment(environment, previous, definition,
+                        inventory, repositories_deltas):
+    settings = Settings()
+    for partition, link, unlink in (
+            ('modules', _link_module, _unlink_module),
+            ('hostgroups', _link_hostgroup, _unlink_hostgroup)):
+        new_elements = set(repositories_deltas[partition]['new'])
+        for element in inventory[partition]:
+            was_linked = element not in new_elements and \
+                _is_element_wanted(partition, element, previous)
+            if _is_element_wanted(partition, element, definition):
+                if not was_linked or \
+                        _get_treeish(partition, element, previous) != \
+                        _get_treeish(partition, element, definition):
+                    link(element, environment, definition, replace=True)
+            elif was_linked:
+                logging.debug("Deleting %s '%s' from environment '%s'",
+                              partition, element, environment)
+                unlink(element, environment)
+        for element in repositories_deltas[partition]['deleted']:
+            unlink(element, environment)
+
+    if _get_treeish('common', 'site', previous) != \
+            _get_treeish('common', 'site', definition):
+        _link_site(environment, definition, replace=True)
+    if _get_treeish('common', 'hieradata', previous) != \
+            _get_treeish('common', 'hieradata', definition):
+        _link_common_hieradata(environment, definition, replace=True)
+    # The setting or the definition might have changed since the
+    # environment was built, so the file is always generated again
+    if settings.DIRECTORY_ENVIRONMENTS:
+        _add_configuration_file(environment, definition)
+    else:
+        _remove_configuration_file(environment)
 
 def _purge_deleted_environments(environments):
     settings = Settings()
@@ -101,14 +237,14 @@ def _purge_deleted_environment(environment):
     settings = Settings()
     logging.info("Deleting environment '%s'", environment)
     env_basepath = "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
-    shutil.rmtree(env_basepath)
+    # The build it points to is removed in the next run
+    if os.path.islink(env_basepath):
+        os.unlink(env_basepath)
+    else:
+        shutil.rmtree(env_basepath)
     logging.info("Deleted '%s'", env_basepath)
     _remove_environment_annotation(environment)
 
-def _create_new_environments(environments, inventory):
-    for environment in environments:
-        _create_new_environment(environment, inventory)
-
 #pylint: disable=too-many-branches, too-many-statements
 def _create_new_environment(environment, inventory):
     settings = Settings()
@@ -129,8 +265,23 @@ def _create_new_environment(environment, inventory):
         logging.error("Environment '%s' is empty", environment)
         return
 
+    if settings.ATOMIC_ENVIRONMENTS:
+        # Built aside and then published in one go
+        _staging_paths[environment] = _compose_staging_path(environment)
+        try:
+            _build_environment(environment, definition, inventory)
+        finally:
+            staging_path = _staging_paths.pop(environment)
+        _publish_environment(environment, staging_path)
+    else:
+        _build_environment(environment, definition, inventory)
+
+    _annotate_environment(environment, definition)
+
+def _build_environment(environment, definition, inventory):
+    settings = Settings()
     logging.debug("Creating directory structure...")
-    env_basepath = "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
+    env_basepath = _compose_environment_path(environment)
     os.mkdir(env_basepath)
     for directory in ("modules", "hostgroups", "hieradata"):
         os.mkdir("%s/%s" % (env_basepath, directory))
@@ -139,6 +290,9 @@ def _create_new_environment(environment, inventory):
     for directory in hieradata_directories:
         os.mkdir("%s/hieradata/%s" % (env_basepath, directory))
 
+    # All the links of the environment are planned first and then
+    # created in one go
+    links = []
     logging.info("Processing modules...")
     modules = list(inventory['modules'].keys())
     if 'default' not in definition:
@@ -148,11 +302,8 @@ def _create_new_environment(environment, inventory):
             necessary_modules = set()
         modules = set(modules).intersection(necessary_modules)
     for module in modules:
-        try:
-            _link_module(module, environment, definition)
-        except JensEnvironmentsError as error:
-            logging.error("Failed to link module '%s' in enviroment '%s' (%s)",
-                          module, environment, error)
+        links.append(("module '%s'" % module,
+                      _plan_module_links(module, environment, definition)))
 
     logging.info("Processing hostgroups...")
     hostgroups = list(inventory['hostgroups'].keys())
@@ -163,25 +314,23 @@ def _create_new_environment(environment, inventory):
             necessary_hostgroups = set()
         hostgroups = set(hostgroups).intersection(necessary_hostgroups)
     for hostgroup in hostgroups:
-        try:
-            _link_hostgroup(hostgroup, environment, definition)
-        except JensEnvironmentsError as error:
-            logging.error("Failed to link hostgroup '%s' in enviroment '%s' (%s)",
-                          hostgroup, environment, error)
+        links.append(("hostgroup '%s'" % hostgroup,
+                      _plan_hostgroup_links(hostgroup, environment, definition)))
 
     logging.info("Processing site...")
-    try:
-        _link_site(environment, definition)
-    except JensEnvironmentsError as error:
-        logging.error("Failed to link site in enviroment '%s' (%s)",
-                      environment, error)
+    links.append(("site", _plan_site_links(environment, definition)))
 
     logging.info("Processing common Hiera data...")
-    try:
-        _link_common_hieradata(environment, definition)
-    except JensEnvironmentsError as error:
-        logging.error("Failed to link common hieradata in enviroment '%s' (%s)",
-                      environment, error)
+    links.append(("common hieradata",
+                  _plan_common_hieradata_links(environment, definition)))
+
+    logging.info("Linking %d elements...", len(links))
+    for element, element_links in links:
+        try:
+            _apply_links(element_links)
+        except JensEnvironmentsError as error:
+            logging.error("Failed to link %s in enviroment '%s' (%s)",
+                          element, environment, error)
 
     if settings.DIRECTORY_ENVIRONMENTS:
         try:
@@ -190,8 +339,6 @@ def _create_new_environment(environment, inventory):
             logging.error("Failed to generate config file for environment '%s' (%s)",
                           environment, error)
 
-    _annotate_environment(environment)
-
 # This function guarantees that if keys are defined they contain things that
 # make sense. If there's overrides defined then the partitions are in the list
 # of known ones and they contain a dictionary.
@@ -200,8 +347,7 @@ def read_environment_definition(environment):
     try:
         path = settings.ENV_METADATADIR + "/%s.yaml" % environment
         logging.debug("Reading environment from %s", path)
-        with open(path, 'r') as environment_fd:
-            environment = yaml.safe_load(environment_fd)
+        environment = _load_environment_definition(path)
         for key in ('notifications',):
             if key not in environment:
                 raise JensEnvironmentsError("Missing '%s' in environment '%s'" %
@@ -249,88 +395,72 @@ def read_environment_definition(environment):
     except IOError:
         raise JensEnvironmentsError("Unable to open %s for reading" % path)
 
-def _link_module(module, environment, definition):
-    settings = Settings()
-    branch, _ = _resolve_branch('modules', module, definition)
-    logging.debug("Adding module '%s' (%s) to environment '%s'",
-                  module, branch, environment)
+def _load_environment_definition(path):
+    with open(path, 'rb') as environment_fd:
+        data = environment_fd.read()
+    blob_hash = hash_blob(data)
+    cached = _definitions.get(path)
+    if cached is not None and cached[0] == blob_hash:
+        return cached[1]
+    definition = _parse_environment_definition(data)
+    _definitions[path] = (blob_hash, definition)
+    return definition
 
-    # 1. Module's code directory
-    # LINK_NAME: $environment/modules/$module
-    # TARGET: $clonedir/modules/$module/$branch/code
-    target = "%s/modules/%s/%s/code" % \
-        (settings.CLONEDIR, module, branch)
-    link_name = _generate_module_env_code_path(module, environment)
-    target = os.path.relpath(target,
-                             os.path.abspath(os.path.join(link_name, os.pardir)))
-    logging.debug("Linking %s to %s", link_name, target)
-    try:
-        os.symlink(target, link_name)
-    except OSError as error:
-        raise JensEnvironmentsError(error)
+def _parse_environment_definition(data):
+    return yaml.load(data, Loader=SafeLoader)
 
-    # 2. Module's data directory
-    # LINK_NAME: $environment/hieradata/module_names/$module
-    # TARGET: $clonedir/modules/$module/$branch/data
-    target = "%s/modules/%s/%s/data" % \
-             (settings.CLONEDIR, module, branch)
-    link_name = _generate_module_env_hieradata_path(module, environment)
-    target = os.path.relpath(target,
-                             os.path.abspath(os.path.join(link_name, os.pardir)))
-    logging.debug("Linking %s to %s", link_name, target)
-    try:
-        os.symlink(target, link_name)
-    except OSError as error:
-        raise JensEnvironmentsError(error)
+def _link_module(module, environment, definition, replace=False):
+    _apply_links(_plan_module_links(module, environment, definition), replace)
 
-def _link_hostgroup(hostgroup, environment, definition):
-    settings = Settings()
+def _link_hostgroup(hostgroup, environment, definition, replace=False):
+    _apply_links(_plan_hostgroup_links(hostgroup, environment, definition),
+                 replace)
+
+def _plan_module_links(module, environment, definition):
+    branch, _ = _resolve_branch('modules', module, definition)
+    logging.debug("Adding module '%s' (%s) to environment '%s'",
+                  module, branch, environment)
+    return [
+        # 1. Module's code directory
+        # LINK_NAME: $environment/modules/$module
+        # TARGET: $clonedir/modules/$module/$branch/code
+        (_generate_module_env_code_path(module, environment),
+         "%s/modules/%s/%s/code" % (_get_clonedir_prefix(2), module, branch)),
+        # 2. Module's data directory
+        # LINK_NAME: $environment/hieradata/module_names/$module
+        # TARGET: $clonedir/modules/$module/$branch/data
+        (_generate_module_env_hieradata_path(module, environment),
+         "%s/modules/%s/%s/data" % (_get_clonedir_prefix(3), module, branch)),
+    ]
+
+def _plan_hostgroup_links(hostgroup, environment, definition):
     branch, _ = _resolve_branch('hostgroups', hostgroup, definition)
     logging.debug("Adding hostgroup '%s' (%s) to environment '%s'",
                   hostgroup, branch, environment)
-    # 1. Hostgroup's code directory
-    # LINK_NAME: $environment/hostgroups/hg_$hostgroup
-    # TARGET: $clonedir/hostgroups/$hostgroup/$branch/code
-    target = "%s/hostgroups/%s/%s/code" % \
-             (settings.CLONEDIR, hostgroup, branch)
-    link_name = _generate_hostgroup_env_code_path(hostgroup, environment)
-    target = os.path.relpath(target,
-                             os.path.abspath(os.path.join(link_name, os.pardir)))
-    logging.debug("Linking %s to %s", link_name, target)
-    try:
-        os.symlink(target, link_name)
-    except OSError as error:
-        raise JensEnvironmentsError(error)
-
-    # 2. Hostgroup's hostgroup data directory
-    # LINK_NAME: $environment/hostgroups/hieratata/hostgroups/$hostgroup
-    # TARGET: $clonedir/hostgroups/$hostgroup/$branch/data/hostgroup
-    target = "%s/hostgroups/%s/%s/data/hostgroup" % \
-             (settings.CLONEDIR, hostgroup, branch)
-    link_name = _generate_hostgroup_env_hieradata_hostgroup_path(hostgroup,
-                                                                 environment)
-    target = os.path.relpath(target,
-                             os.path.abspath(os.path.join(link_name, os.pardir)))
-    logging.debug("Linking %s to %s", link_name, target)
-    try:
-        os.symlink(target, link_name)
-    except OSError as error:
-        raise JensEnvironmentsError(error)
-
-    # 3. Hostgroup's FQDNs data directory
-    # LINK_NAME: $environment/hostgroups/hieratata/fqdns/$hostgroup
-    # TARGET: $clonedir/hostgroups/$hostgroup/$branch/data/fqdns
-    target = "%s/hostgroups/%s/%s/data/fqdns" % \
-             (settings.CLONEDIR, hostgroup, branch)
-    link_name = \
-        _generate_hostgroup_env_hieradata_fqdns_path(hostgroup, environment)
-    target = os.path.relpath(target,
-                             os.path.abspath(os.path.join(link_name, os.pardir)))
-    logging.debug("Linking %s to %s", link_name, target)
-    try:
-        os.symlink(target, link_name)
-    except OSError as error:
-        raise JensEnvironmentsError(error)
+    return [
+        # 1. Hostgroup's code directory
+        # LINK_NAME: $environment/hostgroups/hg_$hostgroup
+        # TARGET: $clonedir/hostgroups/$hostgroup/$branch/code
+        (_generate_hostgroup_env_code_path(hostgroup, environment),
+         "%s/hostgroups/%s/%s/code" %
+         (_get_clonedir_prefix(2), hostgroup, branch)),
+        # 2. Hostgroup's hostgroup data directory
+        # LINK_NAME: $environment/hostgroups/hieratata/hostgroups/$hostgroup
+        # TARGET: $clonedir/hostgroups/$hostgroup/$branch/data/hostgroup
+        (_generate_hostgroup_env_hieradata_hostgroup_path(hostgroup, environment),
+         "%s/hostgroups/%s/%s/data/hostgroup" %
+         (_get_clonedir_prefix(3), hostgroup, branch)),
+        # 3. Hostgroup's FQDNs data directory
+        # LINK_NAME: $environment/hostgroups/hieratata/fqdns/$hostgroup
+        # TARGET: $clonedir/hostgroups/$hostgroup/$branch/data/fqdns
+        (_generate_hostgroup_env_hieradata_fqdns_path(hostgroup, environment),
+         "%s/hostgroups/%s/%s/data/fqdns" %
+         (_get_clonedir_prefix(3), hostgroup, branch)),
+    ]
+
+def _apply_links(links, replace=False):
+    for link_name, target in links:
+        _symlink(target, link_name, replace)
 
 def _unlink_module(module, environment):
     # 1. Module's code directory
@@ -371,46 +501,118 @@ def _unlink_hostgroup(hostgroup, environment):
     if os.path.islink(link_name):
         os.unlink(link_name)
 
-def _generate_module_env_code_path(module, environment):
+def _compose_environment_path(environment):
     settings = Settings()
-    return "%s/%s/modules/%s" % \
-            (settings.ENVIRONMENTSDIR, environment, module)
+    if environment in _staging_paths:
+        return _staging_paths[environment]
+    return "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
 
-def _generate_module_env_hieradata_path(module, environment):
+# Builds live next to ENVIRONMENTSDIR, at the same depth, so the
+# relative targets of the links inside are valid from both places.
+def _compose_staging_path(environment=None):
+    settings = Settings()
+    path = "%s.staging" % settings.ENVIRONMENTSDIR.rstrip("/")
+    if environment is not None:
+        os.makedirs(path, exist_ok=True)
+        path = "%s/%s.%s" % (path, environment, uuid.uuid4().hex)
+    return path
+
+# ENVIRONMENTSDIR/$environment is a link to the build, replaced with
+# rename(2), so readers see either the previous build or the new one.
+def _publish_environment(environment, staging_path):
     settings = Settings()
-    return "%s/%s/hieradata/module_names/%s" % \
-            (settings.ENVIRONMENTSDIR, environment, module)
+    link_name = "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
+    if os.path.isdir(link_name) and not os.path.islink(link_name):
+        logging.info("Replacing environment '%s' built in place", environment)
+        shutil.rmtree(link_name)
+    _symlink(os.path.relpath(staging_path, settings.ENVIRONMENTSDIR),
+             link_name, replace=True)
+    logging.info("Published environment '%s' (%s)", environment,
+                 os.path.basename(staging_path))
+
+# Builds that were replaced or deleted in the previous run are
+# removed now, so readers that were still using them had time to
+# finish.
+def _collect_staging_garbage():
+    settings = Settings()
+    staging_path = _compose_staging_path()
+    if not os.path.isdir(staging_path):
+        return
+    for build in os.listdir(staging_path):
+        link_name = "%s/%s" % (settings.ENVIRONMENTSDIR, build.split(".")[0])
+        if os.path.islink(link_name) and \
+                os.path.basename(os.readlink(link_name)) == build:
+            continue
+        logging.debug("Removing unused build '%s'", build)
+        shutil.rmtree("%s/%s" % (staging_path, build))
+
+def _generate_module_env_code_path(module, environment):
+    return "%s/modules/%s" % \
+            (_compose_environment_path(environment), module)
+
+def _generate_module_env_hieradata_path(module, environment):
+    return "%s/hieradata/module_names/%s" % \
+            (_compose_environment_path(environment), module)
 
 def _generate_hostgroup_env_code_path(hostgroup, environment):
-    settings = Settings()
-    return "%s/%s/hostgroups/hg_%s" % \
-            (settings.ENVIRONMENTSDIR, environment, hostgroup)
+    return "%s/hostgroups/hg_%s" % \
+            (_compose_environment_path(environment), hostgroup)
 
 def _generate_hostgroup_env_hieradata_hostgroup_path(hostgroup, environment):
-    settings = Settings()
-    return "%s/%s/hieradata/hostgroups/%s" % \
-            (settings.ENVIRONMENTSDIR, environment, hostgroup)
+    return "%s/hieradata/hostgroups/%s" % \
+            (_compose_environment_path(environment), hostgroup)
 
 def _generate_hostgroup_env_hieradata_fqdns_path(hostgroup, environment):
-    settings = Settings()
-    return "%s/%s/hieradata/fqdns/%s" % \
-            (settings.ENVIRONMENTSDIR, environment, hostgroup)
-
-def _annotate_environment(environment):
+    return "%s/hieradata/fqdns/%s" % \
+            (_compose_environment_path(environment), hostgroup)
+
+# The annotation of an environment holds the hash of the definition it
+# was built from and, in a second line, the parts of that definition
+# that determine the links, so it can be updated later on by only
+# changing what's different.
+def _annotate_environment(environment, definition):
     settings = Settings()
     hash_cache_file = open(settings.CACHEDIR + "/environments/%s" %
                            environment, "w+")
     environment_definition = settings.ENV_METADATADIR + "/%s.yaml" % \
                              environment
-    hash_value = hash_object(environment_definition)
+    # The hash of the content the definition was parsed from is known
+    cached = _definitions.get(environment_definition)
+    if cached is not None and cached[1] is definition:
+        hash_value = cached[0]
+    else:
+        hash_value = hash_object(environment_definition)
     logging.debug("New cached hash for environment '%s' is '%s'",
                   environment, hash_value)
+    resolved = dict((key, definition[key])
+                    for key in ('default', 'overrides', 'parser')
+                    if key in definition)
     # TODO: Add error handling here, if the cache can't be saved
     # basically the environment will be regenerated in the next
     # run (which is fine, but must be logged at INFO level)
+    # Pickled, as YAML can give keys of any type (a module called 123
+    # or 'on' for instance) and they must be read back as they were
     hash_cache_file.write(hash_value)
+    hash_cache_file.write("\n%s\n" % base64.b64encode(
+        pickle.dumps(resolved, pickle.HIGHEST_PROTOCOL)).decode('ascii'))
     hash_cache_file.close()
 
+def _read_environment_annotation(environment):
+    settings = Settings()
+    try:
+        with open(settings.CACHEDIR + "/environments/%s" %
+                  environment) as hash_cache_file:
+            hash_value = hash_cache_file.readline().strip()
+            resolved = hash_cache_file.readline().strip()
+    except IOError:
+        return (None, None)
+    try:
+        return (hash_value,
+                pickle.loads(base64.b64decode(resolved, validate=True)))
+    except (ValueError, pickle.PickleError, EOFError):
+        # Written by an older version, only the hash is there
+        return (hash_value, None)
+
 def _remove_environment_annotation(environment):
     settings = Settings()
     logging.debug("Removing cached hash for environment '%s'", environment)
@@ -429,7 +631,12 @@ def get_names_of_declared_environments():
     environments = [env for env in environments if re.match(r'^.+?\.yaml$', env)]
     return [re.sub(r'\.yaml$', '', env) for env in environments]
 
-def _calculate_delta():
+# Blob hashes of the definitions of the given environments, as Git
+# calculates them
+def get_environment_definition_hashes(environments):
+    return _hash_environment_definitions(environments, _get_metadata_head())
+
+def _calculate_delta(metadata_head=None):
     settings = Settings()
     delta = {'notchanged': [], 'changed': []}
     current_envs = set(os.listdir(settings.CACHEDIR + "/environments"))
@@ -439,86 +646,322 @@ def _calculate_delta():
     delta['deleted'] = current_envs.difference(updated_envs)
 
     existing = updated_envs.intersection(current_envs)
+    if metadata_head is not None and \
+            metadata_head == _read_processed_metadata_head():
+        logging.info("Environments metadata still at %s, no environment changed",
+                     metadata_head)
+        delta['notchanged'] = list(existing)
+        return delta
+
+    new_hashes = _hash_environment_definitions(existing, metadata_head)
 
     for environment in existing:
-        # TODO: Cache file should always be there, but check just in case
-        # and count it as changed if missing so the cache is generated again.
-        hash_cache_file = open(settings.CACHEDIR + "/environments/%s" %
-                               environment)
-        old_hash = hash_cache_file.read()
-        hash_cache_file.close()
-        new_hash = hash_object(settings.ENV_METADATADIR + "/%s.yaml" %
-                               environment)
-        if old_hash == new_hash:
+        # A missing annotation counts as changed so it's generated again
+        old_hash, _ = _read_environment_annotation(environment)
+        if old_hash == new_hashes[environment]:
             delta['notchanged'].append(environment)
         else:
             delta['changed'].append(environment)
 
     return delta
 
+# The blobs of the definitions committed to the metadata repository are
+# already known by Git, so only the files that aren't in the tree (if
+# any) have to be hashed. Without a HEAD (see _get_metadata_head) all
+# of them are.
+def _hash_environment_definitions(environments, metadata_head=None):
+    settings = Settings()
+    hashes = {}
+    if metadata_head is not None:
+        try:
+            blobs = ls_tree(settings.ENV_METADATADIR, metadata_head)
+        except JensGitError as error:
+            logging.error("Unable to list the environments metadata (%s)", error)
+            blobs = {}
+        for environment in environments:
+            blob = blobs.get("%s.yaml" % environment)
+            if blob is not None:
+                hashes[environment] = blob
+    # Hashed in-process, there's no 'git hash-object' to batch
+    for environment in environments:
+        if environment not in hashes:
+            hashes[environment] = hash_object(
+                settings.ENV_METADATADIR + "/%s.yaml" % environment)
+    return hashes
+
+# Definitions edited in place aren't what HEAD says they are, so no
+# HEAD is returned then. Everything is hashed from the working tree and
+# the next run can't skip the delta either, even if the edits are
+# reverted without committing anything.
+def _get_metadata_head():
+    settings = Settings()
+    if not os.path.exists(settings.ENV_METADATADIR + "/.git"):
+        return None
+    try:
+        head = get_head(settings.ENV_METADATADIR)
+        if has_local_changes(settings.ENV_METADATADIR, "*.yaml"):
+            logging.info("Environment definitions modified locally, "
+                         "not relying on the metadata HEAD")
+            return None
+        return head
+    except JensGitError as error:
+        logging.error("Unable to get HEAD of the environments metadata (%s)",
+                      error)
+        return None
+
+# The commit of the metadata repository the environments were last
+# refreshed from. If it hasn't moved there's nothing to recalculate.
+def _read_processed_metadata_head():
+    settings = Settings()
+    try:
+        with open(settings.CACHEDIR + "/environments_metadata_head") as head_file:
+            return head_file.read().strip()
+    except IOError:
+        return None
+
+def _write_processed_metadata_head(metadata_head):
+    settings = Settings()
+    path = settings.CACHEDIR + "/environments_metadata_head"
+    if metadata_head is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, "w") as head_file:
+        head_file.write(metadata_head)
+
+# The index of environments maps every (partition, element, treeish)
+# to the environments linking it, so the environments affected by a
+# change in the repositories are known without reading every
+# definition. Defaults are indexed under the element None, as they
+# apply to every element not overridden. It's kept in sync with the
+# annotations of the environments, from which it can be regenerated.
+def get_environments_using(partition, element, treeish=None, index=None):
+    if index is None:
+        index = _read_environments_index()
+    elements = index['elements'].get(partition, {})
+    explicit = elements.get(element, {})
+    overriding = set()
+    for environments in explicit.values():
+        overriding.update(environments)
+    users = {}
+    for key, environments in explicit.items():
+        users[key] = set(environments)
+    for key, environments in elements.get(None, {}).items():
+        environments = environments.difference(overriding)
+        if environments:
+            users.setdefault(key, set()).update(environments)
+    if treeish is not None:
+        users = {treeish: users[treeish]} if treeish in users else {}
+    return dict((key, sorted(environments))
+                for key, environments in users.items())
+
+# New elements are added to the environments with a default and deleted
+# ones are removed from those and the ones overriding them, no other
+# environment has to be refreshed.
+def _get_affected_environments(index, repositories_deltas):
+    affected = set()
+    for partition in ('modules', 'hostgroups'):
+        delta = repositories_deltas.get(partition, {})
+        new, deleted = delta.get('new', []), delta.get('deleted', [])
+        elements = index['elements'].get(partition, {})
+        if new or deleted:
+            for environments in elements.get(None, {}).values():
+                affected.update(environments)
+        for element in deleted:
+            for environments in elements.get(element, {}).values():
+                affected.update(environments)
+    return affected
+
+def _read_environments_index():
+    settings = Settings()
+    try:
+        with open(settings.CACHEDIR + "/environments_index", "rb") as index_file:
+            index = pickle.load(index_file)
+    except (IOError, EOFError, pickle.PickleError) as error:
+        logging.warning("Index of environments not found or corrupt (%s), "
+                        "generating...", error)
+        return _generate_environments_index()
+    # Environments could have been added or removed by someone else
+    # (for instance, by jens-reset)
+    if index.get('environments') != \
+            set(os.listdir(settings.CACHEDIR + "/environments")):
+        logging.warning("Index of environments out of date, generating...")
+        return _generate_environments_index()
+    return index
+
+def _write_environments_index(index):
+    settings = Settings()
+    index_file_path = settings.CACHEDIR + "/environments_index"
+    temporary_path = "%s.tmp" % index_file_path
+    logging.debug("Writing index of environments to %s", index_file_path)
+    try:
+        with open(temporary_path, "wb") as index_file:
+            pickle.dump(index, index_file)
+        os.rename(temporary_path, index_file_path)
+    except (IOError, OSError, pickle.PickleError) as error:
+        # It will be generated again in the next run
+        logging.error("Unable to write index of environments (%s)", error)
+        for path in (temporary_path, index_file_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def _generate_environments_index():
+    settings = Settings()
+    index = {'environments': set(), 'elements': {}}
+    _update_environments_index(index,
+                               os.listdir(settings.CACHEDIR + "/environments"))
+    return index
+
+def _update_environments_index(index, environments):
+    settings = Settings()
+    environments = set(environments)
+    for elements in index['elements'].values():
+        for element in list(elements.keys()):
+            for treeish in list(elements[element].keys()):
+                elements[element][treeish].difference_update(environments)
+                if not elements[element][treeish]:
+                    del elements[element][treeish]
+            if not elements[element]:
+                del elements[element]
+    index['environments'].difference_update(environments)
+
+    for environment in environments:
+        if not os.path.exists(settings.CACHEDIR + "/environments/%s" %
+                              environment):
+            continue
+        _, definition = _read_environment_annotation(environment)
+        if definition is None:
+            try:
+                definition = read_environment_definition(environment)
+            except JensEnvironmentsError as error:
+                logging.debug("Not indexing environment '%s' (%s)",
+                              environment, error)
+                definition = {}
+        index['environments'].add(environment)
+        default = definition.get('default')
+        overrides = definition.get('overrides') or {}
+        for partition in ('modules', 'hostgroups', 'common'):
+            elements = index['elements'].setdefault(partition, {})
+            if default is not None:
+                elements.setdefault(None, {}).setdefault(
+                    default, set()).add(environment)
+            for element, treeish in (overrides.get(partition) or {}).items():
+                elements.setdefault(element, {}).setdefault(
+                    treeish, set()).add(environment)
+
+# There's no HEAD to compare if definitions were edited in place (see
+# _get_metadata_head), so those runs aren't skipped either
+def _environments_up_to_date(metadata_head, repositories_deltas):
+    if metadata_head is None or \
+            metadata_head != _read_processed_metadata_head():
+        return False
+    for delta in repositories_deltas.values():
+        if delta.get('new') or delta.get('deleted'):
+            return False
+    return True
+
 def _resolve_branch(partition, element, definition):
-    overridden = False
-    branch = 'master'
-    if 'overrides' in definition:
-        if partition in definition['overrides']:
-            if element in list(definition['overrides'][partition].keys()):
-                branch = definition['overrides'][partition][element]
-                logging.info("%s '%s' overridden to use treeish '%s'",
-                             partition, element, branch)
-                overridden = True
-    if not overridden and 'default' in definition:
-        branch = definition['default']
+    branch, overridden = _get_treeish(partition, element, definition)
+    if overridden:
+        logging.info("%s '%s' overridden to use treeish '%s'",
+                     partition, element, branch)
     return (refname_to_dirname(branch), overridden)
 
-def _link_site(environment, definition):
-    # LINK_NAME: $environment/site
-    # TARGET: $clonedir/common/site/$branch/code
-    settings = Settings()
-    branch, _ = _resolve_branch('common', 'site', definition)
-    target = settings.CLONEDIR + "/common/site/%s/code" % branch
-    link_name = settings.ENVIRONMENTSDIR + "/%s/site" % environment
-    target = os.path.relpath(target,
-                             os.path.abspath(os.path.join(link_name, os.pardir)))
+def _get_treeish(partition, element, definition):
+    overrides = definition.get('overrides') or {}
+    if element in (overrides.get(partition) or {}):
+        return (overrides[partition][element], True)
+    return (definition.get('default', 'master'), False)
+
+def _is_element_wanted(partition, element, definition):
+    return 'default' in definition or \
+        element in ((definition.get('overrides') or {}).get(partition) or {})
+
+# Links are replaced by renaming a new link over them, so they never
+# disappear, not even briefly.
+def _symlink(target, link_name, replace=False):
     logging.debug("Linking %s to %s", link_name, target)
     try:
-        os.symlink(target, link_name)
+        if not replace:
+            os.symlink(target, link_name)
+            return
+        temporary_name = "%s/.%s.tmp" % os.path.split(link_name)
+        if os.path.lexists(temporary_name):
+            os.unlink(temporary_name)
+        os.symlink(target, temporary_name)
+        os.rename(temporary_name, link_name)
     except OSError as error:
         raise JensEnvironmentsError(error)
 
-def _link_common_hieradata(environment, definition):
+def _link_site(environment, definition, replace=False):
+    _apply_links(_plan_site_links(environment, definition), replace)
+
+def _link_common_hieradata(environment, definition, replace=False):
+    _apply_links(_plan_common_hieradata_links(environment, definition), replace)
+
+def _plan_site_links(environment, definition):
+    # LINK_NAME: $environment/site
+    # TARGET: $clonedir/common/site/$branch/code
+    branch, _ = _resolve_branch('common', 'site', definition)
+    return [(_compose_environment_path(environment) + "/site",
+             "%s/common/site/%s/code" % (_get_clonedir_prefix(1), branch))]
+
+def _plan_common_hieradata_links(environment, definition):
     # Global scoped (aka, 'common') Hiera data
     # LINK_NAME: $environment/hieradata/
     # {settings.COMMON_HIERADATA_ITEMS}
     # TARGET: $clonedir/common/hieradata/$branch/data/{ditto}
     settings = Settings()
     branch, _ = _resolve_branch('common', 'hieradata', definition)
-    base_target = settings.CLONEDIR + "/common/hieradata/%s/data" % branch
-    base_link_name = settings.ENVIRONMENTSDIR + "/%s/hieradata" % environment
-
+    base_link_name = _compose_environment_path(environment) + "/hieradata"
+    links = []
     for element in settings.COMMON_HIERADATA_ITEMS:
-        target = base_target + "/%s" % element
-        link_name = base_link_name + "/%s" % element
-        target = os.path.relpath(target, \
-            os.path.abspath(os.path.join(link_name, os.pardir)))
-        logging.debug("Linking %s to %s", link_name, target)
-        try:
-            os.symlink(target, link_name)
-        except OSError as error:
-            raise JensEnvironmentsError(error)
+        element = element.strip("/")
+        prefix = _get_clonedir_prefix(2 + element.count("/"))
+        links.append(("%s/%s" % (base_link_name, element),
+                      "%s/common/hieradata/%s/data/%s" %
+                      (prefix, branch, element)))
+    return links
+
+# Links are relative and all environments (and their builds in the
+# staging area) live at the same depth, so the path from a directory
+# of an environment to CLONEDIR only depends on how deep the directory
+# is. It's calculated once per depth instead of once per link.
+def _get_clonedir_prefix(depth):
+    settings = Settings()
+    key = (settings.CLONEDIR, settings.ENVIRONMENTSDIR, depth)
+    prefix = _clonedir_prefixes.get(key)
+    if prefix is None:
+        directory = os.path.join(os.path.abspath(settings.ENVIRONMENTSDIR),
+                                 *(["environment"] * depth))
+        prefix = os.path.relpath(settings.CLONEDIR, directory)
+        _clonedir_prefixes[key] = prefix
+    return prefix
 
 def _add_configuration_file(environment, definition):
-    settings = Settings()
-    conf_file_path = "%s/%s/%s" % \
-        (settings.ENVIRONMENTSDIR, environment,
+    conf_file_path = "%s/%s" % \
+        (_compose_environment_path(environment),
          DIRECTORY_ENVIRONMENTS_CONF_FILENAME)
-    config = ConfigObj(conf_file_path)
+    # Generated from scratch, so options that are not in the
+    # definition anymore are gone, and swapped in one go
+    config = ConfigObj()
     config['modulepath'] = "modules:hostgroups"
     config['manifest'] = "site/site.pp"
     if 'parser' in definition:
         config['parser'] = definition['parser']
 
+    temporary_path = "%s.tmp" % conf_file_path
     try:
-        config.write()
-    except IOError:
+        with open(temporary_path, 'wb') as conf_file:
+            config.write(conf_file)
+        os.rename(temporary_path, conf_file_path)
+    except (IOError, OSError):
         raise JensEnvironmentsError("Unable to write to %s" %
                                     conf_file_path)
+
+def _remove_configuration_file(environment):
+    conf_file_path = "%s/%s" % \
+        (_compose_environment_path(environment),
+         DIRECTORY_ENVIRONMENTS_CONF_FILENAME)
+    if os.path.exists(conf_file_path):
+        os.unlink(conf_file_path)
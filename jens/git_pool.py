@@ -0,0 +1,92 @@
+# Copyright (C) 2026, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import absolute_import
+import os
+import logging
+from collections import OrderedDict
+
+import git
+
+from jens.settings import Settings
+
+# GitPython keeps one 'git cat-file --batch' and one
+# 'git cat-file --batch-check' process alive per git.Repo object
+# (see GitCmdObjectDB). Opening a new git.Repo for every call
+# throws them away, so instead the objects are kept in a small
+# LRU pool indexed by path and reused across calls.
+_pool = OrderedDict()
+_pool_pid = None
+
+def get_repository(repository_path):
+    settings = Settings()
+    if settings.GIT_POOL_SIZE == 0:
+        return git.Repo(repository_path, odbt=git.GitCmdObjectDB)
+
+    _check_owner()
+    key = os.path.abspath(repository_path)
+    entry = _pool.get(key)
+    if entry is not None:
+        repo, identity = entry
+        if identity == _identity(repo):
+            _pool.move_to_end(key)
+            return repo
+        logging.debug("Repository %s changed on disk, reopening", key)
+        release_repository(key)
+
+    repo = git.Repo(repository_path, odbt=git.GitCmdObjectDB)
+    _pool[key] = (repo, _identity(repo))
+    while len(_pool) > settings.GIT_POOL_SIZE:
+        _, (evicted, _) = _pool.popitem(last=False)
+        evicted.close()
+    return repo
+
+def release_repository(repository_path):
+    _check_owner()
+    entry = _pool.pop(os.path.abspath(repository_path), None)
+    if entry is not None:
+        entry[0].close()
+
+def release_all():
+    _check_owner()
+    logging.debug("Releasing %d pooled repositories", len(_pool))
+    while _pool:
+        _, (repo, _) = _pool.popitem()
+        repo.close()
+
+def _check_owner():
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool_pid != pid:
+        for repo, _ in _pool.values():
+            _detach(repo)
+        _pool = OrderedDict()
+        _pool_pid = pid
+
+# Repositories opened by a parent process must not be finalised by a
+# forked child as is, GitPython would then terminate the parent's
+# persistent processes. The child forgets about them instead.
+def _detach(repo):
+    for attribute in ('cat_file_all', 'cat_file_header'):
+        command = getattr(repo.git, attribute, None)
+        if command is not None and command.proc is not None:
+            # Only the child's ends of the pipes are closed
+            for stream in (command.proc.stdin, command.proc.stdout,
+                           command.proc.stderr):
+                if stream is not None:
+                    stream.close()
+            command.proc = None
+        setattr(repo.git, attribute, None)
+
+# A repository removed and created again in the same path (for instance
+# when a clone is recreated) must not be served by stale processes
+def _identity(repo):
+    try:
+        stat = os.stat(repo.git_dir)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino)
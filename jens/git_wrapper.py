@@ -6,20 +6,27 @@
 # or submit itself to any jurisdiction.
 
 from __future__ import absolute_import
+import os
 import git
+import hashlib
 import logging
 from jens.decorators import git_exec
+from jens.errors import JensGitError
+from jens.git_pool import release_repository
+
+# Git's object id of a blob is the SHA-1 of a small header followed by
+# the content, so there's no need to fork 'git hash-object' to get it.
+# Like 'git hash-object' outside a repository, no filters are applied.
+def hash_blob(data):
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
 
 def hash_object(path):
-    args = [path]
-    kwargs = {}
     logging.debug("Hashing object %s", path)
-
-    @git_exec
-    def hash_object_exec(*args, **kwargs):
-        return git.cmd.Git().hash_object(*args, **kwargs).strip()
-
-    return hash_object_exec(name='hash-object', args=args, kwargs=kwargs)
+    try:
+        with open(path, 'rb') as blob:
+            return hash_blob(blob.read())
+    except (IOError, OSError) as error:
+        raise JensGitError("Couldn't hash object %s (%s)" % (path, error))
 
 # pylint: disable=invalid-name
 # (too short but all match Git command names)
@@ -29,11 +36,13 @@ def gc(repository_path, aggressive=False):
     logging.debug("Collecting garbage in %s", repository_path)
 
     @git_exec
-    def gc_exec(*args, **kwargs):
-        repo = git.Repo(repository_path, odbt=git.GitCmdObjectDB)
+    def gc_exec(repo, *args, **kwargs):
         repo.git.gc(*args, **kwargs)
 
-    gc_exec(name='gc', args=args, kwargs=kwargs)
+    gc_exec(name='gc', repository_path=repository_path,
+            args=args, kwargs=kwargs)
+    # Packs have been rewritten
+    release_repository(repository_path)
 
 def clone(repository_path, url, bare=False, shared=False, branch=None):
     args = [url, repository_path]
@@ -50,19 +59,86 @@ def clone(repository_path, url, bare=False, shared=False, branch=None):
     def clone_exec(*args, **kwargs):
         git.Repo.clone_from(*args, **kwargs)
 
+    release_repository(repository_path)
     clone_exec(name='clone', args=args, kwargs=kwargs)
 
+def add_worktree(repository_path, worktree_path, treeish):
+    # Forced so paths of worktrees removed by hand can be reused
+    args = ["add", "--force", "--detach", worktree_path, treeish]
+    kwargs = {}
+    logging.debug("Adding worktree %s to %s (%s)", worktree_path,
+                  repository_path, treeish)
+
+    @git_exec
+    def add_worktree_exec(repo, *args, **kwargs):
+        repo.git.worktree(*args, **kwargs)
+
+    release_repository(worktree_path)
+    add_worktree_exec(name='worktree-add', repository_path=repository_path,
+                      args=args, kwargs=kwargs)
+
+def prune_worktrees(repository_path):
+    args = ["prune"]
+    kwargs = {}
+    logging.debug("Pruning stale worktrees of %s", repository_path)
+
+    @git_exec
+    def prune_worktrees_exec(repo, *args, **kwargs):
+        repo.git.worktree(*args, **kwargs)
+
+    prune_worktrees_exec(name='worktree-prune',
+                         repository_path=repository_path,
+                         args=args, kwargs=kwargs)
+
+def export_tree(repository_path, treeish, target_path):
+    args = [treeish]
+    kwargs = {}
+    logging.debug("Exporting %s of %s to %s", treeish,
+                  repository_path, target_path)
+    # A throwaway index is used so the one of the repository
+    # (if any) is left untouched.
+    index_path = "%s.index" % target_path
+    env = {"GIT_INDEX_FILE": index_path, "GIT_WORK_TREE": target_path}
+
+    @git_exec
+    def export_tree_exec(repo, *args, **kwargs):
+        repo.git.read_tree(*args, env=env, **kwargs)
+        repo.git.checkout_index(all=True, force=True, env=env)
+
+    try:
+        export_tree_exec(name='export-tree', repository_path=repository_path,
+                         args=args, kwargs=kwargs)
+    finally:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
 def fetch(repository_path, prune=False):
     args = []
     kwargs = {"no-tags": True, "prune": prune}
     logging.debug("Fetching new refs in %s", repository_path)
 
     @git_exec
-    def fetch_exec(*args, **kwargs):
-        repo = git.Repo(repository_path, odbt=git.GitCmdObjectDB)
+    def fetch_exec(repo, *args, **kwargs):
         repo.remotes.origin.fetch(*args, **kwargs)
 
-    fetch_exec(name='fetch', args=args, kwargs=kwargs)
+    fetch_exec(name='fetch', repository_path=repository_path,
+               args=args, kwargs=kwargs)
+
+def ls_remote(repository_path):
+    args = ["origin"]
+    kwargs = {"heads": True, "tags": True}
+    logging.debug("Listing remote refs of %s", repository_path)
+
+    @git_exec
+    def ls_remote_exec(repo, *args, **kwargs):
+        refs = {}
+        for line in repo.git.ls_remote(*args, **kwargs).splitlines():
+            sha, refname = line.split("\t", 1)
+            refs[refname] = sha
+        return refs
+
+    return ls_remote_exec(name='ls-remote', repository_path=repository_path,
+                          args=args, kwargs=kwargs)
 
 def reset(repository_path, treeish, hard=False):
     args = [treeish]
@@ -70,33 +146,233 @@ def reset(repository_path, treeish, hard=False):
     logging.debug("Resetting %s to %s", repository_path, treeish)
 
     @git_exec
-    def reset_exec(*args, **kwargs):
-        repo = git.Repo(repository_path, odbt=git.GitCmdObjectDB)
+    def reset_exec(repo, *args, **kwargs):
         repo.git.reset(*args, **kwargs)
 
-    reset_exec(name='reset', args=args, kwargs=kwargs)
+    reset_exec(name='reset', repository_path=repository_path,
+               args=args, kwargs=kwargs)
 
-def get_refs(repository_path):
-    args = []
+# Without the fallback only the filesystem is touched, so it's safe to
+# call from several threads. None is returned if Git would be needed.
+def get_refs(repository_path, fallback=True):
+    logging.debug("Reading refs of %s", repository_path)
+    git_dir = _find_git_dir(repository_path)
+    if git_dir is not None:
+        try:
+            return _read_refs(git_dir)
+        except _UnsupportedRefs as error:
+            logging.debug("Can't read refs of %s directly (%s)",
+                          repository_path, error)
+    if not fallback:
+        return None
+
+    args = ["refs/heads"]
+    kwargs = {"format": "%(objectname) %(refname:strip=2)"}
+
+    @git_exec
+    def get_refs_exec(repo, *args, **kwargs):
+        refs = {}
+        for line in repo.git.for_each_ref(*args, **kwargs).splitlines():
+            sha, refname = line.split(" ", 1)
+            refs[refname] = sha
+        return refs
+
+    return get_refs_exec(name='for-each-ref',
+                         repository_path=repository_path, args=args, kwargs=kwargs)
+
+class _UnsupportedRefs(Exception):
+    pass
+
+def _find_git_dir(repository_path):
+    if not os.path.isdir(repository_path):
+        raise JensGitError("No such path %s" % repository_path)
+    dot_git = os.path.join(repository_path, ".git")
+    if os.path.isdir(dot_git):
+        return dot_git
+    if os.path.exists(dot_git):
+        return None  # gitfile (worktree), let Git find the right dir
+    if os.path.isfile(os.path.join(repository_path, "HEAD")) and \
+            os.path.isdir(os.path.join(repository_path, "objects")) and \
+            os.path.isdir(os.path.join(repository_path, "refs")):
+        return repository_path
+    raise JensGitError("Not a git repository: %s" % repository_path)
+
+# Builds a {branch: sha} snapshot of the heads in a single pass reading
+# packed-refs and the loose refs, as Git would do, instead of resolving
+# every head one by one. Anything that is not the usual ref storage
+# is left to git-for-each-ref.
+def _read_refs(git_dir):
+    if os.path.isdir(os.path.join(git_dir, "reftable")):
+        raise _UnsupportedRefs("reftable")
+    refs = {}
+    try:
+        with open(os.path.join(git_dir, "packed-refs"), "r") as packed_refs:
+            for line in packed_refs:
+                if line.startswith(("#", "^")):
+                    continue
+                sha, _, refname = line.rstrip("\n").partition(" ")
+                if refname.startswith("refs/heads/"):
+                    refs[refname[11:]] = sha
+    except FileNotFoundError:
+        pass
+    except IOError as error:
+        raise JensGitError("Unable to read packed refs (%s)" % error)
+
+    heads_path = os.path.join(git_dir, "refs", "heads")
+    for path, _, files in os.walk(heads_path):
+        for _file in files:
+            if _file.endswith(".lock"):
+                continue
+            ref_path = os.path.join(path, _file)
+            try:
+                with open(ref_path, "r") as ref:
+                    sha = ref.read().strip()
+            except IOError as error:
+                raise JensGitError("Unable to read ref %s (%s)" %
+                                   (ref_path, error))
+            if sha.startswith("ref:"):
+                raise _UnsupportedRefs("%s is a symbolic ref" % ref_path)
+            refs[os.path.relpath(ref_path, heads_path)] = sha
+    return refs
+
+# Moves HEAD (and the branch it points to, if any) of a checkout to
+# treeish rewriting only the paths that differ between both trees,
+# instead of stat'ing the whole working tree as reset --hard does.
+# Falls back to a hard reset if the two-way merge can't be done (for
+# instance, if some of the paths to update were modified locally).
+# Returns the number of paths written.
+def update_tree(repository_path, treeish):
+    args = [treeish]
+    kwargs = {}
+    logging.debug("Updating tree of %s to %s", repository_path, treeish)
+
+    @git_exec
+    def update_tree_exec(repo, *args, **kwargs):
+        old = repo.head.commit.hexsha
+        new = repo.git.rev_parse("%s^{commit}" % treeish)
+        if old == new:
+            return 0
+        paths = repo.git.diff_tree(old, new, r=True, name_only=True, z=True)
+        paths = [path for path in paths.split("\0") if path]
+        repo.git.read_tree(old, new, m=True, u=True)
+        repo.git.reset(new, soft=True)
+        return len(paths)
+
+    try:
+        return update_tree_exec(name='update-tree',
+                                repository_path=repository_path,
+                                args=args, kwargs=kwargs)
+    except JensGitError as error:
+        logging.warning("Incremental update of %s failed, resetting (%s)",
+                        repository_path, error)
+
+    @git_exec
+    def count_paths_exec(repo, *args, **kwargs):
+        paths = repo.git.diff(*args, name_only=True, z=True)
+        return len([path for path in paths.split("\0") if path])
+
+    count = count_paths_exec(name='diff', repository_path=repository_path,
+                             args=["HEAD", treeish], kwargs={})
+    reset(repository_path, treeish, hard=True)
+    return count
+
+def ls_tree(repository_path, treeish):
+    args = [treeish]
     kwargs = {}
+    logging.debug("Listing tree %s of %s", treeish, repository_path)
 
     @git_exec
-    def get_refs_exec(*args, **kwargs):
-        repo = git.Repo(repository_path, odbt=git.GitCmdObjectDB)
-        return dict((h.name, h.commit.hexsha) for h in repo.heads)
+    def ls_tree_exec(repo, *args, **kwargs):
+        blobs = {}
+        for line in repo.git.ls_tree(*args, **kwargs).splitlines():
+            info, path = line.split("\t", 1)
+            _, object_type, sha = info.split()
+            if object_type == 'blob':
+                blobs[path] = sha
+        return blobs
+
+    return ls_tree_exec(name='ls-tree', repository_path=repository_path,
+                        args=args, kwargs=kwargs)
 
-    return get_refs_exec(name='show-ref', args=args, kwargs=kwargs)
+# Modified, staged, deleted or untracked files matching pathspec
+def has_local_changes(repository_path, pathspec):
+    args = ["--", pathspec]
+    kwargs = {"porcelain": True, "untracked_files": "all"}
+    logging.debug("Looking for local changes to %s in %s",
+                  pathspec, repository_path)
+
+    @git_exec
+    def status_exec(repo, *args, **kwargs):
+        return repo.git.status(*args, **kwargs) != ""
+
+    return status_exec(name='status', repository_path=repository_path,
+                       args=args, kwargs=kwargs)
 
 def rev_parse(repository_path, ref, short=False):
     args = [ref]
     kwargs = {"short": short}
 
     @git_exec
-    def rev_parse_exec(*args, **kwargs):
-        repo = git.Repo(repository_path, odbt=git.GitCmdObjectDB)
+    def rev_parse_exec(repo, *args, **kwargs):
         return repo.git.rev_parse(*args, **kwargs)
 
-    return rev_parse_exec(name='rev-parse', args=args, kwargs=kwargs)
+    return rev_parse_exec(name='rev-parse',
+                          repository_path=repository_path, args=args, kwargs=kwargs)
+
+# Reads the commit HEAD of a checkout (a clone or a worktree) points to
+# straight from the files, without spawning anything, so it can be
+# called for lots of checkouts and from several threads.
+# Same as get_refs regarding the fallback
+def read_head(repository_path, fallback=True):
+    logging.debug("Reading HEAD of %s", repository_path)
+    git_dir = _find_checkout_git_dir(repository_path)
+    try:
+        with open(os.path.join(git_dir, "HEAD"), "r") as head_file:
+            head = head_file.read().strip()
+    except IOError as error:
+        raise JensGitError("Unable to read HEAD of %s (%s)" %
+                           (repository_path, error))
+    if not head.startswith("ref:"):
+        return head
+    refname = head[4:].strip()
+    if not refname.startswith("refs/heads/"):
+        raise JensGitError("HEAD of %s points to %s" %
+                           (repository_path, refname))
+    try:
+        refs = _read_refs(_find_common_dir(git_dir))
+    except _UnsupportedRefs:
+        if not fallback:
+            return None
+        return get_head(repository_path)
+    if refname[11:] not in refs:
+        raise JensGitError("HEAD of %s points to a missing branch (%s)" %
+                           (repository_path, refname))
+    return refs[refname[11:]]
+
+def _find_checkout_git_dir(repository_path):
+    dot_git = os.path.join(repository_path, ".git")
+    if os.path.isdir(dot_git):
+        return dot_git
+    # Worktrees have a gitfile pointing to their administrative dir
+    try:
+        with open(dot_git, "r") as gitfile:
+            content = gitfile.read().strip()
+    except IOError as error:
+        raise JensGitError("Not a git checkout: %s (%s)" %
+                           (repository_path, error))
+    if not content.startswith("gitdir:"):
+        raise JensGitError("Malformed gitfile in %s" % repository_path)
+    return os.path.join(repository_path, content[7:].strip())
+
+def _find_common_dir(git_dir):
+    try:
+        with open(os.path.join(git_dir, "commondir"), "r") as commondir:
+            return os.path.join(git_dir, commondir.read().strip())
+    except FileNotFoundError:
+        return git_dir
+    except IOError as error:
+        raise JensGitError("Unable to read %s/commondir (%s)" %
+                           (git_dir, error))
 
 def get_head(repository_path, short=False):
     args = []
@@ -104,11 +380,11 @@ def get_head(repository_path, short=False):
     logging.debug("Getting HEAD of %s", repository_path)
 
     @git_exec
-    def get_head_exec(*args, **kwargs):
-        repo = git.Repo(repository_path, odbt=git.GitCmdObjectDB)
+    def get_head_exec(repo, *args, **kwargs):
         sha = repo.head.commit.hexsha
         if short:
             sha = rev_parse(repository_path, sha, short=True)
         return sha
 
-    return get_head_exec(name='get-head', args=args, kwargs=kwargs)
+    return get_head_exec(name='get-head',
+                         repository_path=repository_path, args=args, kwargs=kwargs)
@@ -6,45 +6,165 @@
 # or submit itself to any jurisdiction.
 
 from __future__ import absolute_import
+import io
+import os
+import time
+import errno
 import logging
 import pickle
 
 from datetime import datetime
 
 from dirq.queue import Queue
-from dirq.queue import QueueLockError, QueueError
+from dirq.queue import QueueError
 
 from jens.errors import JensMessagingError
 from jens.decorators import timed
 from jens.settings import Settings
-from functools import reduce
 
 MSG_SCHEMA = {'time': 'string', 'data': 'binary'}
 
-# Ex (after unpickling 'data'):
-# {'time': '2015-12-10T14:06:35.339550', 'data': {'modules': ['m1']}}
+# 'data' is a single line of UTF-8 text: a header carrying the version
+# of the format, the partition and the name of the repository.
+# Ex: {'time': '2015-12-10T14:06:35.339550', 'data': b'jens-hint/1 modules m1'}
+HINT_HEADER_PREFIX = b"jens-hint/"
+HINT_FORMAT_VERSION = 1
+HINT_HEADER = HINT_HEADER_PREFIX + str(HINT_FORMAT_VERSION).encode('ascii')
+HINT_PARTITIONS = ("modules", "hostgroups", "common")
+
+# Producers used to send pickled dictionaries instead, for instance
+# pickle.dumps({'modules': ['m1'], 'hostgroups': ['h1']}). They're
+# still understood (see [messaging] accept_pickled_hints) but only
+# made of dicts, lists and strings, as nothing else is unpickled.
+
+# Elements are locked and read one at a time but they're only removed
+# from the queue in batches, once the hints they carry have been merged.
+# Whatever the depth of the queue, only one batch of element names and
+# the (deduplicated) hints are kept in memory. Batches are kept small
+# as locking gets slower the more elements are held locked. If reading
+# or merging fails the elements not removed yet are unlocked instead.
+REMOVAL_BATCH_SIZE = 20
+
+# Runs are serialised by the update lock, so elements still locked
+# when the queue is read were left behind by a run that died. They're
+# unlocked if their lock is older than STALE_LOCK_AGE seconds.
+STALE_LOCK_AGE = 60
+
+# A marker named after partition/name is created in the pending
+# directory when a hint is enqueued and removed when the hint is
+# consumed. While it's there, enqueuing the same hint again is a no-op.
+# Markers older than PENDING_MARKER_TTL seconds are ignored, so a
+# marker left behind by a crashed producer can't swallow hints forever.
+PENDING_MARKER_TTL = 900
+
+# Hints enqueued and coalesced by this process
+producer_stats = {'queued': 0, 'coalesced': 0}
 
 @timed
 def fetch_update_hints():
     hints = {}
     logging.info("Getting and processing hints...")
+    stats = {'messages': 0, 'hints': 0}
+    messages = _iterate_messages(stats)
     try:
-        messages = _fetch_all_messages()
+        hints = _validate_and_merge_messages(messages, stats)
+    except JensMessagingError:
+        raise
     except Exception as error:
         raise JensMessagingError("Could not retrieve messages (%s)" % error)
+    finally:
+        # Unlocks what's left if merging failed
+        messages.close()
 
-    logging.info("%d messages found", len(messages))
-    hints = _validate_and_merge_messages(messages)
+    unique = sum(len(names) for names in hints.values())
+    logging.info("%d messages found (%d hints, %d duplicated)",
+                 stats['messages'], stats['hints'], stats['hints'] - unique)
     return hints
 
 def enqueue_hint(partition, name):
-    if partition not in ("modules", "hostgroups", "common"):
+    if partition not in HINT_PARTITIONS:
         raise JensMessagingError("Unknown partition '%s'" % partition)
+    if not name or '\n' in name:
+        raise JensMessagingError("Invalid name '%s'" % name)
+
+    marker = _create_pending_marker(partition, name)
+    if marker is False:
+        producer_stats['coalesced'] += 1
+        logging.info("Hint '%s/%s' already pending, not queued again "
+                     "(%d queued, %d coalesced so far)", partition, name,
+                     producer_stats['queued'], producer_stats['coalesced'])
+        return False
+
     hint = {'time': datetime.now().isoformat(),
-            'data': pickle.dumps({partition: [name]})}
+            'data': _encode_hint(partition, name)}
+
+    try:
+        _queue_item(hint)
+    except JensMessagingError:
+        if marker is not None:
+            _remove_pending_marker(partition, name)
+        raise
+    producer_stats['queued'] += 1
+    logging.info("Hint '%s/%s' added to the queue "
+                 "(%d queued, %d coalesced so far)", partition, name,
+                 producer_stats['queued'], producer_stats['coalesced'])
+    return True
+
+def count_pending_repositories():
+    settings = Settings()
+    path = settings.MESSAGING_PENDINGDIR
+    try:
+        return sum(len(os.listdir(os.path.join(path, partition)))
+                   for partition in os.listdir(path))
+    except FileNotFoundError:
+        return 0
+    except OSError as error:
+        raise JensMessagingError("Failed to list pending hints (%s)" % error)
+
+def _get_pending_marker_path(partition, name):
+    # Not coalesced if the name can't be used as a file name
+    if not name or name.startswith('.') or os.sep in name:
+        return None
+    settings = Settings()
+    return os.path.join(settings.MESSAGING_PENDINGDIR, partition, name)
+
+# Returns the path to the new marker, None if the hint can't be
+# coalesced or False if the hint is already pending
+def _create_pending_marker(partition, name):
+    path = _get_pending_marker_path(partition, name)
+    if path is None:
+        return None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        return path
+    except FileExistsError:
+        pass
+    except OSError as error:
+        logging.warning("Couldn't create pending marker for '%s/%s' (%s)",
+                        partition, name, error)
+        return None
+    try:
+        if time.time() - os.stat(path).st_mtime < PENDING_MARKER_TTL:
+            return False
+        logging.warning("Ignoring stale pending marker for '%s/%s'",
+                        partition, name)
+        os.utime(path)
+    except OSError as error:
+        logging.warning("Couldn't check pending marker for '%s/%s' (%s)",
+                        partition, name, error)
+    return path
 
-    _queue_item(hint)
-    logging.info("Hint '%s/%s' added to the queue", partition, name)
+def _remove_pending_marker(partition, name):
+    path = _get_pending_marker_path(partition, name)
+    if path is None:
+        return
+    try:
+        os.unlink(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            logging.error("Couldn't remove pending marker for '%s/%s' (%s)",
+                          partition, name, error)
 
 def _queue_item(item):
     settings = Settings()
@@ -74,56 +194,132 @@ def purge_queue():
     except OSError as error:
         raise JensMessagingError("Failed to purge Queue object (%s)" % error)
 
-def _fetch_all_messages():
+def _iterate_messages(stats=None):
     settings = Settings()
     try:
         queue = Queue(settings.MESSAGING_QUEUEDIR, schema=MSG_SCHEMA)
     except OSError as error:
         raise JensMessagingError("Failed to create Queue object (%s)" % error)
-    msgs = []
-    for _, name in enumerate(queue):
-        try:
-            item = queue.dequeue(name)
-        except QueueLockError as error:
-            logging.warning("Element %s was locked when dequeuing", name)
-            continue
-        except OSError as error:
-            logging.error("I/O error when getting item %s", name)
-            continue
+    try:
+        queue.purge(maxtemp=0, maxlock=STALE_LOCK_AGE)
+    except OSError as error:
+        logging.warning("Couldn't unlock stale elements (%s)", error)
+    batch = []
+    try:
+        for name in queue:
+            try:
+                if not queue.lock(name):
+                    logging.warning("Element %s was locked when dequeuing", name)
+                    continue
+                item = queue.get(name)
+            except OSError as error:
+                logging.error("I/O error when getting item %s", name)
+                continue
+            # Everything yielded so far has been merged by now, discarded
+            # messages included so they can't grow the batch either
+            if len(batch) >= REMOVAL_BATCH_SIZE:
+                _remove_elements(queue, batch)
+            batch.append(name)
+            try:
+                item['data'] = _decode_hints(item['data'])
+            except ValueError as error:
+                logging.warning("Discarding message %s (%s)", name, error)
+                continue
+            logging.debug("Message %s extracted and decoded", name)
+            if stats is not None:
+                stats['messages'] += 1
+            yield item
+            # Merged, so new hints for these repositories have to be
+            # queued again. Done before the element is removed so a
+            # marker can't outlive it and swallow hints.
+            for partition, hinted in item['data']:
+                _remove_pending_marker(partition, hinted)
+    except BaseException:
+        _unlock_elements(queue, batch)
+        raise
+    _remove_elements(queue, batch)
+
+def _remove_elements(queue, names):
+    logging.debug("Removing %d elements from the queue", len(names))
+    for name in names:
         try:
-            item['data'] = pickle.loads(item['data'])
-        except (pickle.PickleError, EOFError) as error:
-            logging.debug("Couldn't unpickle item %s. Will be ignored.", name)
-            continue
-        logging.debug("Message %s extracted and unpickled", name)
-        msgs.append(item)
+            queue.remove(name)
+        except (QueueError, OSError) as error:
+            logging.error("Couldn't remove element %s (%s)", name, error)
+    del names[:]
 
-    return msgs
+def _unlock_elements(queue, names):
+    logging.debug("Unlocking %d elements of the queue", len(names))
+    for name in names:
+        try:
+            queue.unlock(name)
+        except (QueueError, OSError) as error:
+            logging.error("Couldn't unlock element %s (%s)", name, error)
+    del names[:]
 
-def _validate_and_merge_messages(messages):
+def _validate_and_merge_messages(messages, stats=None):
     hints = {'modules': set(), 'hostgroups': set(), 'common': set()}
-    def _merger(acc, element):
-        if 'time' not in element:
-            logging.warning("Discarding message: No timestamp")
-            return acc
-        time = element['time']
-        if 'data' not in element or type(element['data']) != dict:
-            logging.warning("Discarding message (%s): Bad data section", time)
-            return acc
-        for k, v in element['data'].items():
-            if k not in hints:
-                logging.warning("Discarding message (%s): Unknown partition '%s'", time, k)
-                continue
-            if type(v) != list:
-                logging.warning("Discarding message (%s): Value '%s' is not a list", time, v)
-                continue
-            for item in v:
-                if type(item) == str:
-                    logging.debug("Accepted message %s:%s created at %s",
-                                  k, v, element['time'])
-                    acc[k].add(item)
-                else:
-                    logging.warning("Discarding item '%s' in (%s - %s:%s): not a str",
-                                 item, time, k, v)
-        return acc
-    return reduce(_merger, messages, hints)
+    for message in messages:
+        for partition, name in message['data']:
+            logging.debug("Accepted hint %s:%s created at %s",
+                          partition, name, message['time'])
+            hints[partition].add(name)
+            if stats is not None:
+                stats['hints'] += 1
+    return hints
+
+def _encode_hint(partition, name):
+    return b" ".join((HINT_HEADER, partition.encode('utf-8'),
+                      name.encode('utf-8')))
+
+# Returns a list of (partition, name) or raises ValueError if the
+# payload is malformed
+def _decode_hints(data):
+    if not data.startswith(HINT_HEADER_PREFIX):
+        return _decode_pickled_hints(data)
+    header, _, body = data.partition(b" ")
+    if header != HINT_HEADER:
+        raise ValueError("unsupported format '%s'" %
+                         header.decode('ascii', 'replace'))
+    try:
+        partition, _, name = body.decode('utf-8').partition(" ")
+    except UnicodeDecodeError:
+        raise ValueError("not UTF-8")
+    if partition not in HINT_PARTITIONS:
+        raise ValueError("unknown partition '%s'" % partition)
+    if not name or '\n' in name:
+        raise ValueError("invalid name '%s'" % name)
+    return [(partition, name)]
+
+class _HintsUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("'%s.%s' is not allowed" % (module, name))
+
+def _decode_pickled_hints(data):
+    settings = Settings()
+    if not settings.MESSAGING_ACCEPT_PICKLED_HINTS:
+        raise ValueError("unknown format")
+    try:
+        payload = _HintsUnpickler(io.BytesIO(data)).load()
+    # Anything can come out of a broken or malicious pickle
+    except Exception as error:
+        raise ValueError("couldn't unpickle (%s)" % error)
+    if type(payload) != dict:
+        raise ValueError("bad data section")
+    hints = []
+    for partition, names in payload.items():
+        if partition not in HINT_PARTITIONS:
+            logging.warning("Ignoring unknown partition '%s'", partition)
+            continue
+        if type(names) != list:
+            logging.warning("Ignoring value '%s': not a list", names)
+            continue
+        for name in names:
+            if type(name) == str:
+                hints.append((partition, name))
+            else:
+                logging.warning("Ignoring item '%s' in %s:%s: not a str",
+                                name, partition, names)
+    if not hints:
+        raise ValueError("no hints")
+    return hints
@@ -11,9 +11,15 @@ import os
 import logging
 import shutil
 import math
-from multiprocessing import Pool, cpu_count, Manager
+import time
+import pickle
+import hashlib
+import queue
+from collections import deque
+from multiprocessing import Pool, cpu_count
 
 import jens.git_wrapper as git
+import jens.git_pool as git_pool
 
 from jens.settings import Settings
 from jens.errors import JensRepositoriesError
@@ -23,9 +29,16 @@ from jens.decorators import timed
 from jens.messaging import enqueue_hint
 from jens.reposinventory import get_inventory, persist_inventory
 from jens.reposinventory import get_desired_inventory
-from jens.tools import ref_is_commit
+from jens.reposinventory import update_inventory, remove_from_inventory
+from jens.tools import ref_is_commit, split_refs
 from jens.tools import refname_to_dirname
 
+FETCH_DONE = 'done'
+FETCH_SKIPPED = 'skipped'
+
+JOB_CLONE = 'clone'
+JOB_REFRESH = 'refresh'
+
 @timed
 def refresh_repositories(hints=None):
     settings = Settings()
@@ -53,120 +66,211 @@ def refresh_repositories(hints=None):
         logging.debug("Existing repositories: %s", delta['existing'])
         logging.info("Deleted repositories: %s", delta['deleted'])
 
-        logging.info("Cloning and expanding NEW bare repositories...")
-        delta['new'] = _create_new_repositories(delta['new'], partition,
-                                                definition, inventory[partition],
-                                                desired[partition])
-
         # If hints are passed but there's nothing explicitly declared
         # for a given partition, we make it explicit here.
         if hints and partition not in hints:
             hints[partition] = set()
 
-        logging.info("Expanding EXISTING bare repositories...")
-        _refresh_repositories(delta['existing'], partition, inventory[partition],
-                              desired[partition], hints[partition] if hints else None)
+        deltas[partition] = delta
 
-        logging.info("Purging REMOVED bare repositories...")
-        _purge_repositories(delta['deleted'], partition,
-                            inventory[partition])
+    # All the partitions are cloned and refreshed together so the
+    # workers are kept busy until there's no work left at all.
+    logging.info("Cloning NEW and expanding EXISTING bare repositories...")
+    fetches = _refresh_repositories(deltas, definition, inventory,
+                                    desired, hints)
+    logging.info("Fetches: %d done, %d skipped as remote refs were unchanged",
+                 fetches.count(FETCH_DONE), fetches.count(FETCH_SKIPPED))
 
-        deltas[partition] = delta
+    for partition in ("modules", "hostgroups", "common"):
+        logging.info("Purging REMOVED bare repositories (%s)...", partition)
+        _purge_repositories(deltas[partition]['deleted'], partition,
+                            inventory)
+
+    _collect_store_garbage()
 
+    git_pool.release_all()
     persist_inventory(inventory)
     logging.debug("Final inventory: %s", inventory)
 
     return (deltas, inventory)
 
-def _create_new_repositories(new_repositories, partition,
-                             definition, inventory, desired):
-    settings = Settings()
-    created = []
-    for repository in new_repositories:
-        logging.info("Cloning and expanding %s/%s...", partition, repository)
-        bare_path = _compose_bare_repository_path(repository, partition)
-        bare_url = definition['repositories'][partition][repository]
-        try:
-            git.clone(bare_path, bare_url, bare=True)
-        except JensGitError as error:
-            logging.error("Unable to clone '%s' (%s). Skipping.",
-                          repository, error)
-            if os.path.exists(bare_path):
-                shutil.rmtree(bare_path)
-            continue
-        try:
-            refs = list(git.get_refs(bare_path).keys())
-        except JensGitError as error:
-            logging.error("Unable to get refs of '%s' (%s). Skipping.",
-                          repository, error)
-            shutil.rmtree(bare_path)
-            logging.debug("Bare repository %s has been removed", bare_path)
-            continue
-        # Check if the repository has the mandatory branches
-        if all([ref in refs for ref in settings.MANDATORY_BRANCHES]):
-            # Expand only the mandatory and available requested branches
-            # commits will always be attempted to be expanded
-            new = set(settings.MANDATORY_BRANCHES)
-            new = new.union([ref for ref in desired.get(repository, [])
-                             if ref_is_commit(ref) or ref in refs])
-            inventory[repository] = []
-            _expand_clones(partition, repository, inventory, None, new, [], [])
-            created.append(repository)
-        else:
-            logging.error("Repository '%s' lacks some of the mandatory branches. Skipping.",
-                          repository)
+def _create_new_repository(data):
+    settings = data['settings']
+    repository = data['repository']
+    partition = data['partition']
+    desired = data['desired']
+    logging.info("Cloning and expanding %s/%s...", partition, repository)
+    bare_path = _compose_bare_repository_path(repository, partition)
+    try:
+        git.clone(bare_path, data['url'], bare=True)
+    except JensGitError as error:
+        logging.error("Unable to clone '%s' (%s). Skipping.",
+                      repository, error)
+        if os.path.exists(bare_path):
             shutil.rmtree(bare_path)
-            logging.debug("Bare repository %s has been removed", bare_path)
-    return created
+        return (partition, repository, None)
+    try:
+        refs = git.get_refs(bare_path)
+    except JensGitError as error:
+        logging.error("Unable to get refs of '%s' (%s). Skipping.",
+                      repository, error)
+        shutil.rmtree(bare_path)
+        logging.debug("Bare repository %s has been removed", bare_path)
+        return (partition, repository, None)
+    # Check if the repository has the mandatory branches
+    if all([ref in refs for ref in settings.MANDATORY_BRANCHES]):
+        # Expand only the mandatory and available requested branches
+        # commits will always be attempted to be expanded
+        new = set(settings.MANDATORY_BRANCHES)
+        new = new.union([ref for ref in desired
+                         if ref_is_commit(ref) or ref in refs])
+        delta = _expand_clones(partition, repository, new, [], [])
+        return (partition, repository, delta)
+    logging.error("Repository '%s' lacks some of the mandatory branches. Skipping.",
+                  repository)
+    shutil.rmtree(bare_path)
+    logging.debug("Bare repository %s has been removed", bare_path)
+    return (partition, repository, None)
 
 # This is the most common operation Jens has to do, git-fetch
-# over all bare repos and the expansion of clones.
-def _refresh_repositories(existing_repositories, partition,
-                          inventory, desired, hints):
+# over all bare repos and the expansion of clones. New repositories
+# are cloned by the same workers.
+def _refresh_repositories(deltas, definition, inventory, desired, hints):
     settings = Settings()
-    if not existing_repositories:
-        return  # Seems that passing [] to pool.map makes .join never return
-    manager = Manager()
-    # The inventory is the only parameter that has to be r/w
-    # so we need a common object and a remote controller :)
-    inventory_proxy = manager.dict(inventory)
-    inventory_lock = manager.Lock()
-    data = [{'settings': settings, 'partition': partition,
-             'repository': repository, 'inventory': inventory_proxy,
-             'inventory_lock': inventory_lock, 'desired': desired,
-             'hints': hints} for repository in existing_repositories]
-    pool = Pool(processes=int(math.ceil(cpu_count()*1.5)))
-    pool.map(_refresh_repository, data)
-    pool.close()
-    pool.join()
-    inventory.update(inventory_proxy)
+    costs = _read_refresh_costs()
+    new = [(partition, repository)
+           for partition in ("modules", "hostgroups", "common")
+           for repository in deltas[partition]['new']]
+    existing = [(partition, repository)
+                for partition in ("modules", "hostgroups", "common")
+                for repository in deltas[partition]['existing']]
+    for partition in ("modules", "hostgroups", "common"):
+        deltas[partition]['new'] = []
+    if not new and not existing:
+        return []  # Seems that passing [] to pool.map makes .join never return
+    # Workers only get what they need to know about their repository
+    # and give back the changes to be applied to the inventory.
+    # Longest first, so the slow ones don't start when everything else
+    # is done. Clones and repositories never refreshed before go first.
+    jobs = [(float('inf'), JOB_CLONE, _create_new_repository,
+             {'settings': settings, 'partition': partition,
+              'repository': repository,
+              'url': definition['repositories'][partition][repository],
+              'desired': desired[partition].get(repository, [])})
+            for partition, repository in new]
+    jobs.extend((costs.get((partition, repository), float('inf')),
+                 JOB_REFRESH, _refresh_repository,
+                 {'settings': settings, 'partition': partition,
+                  'repository': repository,
+                  'refs': inventory[partition][repository],
+                  'desired': desired[partition].get(repository, []),
+                  'hints': hints[partition] if hints else None})
+                for partition, repository in existing)
+    jobs.sort(key=lambda job: (job[0], job[1] == JOB_CLONE), reverse=True)
+    # Children must not inherit the persistent Git processes
+    git_pool.release_all()
+    workers = _get_workers_count()
+    pool = Pool(processes=workers)
+    fetches = []
+    try:
+        for kind, result in _schedule_jobs(pool, jobs, workers,
+                                           settings.GIT_MAX_CONCURRENT_CLONES):
+            if kind == JOB_CLONE:
+                partition, repository, delta = result
+                if delta is not None:
+                    update_inventory(inventory, partition, repository, delta)
+                    deltas[partition]['new'].append(repository)
+                continue
+            partition, repository, fetch, delta, elapsed = result
+            update_inventory(inventory, partition, repository, delta)
+            fetches.append(fetch)
+            # What's expensive is fetching
+            if fetch == FETCH_DONE or (partition, repository) not in costs:
+                costs[(partition, repository)] = elapsed
+        pool.close()
+    finally:
+        # If a worker failed the jobs still running are killed
+        pool.terminate()
+        pool.join()
+        _write_refresh_costs(dict((job, costs[job]) for job in existing
+                                  if job in costs))
+    return fetches
+
+# Hands the jobs, given as (cost, kind, function, data) and sorted by
+# priority, to the pool and yields (kind, result) as they finish.
+# There's never more jobs in the pool than workers, otherwise the
+# order would be lost in the pool's queue, and cloning is the most
+# expensive thing that can be asked to the Git server, so no more
+# than max_clones clones are in flight. Meanwhile, the workers are
+# given the next refreshes.
+def _schedule_jobs(pool, jobs, workers, max_clones):
+    pending = {JOB_CLONE: deque(), JOB_REFRESH: deque()}
+    for job in jobs:
+        pending[job[1]].append(job)
+    finished = queue.Queue()
+    running = {JOB_CLONE: 0, JOB_REFRESH: 0}
+    while pending[JOB_CLONE] or pending[JOB_REFRESH] or \
+            sum(running.values()) > 0:
+        while sum(running.values()) < workers:
+            candidates = [kind for kind in (JOB_CLONE, JOB_REFRESH)
+                          if pending[kind]]
+            if running[JOB_CLONE] >= max_clones and JOB_CLONE in candidates:
+                candidates.remove(JOB_CLONE)
+            if not candidates:
+                break
+            kind = max(candidates, key=lambda kind: pending[kind][0][0])
+            _, _, function, data = pending[kind].popleft()
+            pool.apply_async(function, (data,),
+                callback=lambda result, kind=kind:
+                    finished.put((kind, result, None)),
+                error_callback=lambda error, kind=kind:
+                    finished.put((kind, None, error)))
+            running[kind] += 1
+        kind, result, error = finished.get()
+        running[kind] -= 1
+        if error is not None:
+            raise error
+        yield (kind, result)
 
 def _refresh_repository(data):
     settings = data['settings']
     repository = data['repository']
     partition = data['partition']
-    inventory = data['inventory']
-    inventory_lock = data['inventory_lock']
+    refs = data['refs']
     desired = data['desired']
     hints = data['hints']
+    start = time.time()
     logging.debug("Expanding bare and clones of %s/%s...",
                   partition, repository)
     bare_path = _compose_bare_repository_path(repository, partition)
+    fetch = None
+    delta = ([], [])
 
     try:
         old_refs = git.get_refs(bare_path)
     except JensGitError as error:
         logging.error("Unable to get old refs of '%s' (%s)",
                       repository, error)
-        return
+        return (partition, repository, fetch, delta, time.time() - start)
+
+    # If we know nothing we can still ask the remote before fetching
+    fingerprint = None
+    if hints is None and settings.GIT_REMOTE_FINGERPRINTS:
+        fingerprint = _get_remote_fingerprint(bare_path)
+        if fingerprint is not None and \
+                fingerprint == _read_remote_fingerprint(repository, partition):
+            logging.debug("Remote refs of %s/%s haven't changed, not fetching",
+                          partition, repository)
+            fetch = FETCH_SKIPPED
 
     # If we know nothing or we know that we have to fetch
-    if hints is None or repository in hints:
+    if fetch != FETCH_SKIPPED and (hints is None or repository in hints):
         try:
             if settings.MODE == "ONDEMAND":
                 logging.info("Fetching %s/%s upon demand...",
                              partition, repository)
             git.fetch(bare_path, prune=True)
+            fetch = FETCH_DONE
         except JensGitError as error:
             logging.error("Unable to fetch '%s' from remote (%s)",
                           repository, error)
@@ -175,7 +279,9 @@ def _refresh_repository(data):
                     enqueue_hint(partition, repository)
                 except JensMessagingError as error:
                     logging.error(error)
-            return
+            return (partition, repository, fetch, delta, time.time() - start)
+        if fingerprint is not None:
+            _write_remote_fingerprint(repository, partition, fingerprint)
     try:
         # TODO: Found a corner case where git fetch wiped all
         # all the branches in the bare repository. That led
@@ -187,25 +293,29 @@ def _refresh_repository(data):
         new_refs = git.get_refs(bare_path)
     except JensGitError as error:
         logging.error("Unable to get new refs of '%s' (%s)", repository, error)
-        return
-    new, moved, deleted = _compare_refs(old_refs, new_refs, inventory[repository],
-                                        desired.get(repository, []))
-    _expand_clones(partition, repository, inventory, inventory_lock,
-                   new, moved, deleted)
+        return (partition, repository, fetch, delta, time.time() - start)
+    new, moved, deleted = _compare_refs(old_refs, new_refs, refs, desired)
+    # Clones expanded before the clone mode was changed are rebuilt
+    # even if their refs haven't moved, so layouts don't get mixed
+    moved.extend(_get_clones_in_other_mode(partition, repository,
+        set(refs).difference(new, moved, deleted)))
+    delta = _expand_clones(partition, repository, new, moved, deleted)
+    return (partition, repository, fetch, delta, time.time() - start)
 
 def _purge_repositories(deleted_repositories, partition, inventory):
     for repository in deleted_repositories:
         logging.info("Deleting %s/%s...", partition, repository)
         bare_path = _compose_bare_repository_path(repository, partition)
         # Pass a copy as it will be used as interation set
-        refs = inventory[repository][:]
-        _expand_clones(partition, repository, inventory, None, [], [], refs)
+        refs = inventory[partition][repository][:]
+        _expand_clones(partition, repository, [], [], refs)
         clone_path = _compose_clone_repository_path(repository, partition)
         shutil.rmtree(clone_path)
         logging.debug("Clone repository parent %s has been removed", clone_path)
         shutil.rmtree(bare_path)
         logging.debug("Bare repository %s has been removed", bare_path)
-        inventory.pop(repository, None)
+        _remove_remote_fingerprint(repository, partition)
+        remove_from_inventory(inventory, partition, repository)
 
 # This function computes the list of refs to be expanded, refreshed or
 # removed based on what is available (new_refs), what was available
@@ -215,9 +325,9 @@ def _compare_refs(old_refs, new_refs, inventory, desired):
     settings = Settings()
     desired = set(desired).union(settings.MANDATORY_BRANCHES)
     # New: What we need minus what we have...
-    new = list(desired.difference(inventory))
+    branches, commits = split_refs(desired.difference(inventory))
     # ...but only refs that exist or commits
-    new = [ref for ref in new if ref_is_commit(ref) or ref in new_refs]
+    new = [ref for ref in branches if ref in new_refs] + commits
 
     # Deleted: what we have that we don't need anymore
     deleted = list(set(inventory).difference(desired))
@@ -230,10 +340,9 @@ def _compare_refs(old_refs, new_refs, inventory, desired):
 
     # Candidates are those that we already have and we still need
     moved = []
-    for ref in desired.intersection(inventory):
-        # No point in checking if a commit has moved
-        if ref_is_commit(ref):
-            continue
+    # No point in checking if a commit has moved
+    branches, _ = split_refs(desired.intersection(inventory))
+    for ref in branches:
         # If the ref is still being used (in the inventory and desired)
         # but has been removed from the repo we mark it as delete.
         # Next run will try to get it again and skip the expansion.
@@ -252,10 +361,13 @@ def _compare_refs(old_refs, new_refs, inventory, desired):
 
     return new, moved, deleted
 
-def _expand_clones(partition, name, inventory, inventory_lock, new_refs,
-                   moved_refs, deleted_refs):
+# Returns the refs that have to be added to and removed from the
+# inventory as (added, removed)
+def _expand_clones(partition, name, new_refs, moved_refs, deleted_refs):
     settings = Settings()
     bare_path = _compose_bare_repository_path(name, partition)
+    added, removed = [], []
+    recreated_worktrees = False
     if new_refs:
         logging.debug("Processing new refs of %s/%s (%s)...",
                       partition, name, new_refs)
@@ -263,25 +375,15 @@ def _expand_clones(partition, name, inventory, inventory_lock, new_refs,
         clone_path = _compose_clone_repository_path(name, partition, refname)
         logging.info("Populating new ref '%s'", clone_path)
         try:
-            if ref_is_commit(refname):
-                commit_id = refname.replace(settings.HASHPREFIX, '')
-                logging.debug("Will create a clone pointing to '%s'", commit_id)
-                git.clone(clone_path, "%s" % bare_path, shared=True)
-                git.reset(clone_path, commit_id, hard=True)
-            else:
-                git.clone(clone_path, "%s" % bare_path, branch=refname)
-            # Needs reset so the proxy notices about the change on the mutable
-            # http://docs.python.org/2.7/library/multiprocessing.html#managers
-            # Locking on the assignment is guarateed by the library, but
-            # additional locking is needed as A = A + 1 is a critical section.
-            if inventory_lock:
-                inventory_lock.acquire()
-            inventory[name] += [refname]
-            if inventory_lock:
-                inventory_lock.release()
-        except JensGitError as error:
-            if os.path.isdir(clone_path):
-                shutil.rmtree(clone_path)
+            # Left behind by a run that died or out of the inventory
+            # because it was broken
+            if os.path.lexists(clone_path):
+                logging.warning("Replacing untracked clone '%s'", clone_path)
+                _remove_clone(clone_path)
+            _populate_clone(bare_path, clone_path, refname)
+            added.append(refname)
+        except (JensGitError, OSError) as error:
+            _remove_clone(clone_path)
             logging.error("Unable to create clone '%s' (%s)",
                           clone_path, error)
 
@@ -291,17 +393,35 @@ def _expand_clones(partition, name, inventory, inventory_lock, new_refs,
     for refname in moved_refs:
         clone_path = _compose_clone_repository_path(name, partition, refname)
         logging.info("Updating ref '%s'", clone_path)
+        written = 'all'
         try:
-            # If this fails, the bare would have the correct HEADs
-            # but the clone will be out of date and won't ever be
-            # updated until a new commit arrives to the bare.
-            # Reason: a lock file left behind because Git was killed
-            # mid-flight.
-            git.fetch(clone_path)
-            git.reset(clone_path, "origin/%s" % refname, hard=True)
-            logging.info("Updated ref '%s' (%s)", clone_path,
-                         git.get_head(clone_path, short=True))
-        except JensGitError as error:
+            clone_mode = _get_clone_mode(clone_path)
+            if clone_mode != settings.CLONE_MODE:
+                logging.info("Recreating '%s' as the clone mode changed",
+                             clone_path)
+                recreated_worktrees |= clone_mode == 'WORKTREE'
+                _remove_clone(clone_path)
+                _populate_clone(bare_path, clone_path, refname)
+            elif settings.CLONE_MODE == 'STORE':
+                # The link is switched to the tree of the new commit in
+                # one go, so readers never see a half-updated tree.
+                _populate_clone(bare_path, clone_path, refname)
+            elif settings.CLONE_MODE == 'WORKTREE':
+                # The worktree shares the refs of the bare repository
+                # so there's nothing to fetch.
+                written = git.update_tree(clone_path,
+                                          "refs/heads/%s" % refname)
+            else:
+                # If this fails, the bare would have the correct HEADs
+                # but the clone will be out of date and won't ever be
+                # updated until a new commit arrives to the bare.
+                # Reason: a lock file left behind because Git was killed
+                # mid-flight.
+                git.fetch(clone_path)
+                written = git.update_tree(clone_path, "origin/%s" % refname)
+            logging.info("Updated ref '%s' (%s, %s files written)", clone_path,
+                         _get_clone_head(clone_path), written)
+        except (JensGitError, OSError) as error:
             logging.error("Unable to refresh clone '%s' (%s)",
                           clone_path, error)
 
@@ -312,25 +432,163 @@ def _expand_clones(partition, name, inventory, inventory_lock, new_refs,
         clone_path = _compose_clone_repository_path(name, partition, refname)
         logging.info("Removing %s", clone_path)
         try:
-            if os.path.isdir(clone_path):
-                shutil.rmtree(clone_path)
-            if refname in inventory[name]:
-                if inventory_lock:
-                    inventory_lock.acquire()
-                element = inventory[name]
-                element.remove(refname)
-                inventory[name] = element
-                if inventory_lock:
-                    inventory_lock.release()
-                logging.info("%s/%s deleted from inventory", name, refname)
+            _remove_clone(clone_path)
+            removed.append(refname)
         except OSError as error:
             logging.error("Couldn't delete %s/%s/%s (%s)",
                           partition, name, refname, error)
 
+    # The administrative files of the worktrees that have just been
+    # removed are left behind in the bare repository otherwise.
+    if (removed or recreated_worktrees) and \
+            os.path.isdir("%s/worktrees" % bare_path):
+        try:
+            git.prune_worktrees(bare_path)
+        except JensGitError as error:
+            logging.error("Unable to prune worktrees of %s/%s (%s)",
+                          partition, name, error)
+
+    return (added, removed)
+
+def _populate_clone(bare_path, clone_path, refname):
+    settings = Settings()
+    if settings.CLONE_MODE == 'STORE':
+        commit_id = _resolve_ref(bare_path, refname)
+        store_path = _materialize_tree(bare_path, commit_id)
+        _switch_link(clone_path, store_path)
+    elif ref_is_commit(refname):
+        commit_id = refname.replace(settings.HASHPREFIX, '')
+        logging.debug("Will create a clone pointing to '%s'", commit_id)
+        if settings.CLONE_MODE == 'WORKTREE':
+            git.add_worktree(bare_path, clone_path, commit_id)
+        else:
+            git.clone(clone_path, "%s" % bare_path, shared=True)
+            git.reset(clone_path, commit_id, hard=True)
+    elif settings.CLONE_MODE == 'WORKTREE':
+        git.add_worktree(bare_path, clone_path, "refs/heads/%s" % refname)
+    else:
+        git.clone(clone_path, "%s" % bare_path, branch=refname)
+
+# Worktrees have a '.git' file pointing to the bare repository
+# instead of a '.git' directory and checkouts kept in the store
+# are symlinks.
+def _get_clone_mode(clone_path):
+    if os.path.islink(clone_path):
+        return 'STORE'
+    if os.path.isfile("%s/.git" % clone_path):
+        return 'WORKTREE'
+    return 'CLONE'
+
+def _get_clones_in_other_mode(partition, name, refnames):
+    settings = Settings()
+    clones = []
+    for refname in refnames:
+        clone_path = _compose_clone_repository_path(name, partition, refname)
+        if os.path.lexists(clone_path) and \
+                _get_clone_mode(clone_path) != settings.CLONE_MODE:
+            clones.append(refname)
+    return clones
+
+def _get_clone_head(clone_path):
+    if os.path.islink(clone_path):
+        return os.path.basename(os.readlink(clone_path))[:7]
+    return git.get_head(clone_path, short=True)
+
+def _remove_clone(clone_path):
+    if os.path.islink(clone_path):
+        os.unlink(clone_path)
+    elif os.path.isdir(clone_path):
+        shutil.rmtree(clone_path)
+
+def _resolve_ref(bare_path, refname):
+    settings = Settings()
+    if ref_is_commit(refname):
+        commit_id = refname.replace(settings.HASHPREFIX, '')
+        return git.rev_parse(bare_path, "%s^{commit}" % commit_id)
+    refs = git.get_refs(bare_path)
+    if refname not in refs:
+        raise JensGitError("Ref '%s' not found in %s" % (refname, bare_path))
+    return refs[refname]
+
+# Checkouts in the store are keyed by commit so the same tree is
+# shared by all the refs (of any repository) pointing to it.
+def _materialize_tree(bare_path, commit_id):
+    store_path = _compose_store_path(commit_id)
+    if os.path.isdir(store_path):
+        return store_path
+    temporary_path = _compose_store_path(".tmp-%s-%d" %
+                                         (commit_id, os.getpid()))
+    os.makedirs(temporary_path)
+    try:
+        git.export_tree(bare_path, commit_id, temporary_path)
+        os.rename(temporary_path, store_path)
+    except OSError:
+        # Another worker might have just exported the same commit
+        if not os.path.isdir(store_path):
+            raise
+    finally:
+        if os.path.isdir(temporary_path):
+            shutil.rmtree(temporary_path)
+    return store_path
+
+def _switch_link(clone_path, store_path):
+    parent_path = os.path.dirname(clone_path)
+    if not os.path.isdir(parent_path):
+        os.makedirs(parent_path)
+    temporary_path = _compose_store_path(".tmp-link-%d" % os.getpid())
+    os.symlink(os.path.relpath(store_path, parent_path), temporary_path)
+    try:
+        # rename(2) replaces the destination atomically
+        os.rename(temporary_path, clone_path)
+    except OSError:
+        os.unlink(temporary_path)
+        raise
+
+# Trees not referenced by any clone anymore are moved to the
+# trash and deleted in the next run, so readers that still have
+# them open get some time to finish.
+def _collect_store_garbage():
+    store_path = _compose_store_path()
+    if not os.path.isdir(store_path):
+        return
+    logging.info("Collecting garbage in the store...")
+    settings = Settings()
+    referenced = set()
+    for partition in ("modules", "hostgroups", "common"):
+        partition_path = settings.CLONEDIR + "/%s" % partition
+        for name in os.listdir(partition_path):
+            clones_path = "%s/%s" % (partition_path, name)
+            for dirname in os.listdir(clones_path):
+                clone_path = "%s/%s" % (clones_path, dirname)
+                if os.path.islink(clone_path):
+                    referenced.add(os.path.basename(os.readlink(clone_path)))
+    trash_path = _compose_store_path(".trash")
+    if os.path.isdir(trash_path):
+        shutil.rmtree(trash_path)
+    trashed = 0
+    for entry in os.listdir(store_path):
+        entry_path = "%s/%s" % (store_path, entry)
+        if entry.startswith(".tmp-"):
+            _remove_clone(entry_path)
+        elif entry not in referenced:
+            if not os.path.isdir(trash_path):
+                os.mkdir(trash_path)
+            os.rename(entry_path, "%s/%s" % (trash_path, entry))
+            trashed += 1
+    logging.info("Store: %d trees referenced, %d unreferenced trees trashed",
+                 len(referenced), trashed)
+
 def _compose_bare_repository_path(name, partition):
     settings = Settings()
     return settings.BAREDIR + "/%s/%s" % (partition, name)
 
+def _compose_store_path(entry=None):
+    settings = Settings()
+    path = settings.CLONEDIR + "/.store"
+    if entry is not None:
+        path = "%s/%s" % (path, entry)
+    return path
+
 def _compose_clone_repository_path(name, partition, refname=None):
     settings = Settings()
     path = settings.CLONEDIR + "/%s/%s" % (partition, name)
@@ -339,6 +597,68 @@ def _compose_clone_repository_path(name, partition, refname=None):
         path = "%s/%s" % (path, dirname)
     return path
 
+# The fingerprint of the refs advertised by the remote is saved after
+# every successful fetch so the next fetch can be skipped if nothing
+# has moved upstream, which is much cheaper than fetching.
+def _get_remote_fingerprint(bare_path):
+    try:
+        refs = git.ls_remote(bare_path)
+    except JensGitError as error:
+        logging.debug("Unable to list remote refs of %s (%s)",
+                      bare_path, error)
+        return None
+    fingerprint = hashlib.sha1()
+    for refname in sorted(refs.keys()):
+        fingerprint.update(("%s %s\n" % (refs[refname], refname)).encode())
+    return fingerprint.hexdigest()
+
+def _compose_remote_fingerprint_path(name, partition):
+    settings = Settings()
+    return settings.CACHEDIR + "/fingerprints/%s/%s" % (partition, name)
+
+def _read_remote_fingerprint(name, partition):
+    try:
+        with open(_compose_remote_fingerprint_path(name, partition), 'r') \
+                as fingerprint_file:
+            return fingerprint_file.read()
+    except IOError:
+        return None
+
+def _write_remote_fingerprint(name, partition, fingerprint):
+    path = _compose_remote_fingerprint_path(name, partition)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fingerprint_file:
+            fingerprint_file.write(fingerprint)
+    except (IOError, OSError) as error:
+        logging.warning("Unable to save fingerprint of %s/%s (%s)",
+                        partition, name, error)
+
+def _remove_remote_fingerprint(name, partition):
+    path = _compose_remote_fingerprint_path(name, partition)
+    if os.path.exists(path):
+        os.remove(path)
+
+def _get_workers_count():
+    return int(math.ceil(cpu_count()*1.5))
+
+def _read_refresh_costs():
+    settings = Settings()
+    try:
+        with open(settings.CACHEDIR + "/refresh_costs", "rb") as costs_file:
+            return pickle.load(costs_file)
+    except (IOError, pickle.PickleError, EOFError):
+        logging.debug("No refresh costs found, refreshing in any order")
+        return {}
+
+def _write_refresh_costs(costs):
+    settings = Settings()
+    try:
+        with open(settings.CACHEDIR + "/refresh_costs", "wb") as costs_file:
+            pickle.dump(costs, costs_file)
+    except (IOError, pickle.PickleError) as error:
+        logging.warning("Unable to save refresh costs (%s)", error)
+
 def _calculate_delta(definition, current):
     definition = set(definition.keys())
     current = set(current.keys())
@@ -7,104 +7,357 @@
 
 from __future__ import absolute_import
 import os
+import json
 import logging
 import pickle
+from multiprocessing.pool import ThreadPool
 
 from jens.settings import Settings
 from jens.errors import JensRepositoriesError
 from jens.errors import JensEnvironmentsError
+from jens.errors import JensGitError
+from jens.git_wrapper import get_refs, read_head
 from jens.environments import read_environment_definition
 from jens.environments import get_names_of_declared_environments
+from jens.environments import get_environment_definition_hashes
 from jens.tools import ref_is_commit
-from jens.tools import dirname_to_refname
+from jens.tools import dirnames_to_refnames
+
+# The inventory is kept on disk as a snapshot plus a journal. Every
+# change is appended to the journal as soon as it's known, so if a run
+# dies halfway what was done until then isn't lost. The journal is
+# replayed on top of the snapshot when the inventory is loaded and it's
+# folded into a new snapshot when the inventory is persisted.
+INVENTORY_FORMAT_VERSION = 2
+
+# Regenerating the inventory is mostly waiting for the filesystem
+# (which might be a network one) so it's done by a bunch of threads
+INVENTORY_THREADS = 16
 
 def get_inventory():
     logging.info("Fetching repositories inventory...")
     try:
-        return _read_inventory_from_disk()
-    except (IOError, pickle.PickleError):
+        inventory = _read_inventory_from_disk()
+    except (IOError, EOFError, pickle.PickleError, JensRepositoriesError) as error:
         logging.warning("Inventory on disk not found or corrupt, generating...")
+        logging.debug("Unable to read inventory (%s)", error)
+        # What's on disk already reflects whatever was journaled
+        _remove_journal()
         return _generate_inventory()
+    _replay_journal(inventory)
+    return inventory
 
 def persist_inventory(inventory):
     logging.info("Persisting repositories inventory...")
     _write_inventory_to_disk(inventory)
+    _remove_journal()
 
 def get_desired_inventory():
     return _read_desired_inventory()
 
+# Changes to the inventory must be done via these two functions so they
+# are journaled before being applied.
+def update_inventory(inventory, partition, name, delta):
+    added, removed = delta
+    if not added and not removed and name in inventory[partition]:
+        return
+    _append_to_journal({'partition': partition, 'name': name,
+                        'added': list(added), 'removed': list(removed)})
+    _apply_delta(inventory, partition, name, added, removed)
+
+def remove_from_inventory(inventory, partition, name):
+    _append_to_journal({'partition': partition, 'name': name,
+                        'deleted': True})
+    inventory[partition].pop(name, None)
+
+def _apply_delta(inventory, partition, name, added, removed):
+    refs = inventory[partition].setdefault(name, [])
+    for refname in removed:
+        if refname in refs:
+            refs.remove(refname)
+            logging.info("%s/%s deleted from inventory", name, refname)
+    refs.extend(refname for refname in added if refname not in refs)
+
 def _read_inventory_from_disk():
     settings = Settings()
     with open(settings.CACHEDIR + "/repositories", "rb") as inventory_file:
-        return pickle.load(inventory_file)
+        snapshot = pickle.load(inventory_file)
+    if 'version' not in snapshot:
+        # Written by an older version, just the inventory
+        return snapshot
+    if snapshot['version'] != INVENTORY_FORMAT_VERSION:
+        raise JensRepositoriesError("Unknown inventory format version %s" %
+                                    snapshot['version'])
+    return snapshot['inventory']
 
+# The snapshot is replaced atomically, either the old one or the new
+# one is found by the next run.
 def _write_inventory_to_disk(inventory):
     settings = Settings()
     inventory_file_path = settings.CACHEDIR + "/repositories"
+    temporary_path = "%s.tmp" % inventory_file_path
+    logging.debug("Writing inventory to %s", inventory_file_path)
+    snapshot = {'version': INVENTORY_FORMAT_VERSION, 'inventory': inventory}
     try:
-        inventory_file = open(inventory_file_path, "wb")
-    except IOError as error:
+        with open(temporary_path, "wb") as inventory_file:
+            pickle.dump(snapshot, inventory_file, pickle.HIGHEST_PROTOCOL)
+            inventory_file.flush()
+            os.fsync(inventory_file.fileno())
+        os.rename(temporary_path, inventory_file_path)
+    except (IOError, OSError, pickle.PickleError) as error:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
         raise JensRepositoriesError("Unable to write inventory to disk (%s)" %
                                     error)
-    logging.debug("Writing inventory to %s", inventory_file_path)
+
+def _append_to_journal(entry):
+    settings = Settings()
+    # One line per change, written in one go
+    line = "%s\n" % json.dumps(entry, sort_keys=True)
     try:
-        pickle.dump(inventory, inventory_file)
-    except pickle.PickleError as error:
-        raise JensRepositoriesError("Unable to write inventory to disk (%s)" %
+        with open(settings.CACHEDIR + "/repositories.journal", "a") as journal:
+            journal.write(line)
+    except IOError as error:
+        raise JensRepositoriesError("Unable to write to inventory journal (%s)" %
                                     error)
-    finally:
-        inventory_file.close()
+
+def _replay_journal(inventory):
+    settings = Settings()
+    try:
+        journal = open(settings.CACHEDIR + "/repositories.journal")
+    except IOError:
+        return
+    replayed = 0
+    with journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The run writing it died in the middle of a line
+                logging.warning("Ignoring truncated inventory journal entry")
+                break
+            partition, name = entry['partition'], entry['name']
+            if entry.get('deleted', False):
+                inventory[partition].pop(name, None)
+            else:
+                _apply_delta(inventory, partition, name,
+                             entry['added'], entry['removed'])
+            replayed += 1
+    if replayed:
+        logging.info("Replayed %d changes from the inventory journal", replayed)
+
+def _remove_journal():
+    settings = Settings()
+    journal_path = settings.CACHEDIR + "/repositories.journal"
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
 
 def _generate_inventory():
     settings = Settings()
     logging.info("Generating inventory of bares and clones...")
     inventory = {}
+    jobs = []
     for partition in ("modules", "hostgroups", "common"):
         inventory[partition] = {}
         baredir = settings.BAREDIR + "/%s" % partition
         try:
-            names = os.listdir(baredir)
+            names = [entry.name for entry in os.scandir(baredir)
+                     if entry.is_dir()]
         except OSError as error:
             raise JensRepositoriesError("Unable to list %s (%s)" %
                                         (baredir, error))
-        for name in names:
-            inventory[partition][name] = \
-                _read_list_of_clones(partition, name)
+        jobs.extend((partition, name) for name in names)
+    if not jobs:
+        return inventory
+    pool = ThreadPool(processes=min(INVENTORY_THREADS, len(jobs)))
+    try:
+        clones = pool.map(_read_list_of_clones_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    for (partition, name), refs in zip(jobs, clones):
+        if refs is None:
+            # The Repo objects kept by git_pool can't be shared between
+            # threads, so whatever needs Git is read from here instead.
+            refs = _read_list_of_clones(partition, name)
+        inventory[partition][name] = refs
     return inventory
 
-def _read_list_of_clones(partition, name):
+class _GitNeeded(Exception):
+    pass
+
+def _read_list_of_clones_job(job):
+    try:
+        return _read_list_of_clones(*job, fallback=False)
+    except _GitNeeded:
+        return None
+
+# Clones whose HEAD can't be read or isn't where the bare repository
+# says it should be are left out, so they're expanded again if they
+# are still needed.
+def _read_list_of_clones(partition, name, fallback=True):
     settings = Settings()
+    clones_path = settings.CLONEDIR + "/%s/%s" % (partition, name)
     try:
-        clones = os.listdir(settings.CLONEDIR + "/%s/%s" %
-                            (partition, name))
+        entries = list(os.scandir(clones_path))
     except OSError as error:
         raise JensRepositoriesError("Unable to list clones of %s/%s (%s)" %
                                     (partition, name, error))
-    return [dirname_to_refname(clone) for clone in clones]
+    try:
+        bare_refs = get_refs(settings.BAREDIR + "/%s/%s" % (partition, name),
+                             fallback=fallback)
+        if bare_refs is None:
+            raise _GitNeeded()
+    except JensGitError as error:
+        logging.warning("Unable to read refs of %s/%s, its clones won't be "
+                        "checked (%s)", partition, name, error)
+        bare_refs = None
+    clones = []
+    refnames = dirnames_to_refnames(entry.name for entry in entries)
+    for entry, refname in zip(entries, refnames):
+        if bare_refs is not None:
+            problem = _check_clone(entry, refname, bare_refs, fallback)
+            if problem is not None:
+                logging.warning("Clone %s/%s/%s is broken (%s), leaving it "
+                                "out of the inventory", partition, name,
+                                entry.name, problem)
+                continue
+        clones.append(refname)
+    return clones
+
+def _check_clone(entry, refname, bare_refs, fallback=True):
+    settings = Settings()
+    if ref_is_commit(refname):
+        expected = refname.replace(settings.HASHPREFIX, '').lower()
+    elif refname in bare_refs:
+        expected = bare_refs[refname]
+    else:
+        # The branch is gone, the refresh will get rid of the clone
+        return None
+    try:
+        if entry.is_symlink():
+            # Checkouts in the store are named after their commit
+            head = os.path.basename(os.readlink(entry.path))
+        else:
+            head = read_head(entry.path, fallback=fallback)
+            if head is None:
+                raise _GitNeeded()
+    except (JensGitError, OSError) as error:
+        return str(error)
+    if not head.startswith(expected):
+        return "HEAD at %s, expected %s" % (head, expected)
+    return None
+
+# This is basically the 'look-ahead' bit. What every environment asks
+# for is kept on disk along with the blob hash of its definition, so
+# only the definitions that changed since the last run are read. The
+# overrides are counted, so the ones no environment asks for anymore
+# can be dropped without going through all the environments again.
+DESIRED_INVENTORY_FORMAT_VERSION = 2
 
-# This is basically the 'look-ahead' bit
 def _read_desired_inventory():
-    desired = {'modules': {}, 'hostgroups': {}, 'common': {}}
     environments = get_names_of_declared_environments()
-    for environmentname in environments:
+    try:
+        hashes = get_environment_definition_hashes(environments)
+    except JensGitError as error:
+        logging.warning("Unable to hash the environment definitions, "
+                        "reading all of them (%s)", error)
+        hashes = {}
+    state = _read_desired_state()
+    contributions, counts = state['environments'], state['desired']
+
+    declared = set(environments)
+    forgotten = 0
+    for environment in list(contributions.keys()):
+        hash_value, contribution = contributions[environment]
+        if environment in declared and hash_value is not None and \
+                hash_value == hashes.get(environment):
+            continue
+        _count_desired_contribution(counts, pickle.loads(contribution), -1)
+        del contributions[environment]
+        forgotten += 1
+
+    read = 0
+    for environment in environments:
+        if environment in contributions:
+            continue
         try:
-            environment = read_environment_definition(environmentname)
-            if 'overrides' in environment:
-                for partition in environment['overrides'].keys():
-                    if partition in ("modules", "hostgroups", "common"):
-                        for name, override in \
-                                environment['overrides'][partition].items():
-                            # prefixhash is equivalent to PREFIXhash, contrary to
-                            # refs (branches, sic) which as case-sensitiive
-                            if ref_is_commit(override):
-                                override = override.lower()
-                            if name not in desired[partition]:
-                                desired[partition][name] = [override]
-                            else:
-                                if override not in desired[partition][name]:
-                                    desired[partition][name].append(override)
+            definition = read_environment_definition(environment)
         except JensEnvironmentsError as error:
             logging.error("Unable to process '%s' definition (%s). Skipping",
-                          environmentname, error)
+                          environment, error)
             continue  # Just ignore, as won't be generated later on either.
-    return desired
+        contribution = _get_desired_contribution(definition)
+        _count_desired_contribution(counts, contribution, 1)
+        # Kept serialised, as it's only needed again if the definition
+        # changes and loading thousands of small objects is slow. Pickled,
+        # so names that YAML didn't read as strings come back unchanged.
+        contributions[environment] = (hashes.get(environment),
+            pickle.dumps(contribution, pickle.HIGHEST_PROTOCOL))
+        read += 1
+    logging.debug("Desired inventory updated from %d definitions "
+                  "(%d forgotten)", read, forgotten)
+
+    # Without the hashes the next run couldn't tell what changed
+    if (read or forgotten) and len(hashes) == len(environments):
+        _write_desired_state(state)
+    return dict((partition, dict((name, set(overrides))
+                                 for name, overrides in elements.items()))
+                for partition, elements in counts.items())
+
+def _get_desired_contribution(definition):
+    contribution = {}
+    overrides = definition.get('overrides') or {}
+    for partition in ("modules", "hostgroups", "common"):
+        for name, override in (overrides.get(partition) or {}).items():
+            # prefixhash is equivalent to PREFIXhash, contrary to
+            # refs (branches, sic) which as case-sensitiive
+            if ref_is_commit(override):
+                override = override.lower()
+            wanted = contribution.setdefault(partition, {}).setdefault(name, [])
+            if override not in wanted:
+                wanted.append(override)
+    return contribution
+
+def _count_desired_contribution(counts, contribution, increment):
+    for partition, elements in contribution.items():
+        for name, overrides in elements.items():
+            element_counts = counts[partition].setdefault(name, {})
+            for override in overrides:
+                count = element_counts.get(override, 0) + increment
+                if count > 0:
+                    element_counts[override] = count
+                else:
+                    element_counts.pop(override, None)
+            if not element_counts:
+                del counts[partition][name]
+
+def _read_desired_state():
+    settings = Settings()
+    try:
+        with open(settings.CACHEDIR + "/desired_inventory", "rb") as state_file:
+            state = pickle.load(state_file)
+        if state.get('version') == DESIRED_INVENTORY_FORMAT_VERSION:
+            return state
+        logging.info("Unknown desired inventory format, regenerating...")
+    except (IOError, EOFError, pickle.PickleError) as error:
+        logging.info("Desired inventory not found or corrupt, "
+                     "regenerating... (%s)", error)
+    return {'version': DESIRED_INVENTORY_FORMAT_VERSION,
+            'environments': {},
+            'desired': {'modules': {}, 'hostgroups': {}, 'common': {}}}
+
+def _write_desired_state(state):
+    settings = Settings()
+    state_file_path = settings.CACHEDIR + "/desired_inventory"
+    temporary_path = "%s.tmp" % state_file_path
+    try:
+        with open(temporary_path, "wb") as state_file:
+            pickle.dump(state, state_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_path, state_file_path)
+    except (IOError, OSError, pickle.PickleError) as error:
+        # It will be generated again in the next run
+        logging.error("Unable to write desired inventory (%s)", error)
+        for path in (temporary_path, state_file_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -60,7 +60,10 @@ class Settings(object):
         self.HASHPREFIX = config["main"]["hashprefix"]
         self.DIRECTORY_ENVIRONMENTS = config["main"]["directory_environments"]
         self.COMMON_HIERADATA_ITEMS = config["main"]["common_hieradata_items"]
+        self.ENVIRONMENTS_WORKERS = config["main"]["environments_workers"]
+        self.ATOMIC_ENVIRONMENTS = config["main"]["atomic_environments"]
         self.MODE = config["main"]["mode"]
+        self.CLONE_MODE = config["main"]["clonemode"]
         self.PROTECTED_ENVIRONMENTS = config["main"]["protectedenvironments"]
 
         # [lock]
@@ -72,9 +75,15 @@ class Settings(object):
 
         # [messaging]
         self.MESSAGING_QUEUEDIR = config["messaging"]["queuedir"]
+        self.MESSAGING_PENDINGDIR = config["messaging"]["pendingdir"]
+        self.MESSAGING_ACCEPT_PICKLED_HINTS = \
+            config["messaging"]["accept_pickled_hints"]
 
         # [git]
         self.SSH_CMD_PATH = config["git"]["ssh_cmd_path"]
+        self.GIT_POOL_SIZE = config["git"]["pool_size"]
+        self.GIT_REMOTE_FINGERPRINTS = config["git"]["remote_fingerprints"]
+        self.GIT_MAX_CONCURRENT_CLONES = config["git"]["max_concurrent_clones"]
 
         # [gitlabproducer]
         self.GITLAB_PRODUCER_SECRET_TOKEN = config["gitlabproducer"]["secret_token"]
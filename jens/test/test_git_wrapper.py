@@ -7,11 +7,15 @@
 
 from __future__ import absolute_import
 import os
+import gc
+import shutil
 import jens.git_wrapper as git_wrapper
+import jens.git_pool as git_pool
 from unittest.mock import patch
 from jens.test.testcases import JensTestCase
 from jens.errors import JensGitError
 from jens.test.tools import *
+from jens.test.tools import _git
 
 
 class GitWrapperTest(JensTestCase):
@@ -22,6 +26,17 @@ class GitWrapperTest(JensTestCase):
         self.assertRaises(JensGitError, git_wrapper.hash_object,
                           'platform-9-and-0.75')
 
+    def test_hash_object_matches_git(self):
+        contents = [b"", b"notifications: admins@example.org\n",
+                    "default: master # \u00e9\n".encode('utf-8'),
+                    bytes(range(256)) * 64]
+        for index, content in enumerate(contents):
+            path = "%s/%d.yaml" % (self.sandbox_path, index)
+            with open(path, 'wb') as blob:
+                blob.write(content)
+            (out, _) = _git(["hash-object", path])
+            self.assertEqual(git_wrapper.hash_object(path), out.strip().decode())
+
     def test_gc_existing_repository(self):
         (bare, user) = create_fake_repository(self.sandbox_path,
                                               ['qa'])
@@ -137,6 +152,54 @@ class GitWrapperTest(JensTestCase):
         self.assertFalse(os.path.isfile("%s/%s" %
             (jens_clone, fname)))
 
+    def test_update_tree_only_writes_changed_paths(self):
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        jens_bare = "%s/_bare" % self.settings.BAREDIR
+        git_wrapper.clone(jens_bare, bare, bare=True)
+        jens_clone = "%s/_clone" % self.settings.CLONEDIR
+        git_wrapper.clone(jens_clone, jens_bare, bare=False, branch='qa')
+        self.assertEqual(git_wrapper.update_tree(jens_clone, 'origin/qa'), 0)
+        add_commit_to_branch(user, 'qa', fname='unchanged')
+        git_wrapper.fetch(jens_bare)
+        git_wrapper.fetch(jens_clone)
+        git_wrapper.update_tree(jens_clone, 'origin/qa')
+        unchanged = os.stat("%s/unchanged" % jens_clone)
+        add_commit_to_branch(user, 'qa', fname='first')
+        commit_id = add_commit_to_branch(user, 'qa', fname='second')
+        git_wrapper.fetch(jens_bare)
+        git_wrapper.fetch(jens_clone)
+        self.assertEqual(git_wrapper.update_tree(jens_clone, 'origin/qa'), 2)
+        self.assertEqual(get_repository_head(jens_clone), commit_id)
+        self.assertEqual(git_wrapper.get_refs(jens_clone)['qa'], commit_id)
+        self.assertTrue(os.path.isfile("%s/first" % jens_clone))
+        self.assertTrue(os.path.isfile("%s/second" % jens_clone))
+        self.assertEqual(os.stat("%s/unchanged" % jens_clone).st_ino,
+                         unchanged.st_ino)
+        commit_id = add_commit_to_branch(user, 'qa', fname='first', remove=True)
+        git_wrapper.fetch(jens_bare)
+        git_wrapper.fetch(jens_clone)
+        self.assertEqual(git_wrapper.update_tree(jens_clone, 'origin/qa'), 1)
+        self.assertFalse(os.path.exists("%s/first" % jens_clone))
+        self.assertEqual(get_repository_head(jens_clone), commit_id)
+
+    def test_update_tree_falls_back_to_reset(self):
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        jens_clone = "%s/_clone" % self.settings.CLONEDIR
+        git_wrapper.clone(jens_clone, bare, bare=False, branch='qa')
+        commit_id = add_commit_to_branch(user, 'qa', fname='clash')
+        git_wrapper.fetch(jens_clone)
+        with open("%s/clash" % jens_clone, 'w') as clash:
+            clash.write("local")
+        self.assertEqual(git_wrapper.update_tree(jens_clone, 'origin/qa'), 1)
+        self.assertEqual(get_repository_head(jens_clone), commit_id)
+        with open("%s/clash" % jens_clone) as clash:
+            self.assertEqual(clash.read(), "foo")
+
+    def test_update_tree_not_repository(self):
+        not_repo_path = create_folder_not_repository(self.sandbox_path)
+        self.assertRaises(JensGitError, git_wrapper.update_tree,
+                          not_repo_path, "37d8s8e3")
+
     def test_reset_not_repository(self):
         not_repo_path = create_folder_not_repository(self.sandbox_path)
         self.assertRaises(JensGitError, git_wrapper.reset, not_repo_path,
@@ -176,3 +239,139 @@ class GitWrapperTest(JensTestCase):
     def test_get_head_not_repository(self):
         not_repo_path = create_folder_not_repository(self.sandbox_path)
         self.assertRaises(JensGitError, git_wrapper.get_head, not_repo_path)
+
+    def test_has_local_changes(self):
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        jens_clone = "%s/_clone" % self.settings.CLONEDIR
+        git_wrapper.clone(jens_clone, bare, bare=False)
+        self.assertFalse(git_wrapper.has_local_changes(jens_clone, "*.yaml"))
+        with open("%s/other.txt" % jens_clone, "w") as other:
+            other.write("not a definition")
+        self.assertFalse(git_wrapper.has_local_changes(jens_clone, "*.yaml"))
+        with open("%s/new.yaml" % jens_clone, "w") as new:
+            new.write("default: master")
+        self.assertTrue(git_wrapper.has_local_changes(jens_clone, "*.yaml"))
+
+    def test_has_local_changes_not_repository(self):
+        not_repo_path = create_folder_not_repository(self.sandbox_path)
+        self.assertRaises(JensGitError, git_wrapper.has_local_changes,
+                          not_repo_path, "*.yaml")
+
+    def test_read_head_matches_get_head(self):
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        jens_clone = "%s/_clone" % self.settings.CLONEDIR
+        git_wrapper.clone(jens_clone, bare, bare=False, branch='qa')
+        self.assertEqual(git_wrapper.read_head(jens_clone),
+                         git_wrapper.get_head(jens_clone))
+        _git(["pack-refs", "--all"], gitdir="%s/.git" % jens_clone)
+        self.assertEqual(git_wrapper.read_head(jens_clone),
+                         git_wrapper.get_head(jens_clone))
+        jens_worktree = "%s/_worktree" % self.settings.CLONEDIR
+        git_wrapper.add_worktree(bare, jens_worktree, "refs/heads/qa")
+        self.assertEqual(git_wrapper.read_head(jens_worktree),
+                         git_wrapper.get_head(jens_clone))
+
+    def test_read_head_broken_repository(self):
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        jens_clone = "%s/_clone" % self.settings.CLONEDIR
+        git_wrapper.clone(jens_clone, bare, bare=False, branch='qa')
+        with open("%s/.git/HEAD" % jens_clone, "w") as head:
+            head.write("ref: refs/heads/lost\n")
+        self.assertRaises(JensGitError, git_wrapper.read_head, jens_clone)
+        not_repo_path = create_folder_not_repository(self.sandbox_path)
+        self.assertRaises(JensGitError, git_wrapper.read_head, not_repo_path)
+
+    def test_pool_reuses_repositories(self):
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        self.assertTrue(git_pool.get_repository(bare) is
+                        git_pool.get_repository(bare))
+
+    def test_pool_disabled(self):
+        self.settings.GIT_POOL_SIZE = 0
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        self.assertFalse(git_pool.get_repository(bare) is
+                         git_pool.get_repository(bare))
+
+    def test_pool_is_bounded(self):
+        self.settings.GIT_POOL_SIZE = 1
+        (bare1, user1) = create_fake_repository(self.sandbox_path, ['qa'])
+        (bare2, user2) = create_fake_repository(self.sandbox_path, ['qa'])
+        repo = git_pool.get_repository(bare1)
+        git_pool.get_repository(bare2)
+        self.assertFalse(git_pool.get_repository(bare1) is repo)
+
+    def test_pool_notices_recreated_repositories(self):
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa', 'foo'])
+        jens_clone = "%s/_clone" % self.settings.CLONEDIR
+        git_wrapper.clone(jens_clone, bare, branch='qa')
+        qa_head = git_wrapper.get_head(jens_clone)
+        shutil.rmtree(jens_clone)
+        commit_id = add_commit_to_branch(user, 'foo')
+        git_wrapper.clone(jens_clone, bare, branch='foo')
+        self.assertEqual(git_wrapper.get_head(jens_clone), commit_id)
+        self.assertNotEqual(qa_head, commit_id)
+
+    def test_pool_forked_children_leave_parent_processes_alone(self):
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        repo = git_pool.get_repository(bare)
+        head = git_wrapper.get_head(bare)
+        repo.odb.info(bytes.fromhex(head))
+        process = repo.git.cat_file_header.proc
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                # The inherited object is forgotten and can be finalised
+                fresh = git_pool.get_repository(bare)
+                if fresh is not repo and len(git_pool._pool) == 1 and \
+                        repo.git.cat_file_header is None:
+                    del repo
+                    gc.collect()
+                    status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        self.assertTrue(process.poll() is None)
+        self.assertTrue(repo.git.cat_file_header.proc is process)
+        self.assertEqual(repo.odb.info(bytes.fromhex(head)).hexsha.decode(),
+                         head)
+
+
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        repo = git_pool.get_repository(user)
+        self.assertRaises(JensGitError, git_wrapper.reset, user, "37d8s8e4")
+        self.assertFalse(git_pool.get_repository(user) is repo)
+
+    def test_get_refs_packed_and_loose(self):
+        (bare, user) = create_fake_repository(self.sandbox_path,
+                                              ['qa', 'feature/foo'])
+        jens_bare = "%s/_bare" % self.settings.BAREDIR
+        git_wrapper.clone(jens_bare, bare, bare=True)
+        packed = git_wrapper.get_refs(jens_bare)
+        self.assertEqual(set(packed.keys()),
+                         set(['master', 'qa', 'feature/foo']))
+        commit_id = add_commit_to_branch(user, 'qa')
+        git_wrapper.fetch(jens_bare)
+        refs = git_wrapper.get_refs(jens_bare)
+        self.assertEqual(refs['qa'], commit_id)
+        self.assertEqual(refs['master'], packed['master'])
+        self.assertEqual(refs['feature/foo'], packed['feature/foo'])
+
+    def test_get_refs_same_as_for_each_ref(self):
+        (bare, user) = create_fake_repository(self.sandbox_path,
+                                              ['qa', 'feature/foo'])
+        add_commit_to_branch(user, 'qa')
+        output, _ = _git(["for-each-ref", "refs/heads",
+                          "--format=%(refname:strip=2) %(objectname)"],
+                         gitdir=bare)
+        expected = dict(line.split(" ") for line in
+                        output.decode().splitlines())
+        self.assertEqual(git_wrapper.get_refs(bare), expected)
+
+    def test_get_refs_symbolic_ref_falls_back_to_git(self):
+        (bare, user) = create_fake_repository(self.sandbox_path, ['qa'])
+        _git(["symbolic-ref", "refs/heads/alias", "refs/heads/qa"],
+             gitdir=bare)
+        refs = git_wrapper.get_refs(bare)
+        self.assertEqual(refs['alias'], refs['qa'])
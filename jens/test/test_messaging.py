@@ -7,25 +7,29 @@
 
 from __future__ import absolute_import
 import os
+import time
+import pickle
 
 from datetime import datetime
 
-from dirq.queue import Queue, QueueLockError
+from dirq.queue import Queue
 from dirq.queue import QueueError
 
-from jens.messaging import _validate_and_merge_messages, _fetch_all_messages
+from jens.messaging import _validate_and_merge_messages
+from jens.messaging import _iterate_messages, _remove_elements
+from jens.messaging import _encode_hint, _decode_hints
 from jens.messaging import fetch_update_hints, count_pending_hints
 from jens.messaging import enqueue_hint, purge_queue
+from jens.messaging import count_pending_repositories
+from jens.messaging import MSG_SCHEMA, STALE_LOCK_AGE
 from jens.errors import JensMessagingError
-from jens.test.tools import init_repositories
-from jens.test.tools import add_repository, del_repository
 from jens.test.tools import add_msg_to_queue
 from jens.test.tools import create_hostgroup_event, create_module_event
 from jens.test.tools import create_common_event
 
 from jens.test.testcases import JensTestCase
 
-from unittest.mock import Mock, patch
+from unittest.mock import patch
 
 class MessagingTest(JensTestCase):
     def setUp(self):
@@ -71,25 +75,25 @@ class MessagingTest(JensTestCase):
         self.assertTrue('common' in hints)
         self.assertEqual(0, len(hints['common']))
 
-    def test_fetch_all_messages_noerrors(self):
+    def test_iterate_messages_noerrors(self):
         create_module_event('foo')
         create_hostgroup_event('bar')
-        msgs = _fetch_all_messages()
+        msgs = list(_iterate_messages())
         self.assertEqual(2, len(msgs))
 
-    def test_fetch_all_messages_no_queuedir_is_created(self):
+    def test_iterate_messages_no_queuedir_is_created(self):
         self.settings.MESSAGING_QUEUEDIR = "%s/notthere" % \
             self.settings.MESSAGING_QUEUEDIR
         self.assertFalse(os.path.isdir(self.settings.MESSAGING_QUEUEDIR))
-        msgs = _fetch_all_messages()
+        msgs = list(_iterate_messages())
         self.assertTrue(os.path.isdir(self.settings.MESSAGING_QUEUEDIR))
         self.assertEqual(0, len(msgs))
 
-    def test_fetch_all_messages_queuedir_cannot_be_created(self):
+    def test_iterate_messages_queuedir_cannot_be_created(self):
         if os.getuid() == 0:
             return
         self.settings.MESSAGING_QUEUEDIR = "/oops"
-        self.assertRaises(JensMessagingError, _fetch_all_messages)
+        self.assertRaises(JensMessagingError, list, _iterate_messages())
 
     def test_purge_queue_queuedir_does_not_exist(self):
         if os.getuid() == 0:
@@ -97,25 +101,25 @@ class MessagingTest(JensTestCase):
         self.settings.MESSAGING_QUEUEDIR = "/oops"
         self.assertRaises(JensMessagingError, purge_queue)
 
-    def test_fetch_all_messages_ununpickable(self):
+    def test_iterate_messages_ununpickable(self):
         create_hostgroup_event('bar')
         broken = {'time': datetime.now().isoformat(),
             'data': '))'.encode()}
         add_msg_to_queue(broken)
-        msgs = _fetch_all_messages()
+        msgs = list(_iterate_messages())
         self.assertEqual(1, len(msgs))
 
-    @patch.object(Queue, 'dequeue', side_effect=QueueLockError)
-    def test_fetch_all_messages_locked_item(self, mock_queue):
+    @patch.object(Queue, 'lock', return_value=False)
+    def test_iterate_messages_locked_item(self, mock_queue):
         create_module_event('foo')
-        msgs = _fetch_all_messages()
+        msgs = list(_iterate_messages())
         self.assertEqual(0, len(msgs))
         mock_queue.assert_called_once()
 
-    @patch.object(Queue, 'dequeue', side_effect=OSError)
-    def test_fetch_all_messages_ioerror_when_dequeuing(self, mock_queue):
+    @patch.object(Queue, 'get', side_effect=OSError)
+    def test_iterate_messages_ioerror_when_dequeuing(self, mock_queue):
         create_module_event('foo')
-        msgs = _fetch_all_messages()
+        msgs = list(_iterate_messages())
         self.assertLogErrors()
         mock_queue.assert_called_once()
         self.assertEqual(0, len(msgs))
@@ -136,40 +140,110 @@ class MessagingTest(JensTestCase):
         create_module_event('foo')
         self.assertRaises(JensMessagingError, count_pending_hints)
 
+    def test_iterate_messages_removes_in_batches(self):
+        for index in range(0, 5):
+            create_module_event("m%d" % index)
+        with patch('jens.messaging.REMOVAL_BATCH_SIZE', 2), \
+                patch.object(Queue, 'remove', autospec=True,
+                             side_effect=Queue.remove) as remove:
+            messages = _iterate_messages()
+            next(messages)
+            self.assertEqual(0, remove.call_count)
+            next(messages)
+            next(messages)
+            # Only once the messages of the batch have been consumed
+            self.assertEqual(2, remove.call_count)
+            self.assertEqual(3, count_pending_hints())
+            self.assertEqual(2, len(list(messages)))
+            self.assertEqual(5, remove.call_count)
+        self.assertEqual(0, count_pending_hints())
+
+    def test_iterate_messages_removes_discarded_messages_in_batches(self):
+        for index in range(0, 7):
+            add_msg_to_queue({'time': datetime.now().isoformat(),
+                              'data': '))'.encode()})
+        create_module_event('foo')
+        sizes = []
+        def _count_and_remove(queue, names):
+            sizes.append(len(names))
+            _remove_elements(queue, names)
+        with patch('jens.messaging.REMOVAL_BATCH_SIZE', 3), \
+                patch('jens.messaging._remove_elements',
+                      side_effect=_count_and_remove):
+            messages = list(_iterate_messages())
+        self.assertEqual(1, len(messages))
+        self.assertEqual([3, 3, 2], sizes)
+        self.assertEqual(0, count_pending_hints())
+
+    def test_update_hints_are_kept_if_merging_fails(self):
+        create_module_event('foo')
+        create_module_event('bar')
+        create_hostgroup_event('baz')
+        def _merge_and_fail(messages, stats=None):
+            next(messages)
+            next(messages)
+            raise RuntimeError("boom")
+        with patch('jens.messaging.REMOVAL_BATCH_SIZE', 1), \
+                patch('jens.messaging._validate_and_merge_messages',
+                      side_effect=_merge_and_fail):
+            self.assertRaises(JensMessagingError, fetch_update_hints)
+        # The first batch was already removed, the rest is unlocked
+        self.assertEqual(2, count_pending_hints())
+        hints = fetch_update_hints()
+        self.assertEqual(1, len(hints['modules']))
+        self.assertEqual(set(['baz']), hints['hostgroups'])
+        self.assertEqual(0, count_pending_hints())
+
+    def test_update_hints_unlock_elements_left_locked(self):
+        create_module_event('foo')
+        create_module_event('bar')
+        queue = Queue(self.settings.MESSAGING_QUEUEDIR, schema=MSG_SCHEMA)
+        names = list(queue)
+        for name in names:
+            self.assertTrue(queue.lock(name))
+        # Only the old lock was left behind by a dead run
+        past = time.time() - STALE_LOCK_AGE - 10
+        os.utime("%s/%s" % (self.settings.MESSAGING_QUEUEDIR, names[0]),
+                 (past, past))
+        hints = fetch_update_hints()
+        self.assertEqual(1, len(hints['modules']))
+        self.assertEqual(1, count_pending_hints())
+
+    def test_update_hints_are_merged_while_streaming(self):
+        for index in range(0, 10):
+            create_module_event("m%d" % (index % 3))
+        create_hostgroup_event('bar')
+        with patch('jens.messaging.REMOVAL_BATCH_SIZE', 4):
+            hints = fetch_update_hints()
+        self.assertEqual(set(['m0', 'm1', 'm2']), hints['modules'])
+        self.assertEqual(set(['bar']), hints['hostgroups'])
+        self.assertEqual(0, count_pending_hints())
+
     # TODO: Test that other messages are fetched if one is locked/broken
 
-    def test_validate_and_merge_messages(self):
-        messages = [
+    def test_validate_and_merge_pickled_messages(self):
+        payloads = [
+            '', # Bad
             {}, # Bad
-            {'data': {'modules': ['foo']}}, # Bad
-            {'time': datetime.now().isoformat()}, # Bad
-            {'time': datetime.now().isoformat(),
-                'data': ''}, # Bad
-            {'time': datetime.now().isoformat(),
-                'data': {}}, # Bad
-            {'time': datetime.now().isoformat(),
-                'data': {'modules': 'foo'}}, # Bad
-            {'time': datetime.now().isoformat(),
-                'data': {'modules': ['fizz', []]}}, # Bad
-            {'time': datetime.now().isoformat(),
-                'data': {'modules': ['foo']}},
-            {'time': datetime.now().isoformat(),
-                'data': {'modules': ['bar']}},
-            {'time': datetime.now().isoformat(),
-                'data': {'modules': ['baz1', 'baz2']}},
-            {'time': datetime.now().isoformat(),
-                'data': {'hostgroups': ['hg0']}},
-            {'time': datetime.now().isoformat(),
-                'data': {'hostgroups': ['hg1', 'hg2']}},
-            {'time': datetime.now().isoformat(),
-                'data': {'hostgroups': ['hg3', 'hg4'],
-                'modules': ['m1']}},
-            {'time': datetime.now().isoformat(),
-                'data': {'crap': ['hg3', 'hg4'],
-                'modules': ['m2']}},
-            {'time': datetime.now().isoformat(),
-                'data': {'common': ['site']}},
+            {'modules': 'foo'}, # Bad
+            {'modules': ['fizz', []]}, # Partially bad
+            {'modules': ['foo']},
+            {'modules': ['bar']},
+            {'modules': ['baz1', 'baz2']},
+            {'hostgroups': ['hg0']},
+            {'hostgroups': ['hg1', 'hg2']},
+            {'hostgroups': ['hg3', 'hg4'], 'modules': ['m1']},
+            {'crap': ['hg3', 'hg4'], 'modules': ['m2']},
+            {'common': ['site']},
         ]
+        messages = []
+        for payload in payloads:
+            try:
+                messages.append({'time': datetime.now().isoformat(),
+                                 'data': _decode_hints(pickle.dumps(payload))})
+            except ValueError:
+                pass
+        self.assertEqual(9, len(messages))
 
         modules = ['foo', 'bar', 'baz1', 'baz2', 'm1', 'm2', 'fizz']
         hgs = ['hg0', 'hg1', 'hg2', 'hg3', 'hg4']
@@ -187,6 +261,39 @@ class MessagingTest(JensTestCase):
             self.assertTrue(h in result['hostgroups'])
         self.assertTrue('site' in result['common'])
 
+    def test_decode_hints(self):
+        self.assertEqual([('modules', 'foo bar')],
+                         _decode_hints(_encode_hint('modules', 'foo bar')))
+        self.assertEqual(b'jens-hint/1 hostgroups h\xc3\xa9',
+                         _encode_hint('hostgroups', 'h\xe9'))
+        for payload in (b'jens-hint/1 modules', b'jens-hint/1 modules ',
+                        b'jens-hint/1 crap foo', b'jens-hint/2 modules foo',
+                        b'jens-hint/1 modules foo\nbar',
+                        b'jens-hint/1 modules \xff', b'', b'))'):
+            self.assertRaises(ValueError, _decode_hints, payload)
+
+    def test_pickled_hints_cannot_run_code(self):
+        class Evil(object):
+            def __reduce__(self):
+                return (os.mkdir, ("%s/pwned" % self.sandbox,))
+        evil = Evil()
+        evil.sandbox = self.sandbox_path
+        add_msg_to_queue({'time': datetime.now().isoformat(),
+                          'data': pickle.dumps({'modules': [evil]})})
+        create_module_event('foo')
+        hints = fetch_update_hints()
+        self.assertEqual(set(['foo']), hints['modules'])
+        self.assertFalse(os.path.exists("%s/pwned" % self.sandbox_path))
+        self.assertEqual(0, count_pending_hints())
+
+    def test_pickled_hints_can_be_refused(self):
+        self.settings.MESSAGING_ACCEPT_PICKLED_HINTS = False
+        create_module_event('foo')
+        enqueue_hint('modules', 'bar')
+        hints = fetch_update_hints()
+        self.assertEqual(set(['bar']), hints['modules'])
+        self.assertEqual(0, count_pending_hints())
+
     def test_enqueue_hint_okay(self):
         enqueue_hint('modules', 'foo1')
         enqueue_hint('modules', 'foo2')
@@ -217,6 +324,55 @@ class MessagingTest(JensTestCase):
     @patch.object(Queue, 'add', side_effect=QueueError)
     def test_enqueue_hint_queue_error(self, mock):
         self.assertRaises(JensMessagingError, enqueue_hint, 'modules', 'foo')
+        # Otherwise the hint could never be queued again
+        self.assertEqual(0, count_pending_repositories())
+
+    def test_enqueue_hint_coalesces_pending_hints(self):
+        self.assertTrue(enqueue_hint('modules', 'foo'))
+        self.assertFalse(enqueue_hint('modules', 'foo'))
+        self.assertFalse(enqueue_hint('modules', 'foo'))
+        self.assertTrue(enqueue_hint('hostgroups', 'foo'))
+        self.assertEqual(2, count_pending_hints())
+        self.assertEqual(2, count_pending_repositories())
+        hints = fetch_update_hints()
+        self.assertEqual(set(['foo']), hints['modules'])
+        self.assertEqual(set(['foo']), hints['hostgroups'])
+        self.assertEqual(0, count_pending_repositories())
+        # Consumed, so it has to be queued again
+        self.assertTrue(enqueue_hint('modules', 'foo'))
+        self.assertEqual(1, count_pending_hints())
+
+    def test_enqueue_hint_ignores_stale_pending_markers(self):
+        self.assertTrue(enqueue_hint('modules', 'foo'))
+        with patch('jens.messaging.PENDING_MARKER_TTL', 0):
+            self.assertTrue(enqueue_hint('modules', 'foo'))
+        self.assertEqual(2, count_pending_hints())
+        self.assertEqual(1, count_pending_repositories())
+
+    def test_hints_from_other_producers_clear_pending_markers(self):
+        enqueue_hint('modules', 'foo')
+        create_module_event('foo')
+        create_module_event('bar')
+        hints = fetch_update_hints()
+        self.assertEqual(set(['foo', 'bar']), hints['modules'])
+        self.assertEqual(0, count_pending_repositories())
+
+    def test_pending_markers_are_removed_as_hints_are_merged(self):
+        enqueue_hint('modules', 'foo')
+        enqueue_hint('modules', 'bar')
+        def _merge_and_fail(messages, stats=None):
+            next(messages)
+            next(messages)
+            raise RuntimeError("boom")
+        with patch('jens.messaging.REMOVAL_BATCH_SIZE', 1), \
+                patch('jens.messaging._validate_and_merge_messages',
+                      side_effect=_merge_and_fail):
+            self.assertRaises(JensMessagingError, fetch_update_hints)
+        # Only the hint that was merged and removed lost its marker
+        self.assertEqual(1, count_pending_hints())
+        self.assertEqual(1, count_pending_repositories())
+        self.assertTrue(enqueue_hint('modules', 'foo'))
+        self.assertFalse(enqueue_hint('modules', 'bar'))
 
     def test_enqueue_hint_bad_partition(self):
         self.assertRaises(JensMessagingError, enqueue_hint, 'booboo', 'foo')
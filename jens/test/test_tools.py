@@ -0,0 +1,45 @@
+# Copyright (C) 2026, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import absolute_import
+
+from jens.tools import ref_is_commit, split_refs
+from jens.tools import refname_to_dirname, dirname_to_refname
+from jens.tools import dirnames_to_refnames
+
+from jens.test.testcases import JensTestCase
+
+class ToolsTest(JensTestCase):
+    def test_ref_is_commit(self):
+        self.assertTrue(ref_is_commit('commit/7a9a6e2'))
+        self.assertTrue(ref_is_commit('COMMIT/7A9A6E2'))
+        self.assertEqual(ref_is_commit('commit/7a9a6e2').group(1), '7a9a6e2')
+        self.assertFalse(ref_is_commit('master'))
+        self.assertFalse(ref_is_commit('commit/nothex'))
+        # Memoized results are the same
+        self.assertTrue(ref_is_commit('commit/7a9a6e2'))
+        self.assertFalse(ref_is_commit('master'))
+
+    def test_refname_dirname_round_trip(self):
+        for refname in ('master', 'qa', 'commit/7a9a6e2'):
+            dirname = refname_to_dirname(refname)
+            self.assertEqual(dirname_to_refname(dirname), refname)
+        self.assertEqual(refname_to_dirname('commit/7a9a6e2'), '.7a9a6e2')
+        self.assertEqual(dirnames_to_refnames(['.7a9a6e2', 'qa']),
+                         ['commit/7a9a6e2', 'qa'])
+
+    def test_split_refs(self):
+        self.assertEqual(split_refs(['master', 'commit/7a9a6e2', 'qa']),
+                         (['master', 'qa'], ['commit/7a9a6e2']))
+        self.assertEqual(split_refs([]), ([], []))
+
+    def test_hashprefix_changes_are_noticed(self):
+        self.assertEqual(refname_to_dirname('commit/7a9a6e2'), '.7a9a6e2')
+        self.settings.HASHPREFIX = 'sha/'
+        self.assertEqual(refname_to_dirname('commit/7a9a6e2'), 'commit/7a9a6e2')
+        self.assertEqual(refname_to_dirname('sha/7a9a6e2'), '.7a9a6e2')
+        self.assertEqual(dirname_to_refname('.7a9a6e2'), 'sha/7a9a6e2')
@@ -7,16 +7,27 @@
 
 from __future__ import absolute_import
 import os
+import re
 import yaml
+import pickle
 import shutil
+import time
+import threading
+import multiprocessing
 from unittest import mock
+from multiprocessing.pool import ThreadPool
 
 from jens.messaging import count_pending_hints
 from jens.repos import refresh_repositories
 from jens.locks import JensLockFactory
 from jens.environments import refresh_environments
+import jens.environments as environments
+import jens.repos as repos
+import jens.reposinventory as reposinventory
+import jens.git_wrapper as git_wrapper
 from jens.git_wrapper import get_refs
-from jens.errors import JensMessagingError
+from jens.git_pool import get_repository
+from jens.errors import JensMessagingError, JensEnvironmentsError
 
 from jens.test.tools import ensure_environment, destroy_environment
 from jens.test.tools import init_repositories
@@ -24,6 +35,7 @@ from jens.test.tools import add_repository, del_repository
 from jens.test.tools import create_fake_repository
 from jens.test.tools import add_branch_to_repo, remove_branch_from_repo
 from jens.test.tools import add_commit_to_branch, reset_branch_to
+from jens.test.tools import _git
 
 from jens.test.testcases import JensTestCase
 
@@ -57,6 +69,18 @@ class UpdateTest(JensTestCase):
         add_repository('hostgroups', hostgroup, bare)
         return user
 
+    def _commit_environments(self, environments=None):
+        path = self.settings.ENV_METADATADIR
+        gitdir = "%s/.git" % path
+        if not os.path.exists(gitdir):
+            _git(["init"], gitdir=gitdir, gitworkingtree=path)
+        if environments is None:
+            paths = ["-A"]
+        else:
+            paths = ["%s.yaml" % environment for environment in environments]
+        _git(["add"] + paths, gitdir=gitdir, gitworkingtree=path)
+        _git(["commit", "-m", "update"], gitdir=gitdir, gitworkingtree=path)
+
     def _jens_update(self, errorsExpected=False, errorRegexp=None, hints=None):
         repositories_deltas, inventory = refresh_repositories(hints=hints)
         refresh_environments(repositories_deltas, inventory)
@@ -1215,3 +1239,1007 @@ class UpdateTest(JensTestCase):
         ensure_environment('parserbroken', 'qa', parser='broken')
         self._jens_update(errorsExpected=True)
         self.assertEnvironmentDoesntExist('parserbroken')
+
+    def _fetch_counters(self):
+        counters = None
+        with open("%s/jens-test.log" % self.settings.LOGDIR) as log:
+            for line in log:
+                match = re.match(r'.+Fetches: (\d+) done, (\d+) skipped', line)
+                if match:
+                    counters = (int(match.group(1)), int(match.group(2)))
+        return counters
+
+    def test_fetch_skipped_if_remote_refs_unchanged(self):
+        murdock_path = self._create_fake_module('murdock', ['qa'])
+
+        self._jens_update()
+        self._jens_update()
+
+        self.assertEqual(self._fetch_counters(), (3, 0))
+
+        self._jens_update()
+
+        self.assertEqual(self._fetch_counters(), (0, 3))
+
+        new_qa = add_commit_to_branch(murdock_path, 'qa')
+
+        self._jens_update()
+
+        self.assertEqual(self._fetch_counters(), (1, 2))
+        self.assertClone('modules/murdock/qa', pointsto=new_qa)
+
+        remove_branch_from_repo(murdock_path, 'qa')
+        add_branch_to_repo(murdock_path, 'foo')
+        ensure_environment('test', 'master', modules=["murdock:foo"])
+
+        self._jens_update()
+
+        self.assertEqual(self._fetch_counters(), (1, 2))
+        self.assertClone('modules/murdock/foo')
+        self.assertEnvironmentOverride("test", 'modules/murdock', 'foo')
+
+    def test_fetch_not_skipped_if_remote_fingerprints_disabled(self):
+        self.settings.GIT_REMOTE_FINGERPRINTS = False
+        self._create_fake_module('murdock', ['qa'])
+
+        self._jens_update()
+        self._jens_update()
+        self._jens_update()
+
+        self.assertEqual(self._fetch_counters(), (3, 0))
+
+    def test_fetch_not_skipped_if_remote_unavailable(self):
+        yi_path = self._create_fake_hostgroup('yi', ['qa'])
+        yi_path_bare = yi_path.replace('/user/', '/bare/')
+
+        self._jens_update()
+        self._jens_update()
+
+        shutil.move("%s/refs" % yi_path_bare, "%s/goat" % yi_path_bare)
+
+        self._jens_update(errorsExpected=True, errorRegexp="fetch 'yi'")
+
+        self.assertEqual(self._fetch_counters(), (0, 2))
+
+    def test_refresh_costs_are_recorded_for_all_partitions(self):
+        self._create_fake_module('murdock', ['qa'])
+        self._create_fake_hostgroup('steve', ['qa'])
+
+        self._jens_update()
+        self._jens_update()
+
+        with open("%s/refresh_costs" % self.settings.CACHEDIR, 'rb') as costs_file:
+            costs = pickle.load(costs_file)
+        self.assertEqual(set(costs.keys()),
+            set([('modules', 'murdock'), ('hostgroups', 'steve'),
+                 ('common', 'site'), ('common', 'hieradata')]))
+
+        del_repository('modules', 'murdock')
+
+        self._jens_update()
+
+        with open("%s/refresh_costs" % self.settings.CACHEDIR, 'rb') as costs_file:
+            costs = pickle.load(costs_file)
+        self.assertFalse(('modules', 'murdock') in costs)
+
+    def test_new_repositories_of_all_partitions_are_created_together(self):
+        self.settings.GIT_MAX_CONCURRENT_CLONES = 2
+        self._create_fake_module('murdock', ['qa'])
+        self._create_fake_module('electron')
+        self._create_fake_hostgroup('steve', ['qa'])
+        self._create_fake_hostgroup('newton', ['qa'])
+
+        repositories_deltas = self._jens_update(errorsExpected=True,
+            errorRegexp="electron.+mandatory branches")
+
+        self.assertEqual(sorted(repositories_deltas['modules']['new']),
+                         ['murdock'])
+        self.assertEqual(sorted(repositories_deltas['hostgroups']['new']),
+                         ['newton', 'steve'])
+        self.assertNotBare('modules/electron')
+        for name in ('modules/murdock', 'hostgroups/steve', 'hostgroups/newton'):
+            self.assertBare(name)
+            self.assertClone('%s/master' % name)
+            self.assertClone('%s/qa' % name)
+        self.assertEnvironmentLinks("production")
+        self.assertEnvironmentLinks("qa")
+
+    def test_clones_and_refreshes_are_scheduled_together(self):
+        lock = threading.Lock()
+        started = []
+        running = {repos.JOB_CLONE: 0, 'peak': 0}
+        def job(data):
+            with lock:
+                started.append(data['name'])
+                if data['kind'] == repos.JOB_CLONE:
+                    running[repos.JOB_CLONE] += 1
+                    running['peak'] = max(running['peak'],
+                                          running[repos.JOB_CLONE])
+            time.sleep(0.05)
+            with lock:
+                if data['kind'] == repos.JOB_CLONE:
+                    running[repos.JOB_CLONE] -= 1
+            return data['name']
+        jobs = [(float('inf'), repos.JOB_CLONE, job,
+                 {'kind': repos.JOB_CLONE, 'name': "c%d" % index})
+                for index in range(0, 6)]
+        jobs.extend((cost, repos.JOB_REFRESH, job,
+                     {'kind': repos.JOB_REFRESH, 'name': "r%d" % cost})
+                    for cost in (5, 3, 1))
+
+        # With one worker, the jobs are run in order of priority
+        pool = ThreadPool(processes=1)
+        results = list(repos._schedule_jobs(pool, jobs, 1, 2))
+        pool.close()
+        pool.join()
+        self.assertEqual(['c0', 'c1', 'c2', 'c3', 'c4', 'c5',
+                          'r5', 'r3', 'r1'], started)
+        self.assertEqual(started, [name for _, name in results])
+
+        # Refreshes fill the workers not allowed to clone
+        del started[:]
+        pool = ThreadPool(processes=4)
+        results = list(repos._schedule_jobs(pool, jobs, 4, 2))
+        pool.close()
+        pool.join()
+        self.assertEqual(set(['c0', 'c1', 'r5', 'r3']), set(started[0:4]))
+        self.assertEqual(2, running['peak'])
+        self.assertEqual(9, len(results))
+
+    def test_refresh_workers_are_stopped_if_one_fails(self):
+        murdock_path = self._create_fake_module('murdock', ['qa'])
+        self._create_fake_module('steve', ['qa'])
+        self._jens_update()
+        costs_path = "%s/refresh_costs" % self.settings.CACHEDIR
+        os.remove(costs_path)
+        add_commit_to_branch(murdock_path, 'qa')
+
+        # Inherited by the workers, only the one refreshing murdock fails
+        with mock.patch('jens.repos._expand_clones',
+                        side_effect=RuntimeError("boom")):
+            self.assertRaises(RuntimeError, refresh_repositories)
+
+        self.assertEqual([], multiprocessing.active_children())
+        with open(costs_path, "rb") as costs_file:
+            costs = pickle.load(costs_file)
+        # Whatever finished before is kept
+        self.assertFalse(('modules', 'murdock') in costs)
+
+
+        self.settings.CLONE_MODE = 'WORKTREE'
+        murdock_path = self._create_fake_hostgroup('murdock', ['qa', 'foo'])
+        commit_id = get_refs(murdock_path + '/.git')['qa']
+        override = "{0}{1}".format(COMMIT_PREFIX, commit_id)
+        ensure_environment('test', 'master',
+            hostgroups=["murdock:foo"], modules=[])
+        ensure_environment('static', 'master',
+            hostgroups=["murdock:%s" % override])
+
+        self._jens_update()
+
+        clonedir = "%s/hostgroups/murdock" % self.settings.CLONEDIR
+        for dirname in ('master', 'qa', 'foo', '.%s' % commit_id):
+            self.assertTrue(os.path.isfile("%s/%s/.git" % (clonedir, dirname)))
+        self.assertClone('hostgroups/murdock/.%s' % commit_id, pointsto=commit_id)
+        self.assertEnvironmentOverride("test", 'hostgroups/hg_murdock', 'foo')
+
+        qa_commit_id = add_commit_to_branch(murdock_path, 'qa', fname='qa1')
+        foo_commit_id = add_commit_to_branch(murdock_path, 'foo', fname='foo1')
+
+        self._jens_update()
+
+        self.assertClone('hostgroups/murdock/qa', pointsto=qa_commit_id)
+        self.assertCloneFileExists('hostgroups/murdock/qa', 'qa1')
+        self.assertClone('hostgroups/murdock/foo', pointsto=foo_commit_id)
+        self.assertCloneFileExists('hostgroups/murdock/foo', 'foo1')
+        self.assertClone('hostgroups/murdock/.%s' % commit_id, pointsto=commit_id)
+
+        destroy_environment('test')
+        ensure_environment('test', 'master')
+
+        self._jens_update()
+
+        self.assertNotClone('hostgroups/murdock/foo')
+        worktrees = os.listdir("%s/hostgroups/murdock/worktrees" %
+                               self.settings.BAREDIR)
+        self.assertEqual(len(worktrees), 3)
+
+    def test_clones_are_recreated_if_clone_mode_changes(self):
+        murdock_path = self._create_fake_hostgroup('murdock', ['qa'])
+
+        self._jens_update()
+
+        qa_path = "%s/hostgroups/murdock/qa" % self.settings.CLONEDIR
+        self.assertTrue(os.path.isdir("%s/.git" % qa_path))
+
+        self.settings.CLONE_MODE = 'WORKTREE'
+        qa_commit_id = add_commit_to_branch(murdock_path, 'qa', fname='qa1')
+
+        self._jens_update()
+
+        self.assertTrue(os.path.isfile("%s/.git" % qa_path))
+        self.assertClone('hostgroups/murdock/qa', pointsto=qa_commit_id)
+        self.assertCloneFileExists('hostgroups/murdock/qa', 'qa1')
+
+        self.settings.CLONE_MODE = 'CLONE'
+        qa_commit_id = add_commit_to_branch(murdock_path, 'qa', fname='qa2')
+
+        self._jens_update()
+
+        self.assertTrue(os.path.isdir("%s/.git" % qa_path))
+        self.assertClone('hostgroups/murdock/qa', pointsto=qa_commit_id)
+        self.assertCloneFileExists('hostgroups/murdock/qa', 'qa2')
+
+    def test_clones_are_recreated_if_clone_mode_changes_without_commits(self):
+        murdock_path = self._create_fake_hostgroup('murdock', ['qa'])
+        commit_id = get_refs(murdock_path + '/.git')['qa']
+        override = "{0}{1}".format(COMMIT_PREFIX, commit_id)
+        ensure_environment('static', 'master',
+            hostgroups=["murdock:%s" % override])
+
+        self._jens_update()
+
+        clonedir = "%s/hostgroups/murdock" % self.settings.CLONEDIR
+        dirnames = ('master', 'qa', '.%s' % commit_id)
+        for dirname in dirnames:
+            self.assertTrue(os.path.isdir("%s/%s/.git" % (clonedir, dirname)))
+
+        self.settings.CLONE_MODE = 'WORKTREE'
+        self._jens_update()
+
+        for dirname in dirnames:
+            self.assertTrue(os.path.isfile("%s/%s/.git" % (clonedir, dirname)))
+        self.assertClone('hostgroups/murdock/qa', pointsto=commit_id)
+        self.assertClone('hostgroups/murdock/.%s' % commit_id,
+                         pointsto=commit_id)
+
+        self.settings.CLONE_MODE = 'STORE'
+        self._jens_update()
+
+        for dirname in dirnames:
+            self.assertTrue(os.path.islink("%s/%s" % (clonedir, dirname)))
+        # No administrative files of the old worktrees are left behind
+        worktrees_path = "%s/hostgroups/murdock/worktrees" % \
+            self.settings.BAREDIR
+        self.assertFalse(os.path.isdir(worktrees_path) and
+                         os.listdir(worktrees_path))
+        self.assertEnvironmentOverride("static", 'hostgroups/hg_murdock',
+                                       '.%s' % commit_id)
+
+    def test_store_mode_shares_trees_and_switches_links(self):
+        self.settings.CLONE_MODE = 'STORE'
+        murdock_path = self._create_fake_hostgroup('murdock', ['qa'])
+        # Fake repositories created in the same second share commits
+        qa_commit_id = add_commit_to_branch(murdock_path, 'qa', fname='qa0')
+        override = "{0}{1}".format(COMMIT_PREFIX, qa_commit_id)
+        ensure_environment('test', 'master',
+            hostgroups=["murdock:%s" % override])
+
+        self._jens_update()
+
+        store_path = "%s/.store" % self.settings.CLONEDIR
+        qa_path = "%s/hostgroups/murdock/qa" % self.settings.CLONEDIR
+        commit_path = "%s/hostgroups/murdock/.%s" % \
+            (self.settings.CLONEDIR, qa_commit_id)
+        self.assertTrue(os.path.islink(qa_path))
+        self.assertEqual(os.path.realpath(qa_path),
+                         os.path.realpath("%s/%s" % (store_path, qa_commit_id)))
+        self.assertEqual(os.readlink(qa_path), os.readlink(commit_path))
+        self.assertClone('hostgroups/murdock/qa')
+        self.assertClone('hostgroups/murdock/master')
+        self.assertClone('hostgroups/murdock/.%s' % qa_commit_id)
+        self.assertFalse(os.path.exists("%s/.git" % qa_path))
+        self.assertEnvironmentLinks("qa")
+        self.assertEnvironmentOverride("test", 'hostgroups/hg_murdock', override)
+
+        # --- qa moves but the old tree is still used by the override
+
+        new_commit_id = add_commit_to_branch(murdock_path, 'qa', fname='qa1')
+
+        self._jens_update()
+
+        self.assertEqual(os.path.basename(os.readlink(qa_path)), new_commit_id)
+        self.assertCloneFileExists('hostgroups/murdock/qa', 'qa1')
+        self.assertTrue(qa_commit_id in os.listdir(store_path))
+        self.assertEnvironmentLinks("qa")
+
+        # --- Once nothing points to it, it's trashed and then deleted
+
+        destroy_environment('test')
+
+        self._jens_update()
+
+        self.assertFalse(os.path.lexists(commit_path))
+        self.assertEqual(os.listdir("%s/.trash" % store_path), [qa_commit_id])
+
+        self._jens_update()
+
+        self.assertFalse(qa_commit_id in os.listdir(store_path))
+        self.assertFalse(os.path.exists("%s/.trash" % store_path))
+
+    def test_store_mode_trees_of_deleted_repositories_are_trashed(self):
+        self.settings.CLONE_MODE = 'STORE'
+        murdock_path = self._create_fake_hostgroup('murdock', ['qa'])
+        qa_commit_id = add_commit_to_branch(murdock_path, 'qa', fname='qa0')
+        master_commit_id = add_commit_to_branch(murdock_path, 'master',
+                                                fname='master0')
+
+        self._jens_update()
+
+        del_repository('hostgroups', 'murdock')
+
+        self._jens_update()
+
+        self.assertNotBare('hostgroups/murdock')
+        self.assertEqual(
+            sorted(os.listdir("%s/.store/.trash" % self.settings.CLONEDIR)),
+            sorted([qa_commit_id, master_commit_id]))
+
+    def test_environment_definitions_are_parsed_once_per_content(self):
+        self.settings.ENVIRONMENTS_WORKERS = 4
+        self._create_fake_module('foo', ['qa'])
+        ensure_environment('test', 'master', modules=['foo:qa'])
+
+        # The environments are processed by forked workers, so the
+        # parses are counted in a file to see the ones made by them too
+        parses_path = "%s/parses" % self.sandbox_path
+        parse_environment_definition = environments._parse_environment_definition
+        def _counting_parse(data):
+            with open(parses_path, 'a') as parses:
+                parses.write("%d\n" % os.getpid())
+            return parse_environment_definition(data)
+        def _count_parses():
+            if not os.path.exists(parses_path):
+                return 0
+            with open(parses_path) as parses:
+                count = len(parses.readlines())
+            os.unlink(parses_path)
+            return count
+
+        with mock.patch('jens.environments._parse_environment_definition',
+                        side_effect=_counting_parse):
+            self._jens_update()
+            # production, qa and test
+            self.assertEqual(_count_parses(), 3)
+            self.assertEnvironmentOverride('test', 'modules/foo', 'qa')
+
+            self._jens_update()
+            self.assertEqual(_count_parses(), 0)
+
+            destroy_environment('test')
+            ensure_environment('test', 'master', modules=['foo:master'])
+            self._jens_update()
+            self.assertEqual(_count_parses(), 1)
+            self.assertEnvironmentOverride('test', 'modules/foo', 'master')
+
+            environment = {'notifications': 'higgs@example.org',
+                'default': 'master', 'overrides': None}
+            with open("%s/test.yaml" % self.settings.ENV_METADATADIR, 'w') \
+                    as environment_file:
+                yaml.dump(environment, environment_file)
+            self._jens_update(errorsExpected=True, errorRegexp="test")
+            # Cached definitions are validated every time
+            self.assertRaises(JensEnvironmentsError,
+                              environments.read_environment_definition, 'test')
+            self.assertEnvironmentDoesntExist("test")
+
+    def test_environments_delta_skipped_if_metadata_head_unchanged(self):
+        self._create_fake_module('foo', ['qa'])
+        ensure_environment('test', 'master')
+        self._commit_environments()
+
+        self._jens_update()
+
+        self.assertEnvironmentOverride('test', 'modules/foo', 'master')
+
+        with mock.patch('jens.environments.hash_object',
+                        wraps=environments.hash_object) as hashing:
+            self._jens_update()
+            hashing.assert_not_called()
+
+            # --- Committed changes are detected via the tree
+
+            ensure_environment('test', 'master', modules=['foo:qa'])
+            self._commit_environments()
+
+            self._jens_update()
+
+            self.assertEnvironmentOverride('test', 'modules/foo', 'qa')
+            hashing.assert_not_called()
+
+            # --- Untracked definitions are hashed
+
+            ensure_environment('untracked', 'qa')
+
+            self._jens_update()
+
+            self.assertEnvironmentLinks('untracked')
+            destroy_environment('untracked')
+            ensure_environment('untracked', 'master')
+            ensure_environment('test', 'master', modules=['foo:master'])
+            self._commit_environments(['test'])
+            hashing.reset_mock()
+
+            self._jens_update()
+
+            # HEAD doesn't tell what's in the tree, so everything is hashed
+            self.assertEqual(set(call[0][0] for call in hashing.call_args_list),
+                set(["%s/%s.yaml" % (self.settings.ENV_METADATADIR, name)
+                     for name in environments.get_names_of_declared_environments()]))
+            self.assertEnvironmentOverride('test', 'modules/foo', 'master')
+            self.assertEnvironmentOverride('untracked', 'modules/foo', 'master')
+
+    def test_environments_edited_in_place_are_not_skipped(self):
+        self._create_fake_module('foo', ['qa'])
+        ensure_environment('test', 'master')
+        self._commit_environments()
+
+        self._jens_update()
+
+        # --- Modified without committing, HEAD doesn't move
+
+        ensure_environment('test', 'master', modules=['foo:qa'])
+
+        self._jens_update()
+
+        self.assertEnvironmentOverride('test', 'modules/foo', 'qa')
+
+        # --- Reverted without committing, HEAD doesn't move either
+
+        _git(["checkout", "--", "test.yaml"],
+             gitdir="%s/.git" % self.settings.ENV_METADATADIR,
+             gitworkingtree=self.settings.ENV_METADATADIR)
+
+        self._jens_update()
+
+        self.assertEnvironmentOverride('test', 'modules/foo', 'master')
+
+    def test_environments_are_processed_by_several_workers(self):
+        self.settings.ENVIRONMENTS_WORKERS = 3
+        self._create_fake_module('foo', ['qa'])
+        environments = ["env%d" % index for index in range(0, 8)]
+        for environment in environments:
+            ensure_environment(environment, 'master')
+
+        self._jens_update()
+
+        for environment in environments:
+            self.assertEnvironmentLinks(environment)
+            self.assertEnvironmentOverride(environment, 'modules/foo', 'master')
+            self.assertTrue(os.path.isfile("%s/environments/%s" %
+                (self.settings.CACHEDIR, environment)))
+
+        # --- New repositories are linked in the not changed ones
+        # and the changed ones are recreated
+
+        self._create_fake_hostgroup('murdock', ['qa'])
+        for environment in environments[:4]:
+            ensure_environment(environment, 'master', modules=['foo:qa'])
+
+        self._jens_update()
+
+        for environment in environments:
+            self.assertEnvironmentLinks(environment)
+            self.assertEnvironmentOverride(environment,
+                'hostgroups/hg_murdock', 'master')
+        for environment in environments[:4]:
+            self.assertEnvironmentOverride(environment, 'modules/foo', 'qa')
+        for environment in environments[4:]:
+            self.assertEnvironmentOverride(environment, 'modules/foo', 'master')
+
+    def _link_inodes(self, environment):
+        inodes = {}
+        base_path = "%s/%s" % (self.settings.ENVIRONMENTSDIR, environment)
+        for path, dirs, files in os.walk(base_path):
+            for name in dirs + files:
+                name = os.path.join(path, name)
+                if os.path.islink(name):
+                    inodes[os.path.relpath(name, base_path)] = os.lstat(name).st_ino
+        return inodes
+
+    def test_changed_environment_only_relinks_what_changed(self):
+        self._create_fake_module('foo', ['qa'])
+        self._create_fake_module('bar', ['qa'])
+        self._create_fake_hostgroup('murdock', ['qa'])
+        ensure_environment('test', 'master', modules=['foo:qa'])
+
+        self._jens_update()
+
+        before = self._link_inodes('test')
+        with open("%s/environments/test" % self.settings.CACHEDIR) as annotation:
+            self.assertEqual(len(annotation.read().splitlines()), 2)
+
+        ensure_environment('test', 'master',
+            modules=['foo:master'], hostgroups=['murdock:qa'])
+
+        self._jens_update()
+
+        after = self._link_inodes('test')
+        self.assertEqual(sorted(before.keys()), sorted(after.keys()))
+        changed = sorted(path for path in after if before[path] != after[path])
+        self.assertEqual(changed, ['hieradata/fqdns/murdock',
+            'hieradata/hostgroups/murdock', 'hieradata/module_names/foo',
+            'hostgroups/hg_murdock', 'modules/foo'])
+        self.assertEnvironmentLinks('test')
+        self.assertEnvironmentOverride('test', 'modules/foo', 'master')
+        self.assertEnvironmentOverride('test', 'modules/bar', 'master')
+        self.assertEnvironmentOverride('test', 'hostgroups/hg_murdock', 'qa')
+
+        # --- Default changes, repositories come and go at the same time
+
+        del_repository('modules', 'bar')
+        self._create_fake_module('baz', ['qa'])
+        ensure_environment('test', 'qa',
+            modules=['foo:master'], hostgroups=['murdock:qa'])
+
+        self._jens_update()
+
+        after_default = self._link_inodes('test')
+        self.assertEnvironmentLinks('test')
+        self.assertEnvironmentOverrideDoesntExist('test', 'modules/bar')
+        self.assertEnvironmentOverride('test', 'modules/baz', 'qa')
+        self.assertEnvironmentOverride('test', 'modules/foo', 'master')
+        self.assertEqual(after['modules/foo'], after_default['modules/foo'])
+        self.assertEqual(after['hostgroups/hg_murdock'],
+                         after_default['hostgroups/hg_murdock'])
+        self.assertNotEqual(after['site'], after_default['site'])
+
+    def test_changed_environment_without_default_gets_only_overrides(self):
+        self._create_fake_module('foo', ['qa'])
+        self._create_fake_module('bar', ['qa'])
+        ensure_environment('test', None, modules=['foo:qa'])
+
+        self._jens_update()
+
+        self.assertEnvironmentNumberOf('test', 'modules', 1)
+
+        ensure_environment('test', None, modules=['bar:qa'])
+
+        self._jens_update()
+
+        self.assertEnvironmentNumberOf('test', 'modules', 1)
+        self.assertEnvironmentOverrideDoesntExist('test', 'modules/foo')
+        self.assertEnvironmentOverride('test', 'modules/bar', 'qa')
+
+    def test_changed_environment_config_file_follows_parser(self):
+        self.settings.DIRECTORY_ENVIRONMENTS = True
+        self._create_fake_module('foo', ['qa'])
+        ensure_environment('test', 'master', parser='future')
+
+        self._jens_update()
+
+        self.assertEnvironmentHasAConfigFileAndParserSet('test', 'future')
+        before = self._link_inodes('test')
+
+        ensure_environment('test', 'master', modules=['foo:qa'])
+
+        self._jens_update()
+
+        # Updated in place but the parser is gone
+        self.assertEqual(before['site'], self._link_inodes('test')['site'])
+        self.assertEnvironmentHasAConfigFile('test')
+        self.assertEnvironmentHasAConfigFileAndParserSet('test', None)
+        self.assertEnvironmentOverride('test', 'modules/foo', 'qa')
+
+    def test_changed_environment_config_file_follows_setting(self):
+        self._create_fake_module('foo', ['qa'])
+        ensure_environment('test', 'master')
+
+        self._jens_update()
+
+        self.assertEnvironmentDoesNotHaveAConfigFile('test')
+        before = self._link_inodes('test')
+
+        self.settings.DIRECTORY_ENVIRONMENTS = True
+        ensure_environment('test', 'master', modules=['foo:qa'])
+
+        self._jens_update()
+
+        self.assertEqual(before['site'], self._link_inodes('test')['site'])
+        self.assertEnvironmentHasAConfigFile('test')
+        self.assertEnvironmentHasAConfigFileAndParserSet('test', None)
+
+        self.settings.DIRECTORY_ENVIRONMENTS = False
+        ensure_environment('test', 'master')
+
+        self._jens_update()
+
+        self.assertEqual(before['site'], self._link_inodes('test')['site'])
+        self.assertEnvironmentDoesNotHaveAConfigFile('test')
+
+    def test_changed_environment_with_keys_that_are_not_strings(self):
+        self._create_fake_module('foo', ['qa'])
+        # YAML reads 123 as an int and on as a bool
+        definition = "notifications: higgs@example.org\n" \
+            "default: master\n" \
+            "overrides:\n" \
+            "  modules:\n" \
+            "    foo: %s\n" \
+            "    123: qa\n" \
+            "    on: qa\n"
+        definition_path = "%s/test.yaml" % self.settings.ENV_METADATADIR
+        with open(definition_path, 'w') as definition_file:
+            definition_file.write(definition % 'qa')
+
+        self._jens_update()
+
+        self.assertEnvironmentOverride('test', 'modules/foo', 'qa')
+        _, previous = environments._read_environment_annotation('test')
+        self.assertEqual(previous['overrides'],
+            environments.read_environment_definition('test')['overrides'])
+        before = self._link_inodes('test')
+
+        with open(definition_path, 'w') as definition_file:
+            definition_file.write(definition % 'master')
+
+        self._jens_update()
+
+        # Updated in place
+        self.assertEqual(before['site'], self._link_inodes('test')['site'])
+        self.assertEnvironmentOverride('test', 'modules/foo', 'master')
+
+    def test_changed_environment_recreated_if_annotation_is_old(self):
+        self._create_fake_module('foo', ['qa'])
+        ensure_environment('test', 'master')
+
+        self._jens_update()
+
+        annotation_path = "%s/environments/test" % self.settings.CACHEDIR
+        with open(annotation_path) as annotation:
+            hash_value = annotation.readline().strip()
+        with open(annotation_path, 'w') as annotation:
+            annotation.write(hash_value)
+        ensure_environment('test', 'master', modules=['foo:qa'])
+
+        self._jens_update()
+
+        self.assertEnvironmentLinks('test')
+        self.assertEnvironmentOverride('test', 'modules/foo', 'qa')
+        with open(annotation_path) as annotation:
+            self.assertEqual(len(annotation.read().splitlines()), 2)
+
+    def _environment_snapshot(self, path):
+        snapshot = {}
+        for dirpath, dirs, files in os.walk(path):
+            for name in dirs + files:
+                name = os.path.join(dirpath, name)
+                if os.path.islink(name):
+                    snapshot[os.path.relpath(name, path)] = os.readlink(name)
+        return snapshot
+
+    def test_atomic_environments_are_never_seen_half_built(self):
+        self.settings.ATOMIC_ENVIRONMENTS = True
+        for index in range(0, 10):
+            self._create_fake_module("module%d" % index, ['qa'])
+            self._create_fake_hostgroup("hostgroup%d" % index, ['qa'])
+        ensure_environment('test', 'master')
+
+        self._jens_update()
+
+        environment_path = "%s/test" % self.settings.ENVIRONMENTSDIR
+        self.assertTrue(os.path.islink(environment_path))
+        self.assertEnvironmentLinks('test')
+        snapshots = [self._environment_snapshot(environment_path)]
+
+        for default in ('qa', 'master', 'qa'):
+            observed = []
+            errors = []
+            stop = threading.Event()
+
+            def reader():
+                while not stop.is_set():
+                    try:
+                        build = os.path.realpath(environment_path)
+                        observed.append(self._environment_snapshot(build))
+                    except Exception as error:
+                        errors.append(error)
+
+            readers = [threading.Thread(target=reader) for _ in range(0, 3)]
+            for thread in readers:
+                thread.start()
+            try:
+                ensure_environment('test', default)
+                self._jens_update()
+            finally:
+                stop.set()
+                for thread in readers:
+                    thread.join()
+
+            snapshots.append(self._environment_snapshot(environment_path))
+            self.assertEqual(errors, [])
+            self.assertNotEqual(snapshots[-2], snapshots[-1])
+            for snapshot in observed:
+                self.assertTrue(snapshot in snapshots[-2:])
+            self.assertEnvironmentLinks('test')
+            self.assertEnvironmentOverride('test', 'modules/module0', default)
+
+        # Only the build in use and the previous one are kept
+        builds = os.listdir("%s.staging" % self.settings.ENVIRONMENTSDIR)
+        self.assertEqual(len([build for build in builds
+                              if build.startswith("test.")]), 2)
+
+        destroy_environment('test')
+
+        self._jens_update()
+
+        self.assertEnvironmentDoesntExist('test')
+
+    def test_link_targets_are_relative_to_the_link(self):
+        self._create_fake_module('foo', ['qa'])
+        self._create_fake_hostgroup('bar', ['qa'])
+        ensure_environment('test', 'master', modules=['foo:qa'])
+        ensure_environment('atomic', 'qa')
+
+        self._jens_update()
+        self.settings.ATOMIC_ENVIRONMENTS = True
+        ensure_environment('atomic', 'master')
+        self._jens_update()
+
+        for environment in ('test', 'atomic'):
+            base_path = os.path.realpath("%s/%s" %
+                                         (self.settings.ENVIRONMENTSDIR,
+                                          environment))
+            links = self._environment_snapshot(base_path)
+            self.assertTrue(len(links) > 0)
+            for name, target in links.items():
+                link_name = os.path.join(base_path, name)
+                expected = os.path.relpath(os.path.realpath(link_name),
+                                           os.path.dirname(link_name))
+                self.assertEqual(target, expected)
+
+    def test_environments_index_knows_who_uses_each_treeish(self):
+        self._create_fake_module('foo', ['qa'])
+        self._create_fake_module('bar', ['qa'])
+        ensure_environment('a', 'master')
+        ensure_environment('b', None, modules=['foo:qa'])
+        ensure_environment('c', 'qa', modules=['foo:master'])
+
+        self._jens_update()
+
+        self.assertEqual(environments.get_environments_using('modules', 'foo'),
+                         {'master': ['a', 'c', 'production'], 'qa': ['b', 'qa']})
+        self.assertEqual(environments.get_environments_using('modules', 'bar'),
+                         {'master': ['a', 'production'], 'qa': ['c', 'qa']})
+        self.assertEqual(environments.get_environments_using('modules', 'foo', 'qa'),
+                         {'qa': ['b', 'qa']})
+        self.assertEqual(environments.get_environments_using('common', 'site', 'qa'),
+                         {'qa': ['c', 'qa']})
+
+        ensure_environment('b', None, modules=['foo:master'])
+        destroy_environment('a')
+        self._jens_update()
+
+        expected = {'master': ['b', 'c', 'production'], 'qa': ['qa']}
+        self.assertEqual(environments.get_environments_using('modules', 'foo'),
+                         expected)
+
+        # Regenerated from the annotations if it's lost
+        os.remove("%s/environments_index" % self.settings.CACHEDIR)
+        self.assertEqual(environments.get_environments_using('modules', 'foo'),
+                         expected)
+
+    def test_repositories_delta_only_refreshes_affected_environments(self):
+        self._create_fake_module('foo', ['qa'])
+        ensure_environment('a', None, modules=['foo:qa'])
+        ensure_environment('b', None, common=['site:qa'])
+
+        self._jens_update()
+
+        index = environments._read_environments_index()
+        deltas = {'modules': {'new': ['bar'], 'deleted': []},
+                  'hostgroups': {'new': [], 'deleted': []}}
+        self.assertEqual(environments._get_affected_environments(index, deltas),
+                         set(['production', 'qa']))
+        deltas['modules'] = {'new': [], 'deleted': ['foo']}
+        self.assertEqual(environments._get_affected_environments(index, deltas),
+                         set(['a', 'production', 'qa']))
+        deltas['modules'] = {'new': [], 'deleted': []}
+        self.assertEqual(environments._get_affected_environments(index, deltas),
+                         set())
+
+        del_repository('modules', 'foo')
+        self._jens_update()
+
+        self.assertEnvironmentOverrideDoesntExist('a', 'modules/foo')
+        self.assertEnvironmentOverrideDoesntExist('qa', 'modules/foo')
+
+    def test_inventory_changes_are_journaled_as_they_happen(self):
+        self._create_fake_module('foo', ['qa'])
+        self._jens_update()
+        self.assertFalse(os.path.exists("%s/repositories.journal" %
+                                        self.settings.CACHEDIR))
+
+        self._create_fake_module('bar', ['qa'])
+        del_repository('modules', 'foo')
+        # The run dies before persisting the inventory
+        with mock.patch('jens.repos.persist_inventory',
+                        side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, refresh_repositories)
+
+        with mock.patch('jens.reposinventory._generate_inventory') as generate:
+            inventory = reposinventory.get_inventory()
+            self.assertFalse(generate.called)
+        self.assertEqual(sorted(inventory['modules']['bar']), ['master', 'qa'])
+        self.assertFalse('foo' in inventory['modules'])
+
+        # A half-written entry is ignored
+        with open("%s/repositories.journal" % self.settings.CACHEDIR, "a") as journal:
+            journal.write('{"partition": "modules", "name": "ba')
+        self.assertEqual(reposinventory.get_inventory(), inventory)
+
+        self._jens_update()
+
+        self.assertClone('modules/bar/qa')
+        self.assertNotBare('modules/foo')
+        self.assertFalse(os.path.exists("%s/repositories.journal" %
+                                        self.settings.CACHEDIR))
+        self.assertEqual(reposinventory.get_inventory(), inventory)
+
+    def test_inventory_snapshot_formats(self):
+        self._create_fake_module('foo', ['qa'])
+        self._jens_update()
+        inventory = reposinventory.get_inventory()
+        inventory_path = "%s/repositories" % self.settings.CACHEDIR
+
+        # Written by an older version
+        with open(inventory_path, "wb") as inventory_file:
+            pickle.dump(inventory, inventory_file)
+        self.assertEqual(reposinventory.get_inventory(), inventory)
+
+        # Written by a newer one, so it's generated again
+        with open(inventory_path, "wb") as inventory_file:
+            pickle.dump({'version': 1000, 'inventory': {}}, inventory_file)
+        generated = reposinventory.get_inventory()
+        for partition, repositories in inventory.items():
+            self.assertEqual(sorted(repositories.keys()),
+                             sorted(generated[partition].keys()))
+            for name, refs in repositories.items():
+                self.assertEqual(sorted(refs), sorted(generated[partition][name]))
+
+    def test_broken_clones_are_left_out_of_a_regenerated_inventory(self):
+        self._create_fake_module('foo', ['qa'])
+        self._create_fake_module('bar', ['qa'])
+        self._jens_update()
+
+        # A commit that the bare repository doesn't know about
+        qa_path = "%s/modules/foo/qa" % self.settings.CLONEDIR
+        _git(["commit", "--allow-empty", "-m", "local"],
+             gitdir="%s/.git" % qa_path, gitworkingtree=qa_path)
+        # And a HEAD pointing nowhere
+        master_path = "%s/modules/bar/master" % self.settings.CLONEDIR
+        with open("%s/.git/HEAD" % master_path, "w") as head:
+            head.write("ref: refs/heads/lost\n")
+        os.remove("%s/repositories" % self.settings.CACHEDIR)
+
+        inventory = reposinventory.get_inventory()
+
+        self.assertEqual(inventory['modules']['foo'], ['master'])
+        self.assertEqual(inventory['modules']['bar'], ['qa'])
+        self.assertEqual(sorted(inventory['common']['site']), ['master', 'qa'])
+
+        self._jens_update()
+
+        bare_path = "%s/modules/foo" % self.settings.BAREDIR
+        self.assertClone('modules/foo/qa',
+                         pointsto=get_refs(bare_path)['qa'])
+        self.assertClone('modules/bar/master')
+        self.assertEnvironmentLinks('production')
+
+    def test_inventory_falls_back_to_git_from_the_main_thread(self):
+        self._create_fake_module('foo', ['qa'])
+        self._create_fake_module('bar', ['qa'])
+        self._jens_update()
+        inventory = reposinventory.get_inventory()
+        os.remove("%s/repositories" % self.settings.CACHEDIR)
+
+        threads = []
+        def _get_repository(repository_path):
+            threads.append(threading.current_thread())
+            return get_repository(repository_path)
+
+        with mock.patch('jens.git_wrapper._read_refs',
+                        side_effect=git_wrapper._UnsupportedRefs("packed")), \
+                mock.patch('jens.decorators.get_repository',
+                           side_effect=_get_repository):
+            generated = reposinventory.get_inventory()
+
+        self.assertTrue(threads)
+        self.assertEqual(set(threads), set([threading.main_thread()]))
+        for partition, repositories in inventory.items():
+            self.assertEqual(sorted(repositories.keys()),
+                             sorted(generated[partition].keys()))
+            for name, refs in repositories.items():
+                self.assertEqual(sorted(refs), sorted(generated[partition][name]))
+
+    def test_desired_inventory_only_reads_changed_definitions(self):
+        self._create_fake_module('foo', ['qa', 'other'])
+        ensure_environment('a', 'master', modules=['foo:qa'])
+        ensure_environment('b', 'master', modules=['foo:qa'])
+        self._commit_environments()
+
+        self._jens_update()
+
+        desired = reposinventory.get_desired_inventory()
+        self.assertEqual(desired['modules'], {'foo': set(['qa'])})
+
+        ensure_environment('b', 'master', modules=['foo:other'])
+        self._commit_environments()
+        with mock.patch('jens.reposinventory.read_environment_definition',
+                        wraps=reposinventory.read_environment_definition) as reading:
+            self._jens_update()
+            self.assertEqual([call[0][0] for call in reading.call_args_list],
+                             ['b'])
+
+        self.assertClone('modules/foo/other')
+        desired = reposinventory.get_desired_inventory()
+        self.assertEqual(desired['modules'], {'foo': set(['qa', 'other'])})
+
+        # Overrides nobody asks for anymore are forgotten
+        destroy_environment('a')
+        destroy_environment('b')
+        self._commit_environments()
+        self.assertEqual(reposinventory.get_desired_inventory()['modules'], {})
+
+    def test_desired_inventory_keeps_names_that_are_not_strings(self):
+        definition_path = "%s/test.yaml" % self.settings.ENV_METADATADIR
+        with open(definition_path, 'w') as definition_file:
+            definition_file.write("notifications: higgs@example.org\n"
+                                  "default: master\n"
+                                  "overrides:\n"
+                                  "  modules:\n"
+                                  "    123: qa\n")
+
+        desired = reposinventory.get_desired_inventory()
+        self.assertEqual(desired['modules'], {123: set(['qa'])})
+
+        # Forgetting it takes away exactly what was added
+        destroy_environment('test')
+        self.assertEqual(reposinventory.get_desired_inventory()['modules'], {})
+
+    def test_ondemand_runs_skip_environments_if_nothing_changed(self):
+        self.settings.MODE = "ONDEMAND"
+        murdock_path = self._create_fake_module('murdock', ['qa'])
+        ensure_environment('test', 'master', modules=["murdock:qa"])
+        self._commit_environments()
+
+        self._jens_update()
+
+        self.assertEnvironmentOverride("test", 'modules/murdock', 'qa')
+        new_qa = add_commit_to_branch(murdock_path, 'qa')
+
+        with mock.patch('jens.environments._calculate_delta',
+                        wraps=environments._calculate_delta) as delta:
+            self._jens_update(hints={'modules': ['murdock']})
+            delta.assert_not_called()
+
+            self.assertClone('modules/murdock/qa', pointsto=new_qa)
+            self.assertEnvironmentOverride("test", 'modules/murdock', 'qa')
+
+            # New repositories still reach the environments...
+            self._create_fake_module('steve', ['qa'])
+            self._jens_update(hints={'modules': []})
+            self.assertEqual(delta.call_count, 1)
+            self.assertEnvironmentOverride("test", 'modules/steve', 'master')
+
+            # ...and so do changes to the definitions
+            ensure_environment('test', 'master', modules=["steve:qa"])
+            self._commit_environments()
+            self._jens_update(hints={'modules': []})
+            self.assertEqual(delta.call_count, 2)
+            self.assertEnvironmentOverride("test", 'modules/steve', 'qa')
+
+            # ...even if they aren't committed
+            ensure_environment('test', 'master', modules=["murdock:master"])
+            self._jens_update(hints={'modules': []})
+            self.assertEqual(delta.call_count, 3)
+            self.assertEnvironmentOverride("test", 'modules/murdock', 'master')
+            self._commit_environments()
+            self._jens_update(hints={'modules': []})
+            self.assertEqual(delta.call_count, 4)
+            self._jens_update(hints={'modules': []})
+            self.assertEqual(delta.call_count, 4)
+
+            # Polling runs go through all the environments anyway
+            self.settings.MODE = "POLL"
+            self._jens_update()
+            self.assertEqual(delta.call_count, 5)
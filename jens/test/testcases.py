@@ -17,6 +17,7 @@ import time
 from string import Template
 from configobj import ConfigObj
 
+import jens.git_pool as git_pool
 from jens.locks import JensLockFactory
 from jens.settings import Settings
 from jens.reposinventory import get_inventory
@@ -45,6 +46,7 @@ type = DISABLED
 
 [messaging]
 queuedir = $sandbox/spool
+pendingdir = $sandbox/spool-pending
 """)
 
 class JensTestCase(unittest.TestCase):
@@ -74,6 +76,7 @@ class JensTestCase(unittest.TestCase):
         self.lock = JensLockFactory.make_lock(self.settings)
 
     def tearDown(self):
+        git_pool.release_all()
         logging.shutdown()
 
         # Remove the logger that writes to the log file of this test
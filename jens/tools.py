@@ -9,20 +9,94 @@ from __future__ import absolute_import
 import re
 from jens.settings import Settings
 
+# Settings is a Borg, so one instance always sees the current values.
+# It's created on first use, as creating it when this module is
+# imported would set the log file before the applications do.
+_settings = None
+_classifier = None
+
+# Refs are classified in tight loops and the same names (master, qa,
+# the same commits in several environments...) come up over and over,
+# so the pattern derived from HASHPREFIX is compiled once and the
+# results are memoized. A new classifier is made if HASHPREFIX changes.
+class _RefClassifier(object):
+    # Only there to bound the memory used by the memos
+    MAX_MEMOIZED = 65536
+
+    def __init__(self, hashprefix):
+        self.hashprefix = hashprefix
+        self.commit_pattern = re.compile(r'^%s([0-9A-Fa-f]+)' % hashprefix,
+                                         re.IGNORECASE)
+        self.dirname_pattern = re.compile(r'^\.([^\.]+)')
+        self.commits = {}
+        self.dirnames = {}
+        self.refnames = {}
+
+    def is_commit(self, refname):
+        try:
+            return self.commits[refname]
+        except KeyError:
+            pass
+        match = self.commit_pattern.match(refname)
+        _memoize(self.commits, refname, match)
+        return match
+
+    def refname_to_dirname(self, refname):
+        try:
+            return self.dirnames[refname]
+        except KeyError:
+            pass
+        match = self.is_commit(refname)
+        dirname = ".%s" % match.group(1) if match else refname
+        _memoize(self.dirnames, refname, dirname)
+        return dirname
+
+    def dirname_to_refname(self, dirname):
+        try:
+            return self.refnames[dirname]
+        except KeyError:
+            pass
+        match = self.dirname_pattern.match(dirname)
+        refname = "%s%s" % (self.hashprefix, match.group(1)) if match \
+            else dirname
+        _memoize(self.refnames, dirname, refname)
+        return refname
+
+def _memoize(memo, key, value):
+    if len(memo) >= _RefClassifier.MAX_MEMOIZED:
+        memo.clear()
+    memo[key] = value
+
+def _get_classifier():
+    global _settings, _classifier
+    if _settings is None:
+        _settings = Settings()
+    hashprefix = _settings.HASHPREFIX
+    if _classifier is None or _classifier.hashprefix != hashprefix:
+        _classifier = _RefClassifier(hashprefix)
+    return _classifier
+
 def refname_to_dirname(refname):
-    match = ref_is_commit(refname)
-    if match:
-        return ".%s" % match.group(1)
-    return refname
+    return _get_classifier().refname_to_dirname(refname)
 
 def dirname_to_refname(dirname):
-    settings = Settings()
-    match = re.match(r'^\.([^\.]+)', dirname)
-    if match:
-        return "%s%s" % (settings.HASHPREFIX, match.group(1))
-    return dirname
+    return _get_classifier().dirname_to_refname(dirname)
 
 def ref_is_commit(refname):
-    settings = Settings()
-    return re.match(r'^%s([0-9A-Fa-f]+)' % settings.HASHPREFIX,
-                    refname, re.IGNORECASE)
+    return _get_classifier().is_commit(refname)
+
+# Same as the above but for a bunch of refs at once
+def dirnames_to_refnames(dirnames):
+    classifier = _get_classifier()
+    return [classifier.dirname_to_refname(dirname) for dirname in dirnames]
+
+# Returns (branches, commits)
+def split_refs(refnames):
+    classifier = _get_classifier()
+    branches, commits = [], []
+    for refname in refnames:
+        if classifier.is_commit(refname):
+            commits.append(refname)
+        else:
+            branches.append(refname)
+    return (branches, commits)
@@ -45,6 +45,7 @@ mkdir -m 750 -p %{buildroot}/var/lib/jens/environments
 mkdir -m 750 -p %{buildroot}/var/lib/jens/metadata
 mkdir -m 750 -p %{buildroot}/var/log/jens/
 mkdir -m 750 -p %{buildroot}/var/spool/jens-update/
+mkdir -m 750 -p %{buildroot}/var/spool/jens-update-pending/
 mkdir -m 750 -p %{buildroot}/var/www/jens
 %{__install} -D -p -m 755 wsgi/* %{buildroot}/var/www/jens
 mkdir -p %{buildroot}%{_tmpfilesdir}
@@ -76,6 +77,7 @@ export GIT_COMMITTER_NAME="RPM build"
 %attr(750, jens, jens) /var/lib/jens/*
 %attr(750, jens, jens) /var/log/jens
 %attr(750, jens, jens) /var/spool/jens-update
+%attr(750, jens, jens) /var/spool/jens-update-pending
 %config(noreplace) %{_sysconfdir}/jens/main.conf
 %{_tmpfilesdir}/%{name}.conf
 %{_unitdir}/jens-update.service
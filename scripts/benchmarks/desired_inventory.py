@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""Measures the calculation of the desired inventory (the look-ahead).
+
+Lots of environments with lots of overrides are committed to the
+environments metadata repository. The desired inventory is then
+calculated the way it used to be (reading every definition and
+appending overrides to lists) and incrementally, from scratch, with
+nothing changed and with a few definitions changed. Every round starts
+with the definitions cache empty, as a new run would.
+"""
+
+import sys
+import random
+import argparse
+import subprocess
+
+import yaml
+
+from sandbox import create_sandbox, destroy_sandbox, Stopwatch
+
+import jens.environments as environments
+from jens.settings import Settings
+from jens.errors import JensEnvironmentsError
+from jens.reposinventory import get_desired_inventory
+from jens.environments import read_environment_definition
+from jens.environments import get_names_of_declared_environments
+from jens.tools import ref_is_commit
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--environments', type=int, default=5000,
+                        help="Number of environments (default: 5000)")
+    parser.add_argument('-o', '--overrides', type=int, default=50,
+                        help="Overrides per environment (default: 50)")
+    parser.add_argument('-m', '--modules', type=int, default=1000,
+                        help="Number of modules overridden (default: 1000)")
+    parser.add_argument('-c', '--changed', type=int, default=50,
+                        help="Definitions changed in the last round "
+                             "(default: 50)")
+    return parser.parse_args()
+
+# What _read_desired_inventory() used to do
+def legacy_desired_inventory():
+    desired = {'modules': {}, 'hostgroups': {}, 'common': {}}
+    for environmentname in get_names_of_declared_environments():
+        try:
+            environment = read_environment_definition(environmentname)
+            if 'overrides' in environment:
+                for partition in environment['overrides'].keys():
+                    if partition in ("modules", "hostgroups", "common"):
+                        for name, override in \
+                                environment['overrides'][partition].items():
+                            if ref_is_commit(override):
+                                override = override.lower()
+                            if name not in desired[partition]:
+                                desired[partition][name] = [override]
+                            else:
+                                if override not in desired[partition][name]:
+                                    desired[partition][name].append(override)
+        except JensEnvironmentsError:
+            continue
+    return desired
+
+def write_environments(generator, names, overrides, modules):
+    settings = Settings()
+    for name in names:
+        definition = {'notifications': 'admins@example.org',
+                      'default': 'master',
+                      'overrides': {'modules': dict(
+                          ("module%d" % generator.randrange(modules),
+                           generator.choice(['qa', 'devel', "feature%d" %
+                                             generator.randrange(20)]))
+                          for _ in range(0, overrides))}}
+        with open("%s/%s.yaml" % (settings.ENV_METADATADIR, name), 'w') as env:
+            yaml.dump(definition, env, default_flow_style=False)
+
+def commit_environments():
+    settings = Settings()
+    path = settings.ENV_METADATADIR
+    for args in (["init", "-q"], ["add", "-A"],
+                 ["commit", "-q", "-m", "update"]):
+        subprocess.check_call(["git"] + args, cwd=path)
+
+def measure(name, function):
+    environments._definitions.clear()
+    with Stopwatch() as stopwatch:
+        desired = function()
+    print("%-28s %.2f s" % (name, stopwatch.elapsed))
+    return desired
+
+def same(legacy, incremental):
+    return all(set(legacy[partition].keys()) == set(incremental[partition].keys())
+               and all(set(overrides) == incremental[partition][element]
+                       for element, overrides in legacy[partition].items())
+               for partition in legacy)
+
+def main():
+    opts = parse_cmdline_args()
+    path = create_sandbox("desired_inventory")
+    generator = random.Random(42)
+    names = ["environment%d" % index for index in range(0, opts.environments)]
+    write_environments(generator, names, opts.overrides, opts.modules)
+    commit_environments()
+
+    legacy = measure("legacy", legacy_desired_inventory)
+    incremental = measure("incremental (from scratch)", get_desired_inventory)
+    measure("incremental (nothing changed)", get_desired_inventory)
+    write_environments(generator, generator.sample(names, opts.changed),
+                       opts.overrides, opts.modules)
+    commit_environments()
+    measure("legacy (%d changed)" % opts.changed, legacy_desired_inventory)
+    measure("incremental (%d changed)" % opts.changed, get_desired_inventory)
+
+    destroy_sandbox(path)
+    if not same(legacy, incremental):
+        print("Results differ")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
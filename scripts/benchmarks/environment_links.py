@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""Measures how many environment links are created per second.
+
+The links of the modules and hostgroups of an environment are
+calculated the way it was done before link plans were introduced (one
+os.path.relpath() per link) and with the link plans, first on their own
+and then creating the links too. The clones don't have to exist, so
+the links are dangling.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+
+from sandbox import create_sandbox, destroy_sandbox, Stopwatch
+
+from jens.settings import Settings
+from jens.environments import _plan_module_links, _plan_hostgroup_links
+from jens.environments import _apply_links
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--elements', type=int, default=2000,
+                        help="Number of modules and hostgroups (default: 2000)")
+    parser.add_argument('-r', '--rounds', type=int, default=5,
+                        help="Environments created per measurement (default: 5)")
+    return parser.parse_args()
+
+# What _link_module() and _link_hostgroup() used to do
+def _relative(target, link_name):
+    return os.path.relpath(target,
+                           os.path.abspath(os.path.join(link_name, os.pardir)))
+
+def legacy_plan(environment, modules, hostgroups):
+    settings = Settings()
+    base = "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
+    links = []
+    for module in modules:
+        for link_name, target in (
+                ("%s/modules/%s" % (base, module),
+                 "%s/modules/%s/master/code" % (settings.CLONEDIR, module)),
+                ("%s/hieradata/module_names/%s" % (base, module),
+                 "%s/modules/%s/master/data" % (settings.CLONEDIR, module))):
+            links.append((link_name, _relative(target, link_name)))
+    for hostgroup in hostgroups:
+        for link_name, target in (
+                ("%s/hostgroups/hg_%s" % (base, hostgroup),
+                 "%s/hostgroups/%s/master/code" % (settings.CLONEDIR, hostgroup)),
+                ("%s/hieradata/hostgroups/%s" % (base, hostgroup),
+                 "%s/hostgroups/%s/master/data/hostgroup" %
+                 (settings.CLONEDIR, hostgroup)),
+                ("%s/hieradata/fqdns/%s" % (base, hostgroup),
+                 "%s/hostgroups/%s/master/data/fqdns" %
+                 (settings.CLONEDIR, hostgroup))):
+            links.append((link_name, _relative(target, link_name)))
+    return links
+
+def plan(environment, modules, hostgroups):
+    definition = {'default': 'master'}
+    links = []
+    for module in modules:
+        links.extend(_plan_module_links(module, environment, definition))
+    for hostgroup in hostgroups:
+        links.extend(_plan_hostgroup_links(hostgroup, environment, definition))
+    return links
+
+def prepare(environment):
+    settings = Settings()
+    base = "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
+    if os.path.exists(base):
+        shutil.rmtree(base)
+    for directory in ('modules', 'hostgroups', 'hieradata/module_names',
+                      'hieradata/hostgroups', 'hieradata/fqdns'):
+        os.makedirs("%s/%s" % (base, directory))
+
+def measure(function, rounds, modules, hostgroups, create):
+    links = 0
+    elapsed = 0.0
+    for index in range(0, rounds):
+        environment = "env%d" % index
+        if create:
+            prepare(environment)
+        with Stopwatch() as stopwatch:
+            planned = function(environment, modules, hostgroups)
+            if create:
+                _apply_links(planned)
+        links += len(planned)
+        elapsed += stopwatch.elapsed
+    return links, elapsed
+
+def main():
+    opts = parse_cmdline_args()
+    path = create_sandbox("environment_links")
+    modules = ["module%d" % index for index in range(0, opts.elements)]
+    hostgroups = ["hostgroup%d" % index for index in range(0, opts.elements)]
+    if plan('env', modules, hostgroups) != \
+            legacy_plan('env', modules, hostgroups):
+        print("The link plan doesn't match the links created before")
+        return 1
+    for create in (False, True):
+        for name, function in (('relpath', legacy_plan), ('plan', plan)):
+            links, elapsed = measure(function, opts.rounds,
+                                     modules, hostgroups, create)
+            print("%-8s %-16s %7d links in %.2f s (%d links/s)" %
+                  (name, "(targets only)" if not create else "(with symlinks)",
+                   links, elapsed, links / elapsed))
+    destroy_sandbox(path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
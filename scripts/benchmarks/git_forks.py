@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""Counts the git processes spawned by a refresh of the repositories.
+
+Every git invocation (including the ones made behind the scenes by
+GitPython) goes through a wrapper placed first in PATH that logs it,
+so the numbers include the work done by the worker processes. The
+refresh is measured twice, with the repository pool disabled
+([git] pool_size = 0) and enabled.
+"""
+
+import os
+import sys
+import stat
+import shutil
+import argparse
+import collections
+
+from sandbox import create_sandbox, destroy_sandbox, Stopwatch
+
+from jens.repos import refresh_repositories
+from jens.test.tools import init_repositories, add_repository
+from jens.test.tools import create_fake_repository, add_commit_to_branch
+
+WRAPPER = """#!/bin/sh
+echo "$1" >> %s
+exec %s "$@"
+"""
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repositories', type=int, default=20,
+                        help="Number of modules (default: 20)")
+    parser.add_argument('-p', '--pool-size', type=int, default=16,
+                        help="Pool size of the second round (default: 16)")
+    return parser.parse_args()
+
+def install_wrapper(path):
+    real_git = shutil.which("git")
+    bindir = "%s/bin" % path
+    os.mkdir(bindir)
+    log_path = "%s/forks.log" % path
+    wrapper_path = "%s/git" % bindir
+    with open(wrapper_path, 'w') as wrapper:
+        wrapper.write(WRAPPER % (log_path, real_git))
+    os.chmod(wrapper_path, stat.S_IRWXU)
+    os.environ['PATH'] = "%s:%s" % (bindir, os.environ['PATH'])
+    return log_path
+
+def uninstall_wrapper(path):
+    os.environ['PATH'] = os.environ['PATH'].replace("%s/bin:" % path, "", 1)
+
+def measure(pool_size, repositories):
+    path = create_sandbox("git_forks",
+                          "\n[git]\npool_size = %d\n" % pool_size)
+    init_repositories()
+    users = []
+    for element in ('site', 'hieradata'):
+        bare, user = create_fake_repository(path, ['qa'])
+        add_repository('common', element, bare)
+    for index in range(0, repositories):
+        bare, user = create_fake_repository(path, ['qa'])
+        add_repository('modules', "module%d" % index, bare)
+        users.append(user)
+    refresh_repositories()
+    for user in users:
+        add_commit_to_branch(user, 'qa')
+        add_commit_to_branch(user, 'master')
+
+    log_path = install_wrapper(path)
+    try:
+        with Stopwatch() as stopwatch:
+            refresh_repositories()
+    finally:
+        uninstall_wrapper(path)
+    with open(log_path) as log:
+        commands = collections.Counter(line.strip() for line in log)
+    destroy_sandbox(path)
+    return commands, stopwatch.elapsed
+
+def main():
+    opts = parse_cmdline_args()
+    for pool_size in (0, opts.pool_size):
+        commands, elapsed = measure(pool_size, opts.repositories)
+        print("pool_size=%d: %d git processes in %.2f s (%d repositories, "
+              "2 moved refs each)" % (pool_size, sum(commands.values()),
+                                      elapsed, opts.repositories + 2))
+        for command, count in commands.most_common():
+            print("\t%-12s %d" % (command, count))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
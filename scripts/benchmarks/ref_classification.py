@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""Measures the classification of the refs of a synthetic inventory.
+
+Every ref of the inventory is classified (branch or commit), translated
+to the name of its clone directory and back, as done when comparing
+refs, expanding clones and generating the inventory. The functions in
+jens.tools are compared with the way they used to work (a new Settings
+object and a regular expression built from HASHPREFIX on every call).
+"""
+
+import re
+import sys
+import random
+import argparse
+
+from sandbox import create_sandbox, destroy_sandbox, Stopwatch
+
+from jens.settings import Settings
+from jens.tools import split_refs, refname_to_dirname
+from jens.tools import dirnames_to_refnames
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--refs', type=int, default=100000,
+                        help="Number of refs in the inventory (default: 100000)")
+    parser.add_argument('-c', '--commits', type=float, default=0.2,
+                        help="Fraction of refs that are commits (default: 0.2)")
+    return parser.parse_args()
+
+def legacy_ref_is_commit(refname):
+    settings = Settings()
+    return re.match(r'^%s([0-9A-Fa-f]+)' % settings.HASHPREFIX,
+                    refname, re.IGNORECASE)
+
+def legacy_refname_to_dirname(refname):
+    match = legacy_ref_is_commit(refname)
+    if match:
+        return ".%s" % match.group(1)
+    return refname
+
+def legacy_dirname_to_refname(dirname):
+    settings = Settings()
+    match = re.match(r'^\.([^\.]+)', dirname)
+    if match:
+        return "%s%s" % (settings.HASHPREFIX, match.group(1))
+    return dirname
+
+def legacy(refs):
+    branches = [ref for ref in refs if not legacy_ref_is_commit(ref)]
+    dirnames = [legacy_refname_to_dirname(ref) for ref in refs]
+    refnames = [legacy_dirname_to_refname(dirname) for dirname in dirnames]
+    return branches, refnames
+
+def current(refs):
+    branches, _ = split_refs(refs)
+    dirnames = [refname_to_dirname(ref) for ref in refs]
+    refnames = dirnames_to_refnames(dirnames)
+    return branches, refnames
+
+def synthetic_inventory(count, commits):
+    settings = Settings()
+    generator = random.Random(42)
+    # Most repositories have the same handful of branches and commits
+    # are often shared by several environments
+    branches = ['master', 'qa'] + ["feature%d" % index for index in range(0, 50)]
+    hashes = ["%s%040x" % (settings.HASHPREFIX, generator.getrandbits(160))
+              for _ in range(0, max(1, count // 50))]
+    return [generator.choice(hashes) if generator.random() < commits
+            else generator.choice(branches) for _ in range(0, count)]
+
+def main():
+    opts = parse_cmdline_args()
+    path = create_sandbox("ref_classification")
+    refs = synthetic_inventory(opts.refs, opts.commits)
+    results = []
+    # The first round of 'current' starts with nothing memoized
+    for name, function in (('legacy', legacy), ('current', current),
+                           ('current', current)):
+        with Stopwatch() as stopwatch:
+            results.append(function(refs))
+        print("%-8s %d refs in %.3f s (%d refs/s)" %
+              (name, len(refs), stopwatch.elapsed, len(refs) / stopwatch.elapsed))
+    destroy_sandbox(path)
+    if results[0] != results[1]:
+        print("Results differ")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+# Copyright (C) 2026, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""Helpers shared by the benchmarks living in this directory.
+
+They reuse the sandbox used by the functional tests, so they have to be
+run from the root of the source tree, for instance:
+
+    $ PYTHONPATH=. python3 scripts/benchmarks/git_forks.py
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from jens.settings import Settings
+from jens.test.testcases import BASE_CONFIG
+from jens.test.tools import init_sandbox
+
+def create_sandbox(name, extra_config=""):
+    """Creates a sandbox like the one used by the testsuite and points
+    the settings at it. Returns the path to the sandbox."""
+    path = tempfile.mkdtemp(prefix="jens_benchmark_%s-" % name)
+    init_sandbox(path)
+    config_file_path = "%s/etc/main.conf" % path
+    with open(config_file_path, 'w') as config_file:
+        config_file.write(BASE_CONFIG.substitute(
+            sandbox=path, hashprefix='commit/', debuglevel='INFO',
+            mandatory_branches='master,qa'))
+        config_file.write(extra_config)
+    settings = Settings("jens-benchmark")
+    settings.parse_config(config_file_path)
+    return path
+
+def destroy_sandbox(path):
+    if not os.getenv('JENS_BENCHMARK_KEEP_SANDBOX', False):
+        shutil.rmtree(path)
+
+class Stopwatch(object):
+    def __enter__(self):
+        self.start = time.time()
+        self.elapsed = None
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        self.elapsed = time.time() - self.start
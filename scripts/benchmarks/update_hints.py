@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# Copyright (C) 2026, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+"""Measures how long it takes to consume a deep queue of update hints.
+
+A local queue is filled with lots of hints (as it would be after an
+outage) about a smaller set of repositories and then consumed the way
+it used to be (dequeuing pickled hints into a list and merging it
+afterwards) and by fetch_update_hints(), each reading the format it was
+written for. Every consumer runs in its own process, so its peak memory
+usage can be told apart.
+"""
+
+import sys
+import pickle
+import logging
+import random
+import resource
+import argparse
+import multiprocessing
+from datetime import datetime
+from functools import reduce
+
+from dirq.queue import Queue
+
+from sandbox import create_sandbox, destroy_sandbox, Stopwatch
+
+from jens.settings import Settings
+from jens.messaging import MSG_SCHEMA, fetch_update_hints
+from jens.messaging import _encode_hint
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--messages', type=int, default=500000,
+                        help="Number of hints in the queue (default: 500000)")
+    parser.add_argument('-r', '--repositories', type=int, default=2000,
+                        help="Number of repositories hinted (default: 2000)")
+    return parser.parse_args()
+
+def fill_queue(count, repositories, encode):
+    settings = Settings()
+    queue = Queue(settings.MESSAGING_QUEUEDIR, schema=MSG_SCHEMA)
+    generator = random.Random(42)
+    for _ in range(0, count):
+        partition = generator.choice(['modules', 'hostgroups'])
+        name = "%s%d" % (partition, generator.randrange(repositories))
+        queue.add({'time': datetime.now().isoformat(),
+                   'data': encode(partition, name)})
+
+def encode_legacy_hint(partition, name):
+    return pickle.dumps({partition: [name]})
+
+# What fetch_update_hints() used to do
+def legacy_fetch_update_hints():
+    settings = Settings()
+    queue = Queue(settings.MESSAGING_QUEUEDIR, schema=MSG_SCHEMA)
+    messages = []
+    for name in queue:
+        item = queue.dequeue(name)
+        item['data'] = pickle.loads(item['data'])
+        messages.append(item)
+    return legacy_validate_and_merge_messages(messages)
+
+# A copy of the reducer that went with it, as the one in jens.messaging
+# now takes decoded (partition, name) pairs
+def legacy_validate_and_merge_messages(messages):
+    hints = {'modules': set(), 'hostgroups': set(), 'common': set()}
+    def _merger(acc, element):
+        if 'time' not in element:
+            logging.warning("Discarding message: No timestamp")
+            return acc
+        time = element['time']
+        if 'data' not in element or type(element['data']) != dict:
+            logging.warning("Discarding message (%s): Bad data section", time)
+            return acc
+        for k, v in element['data'].items():
+            if k not in hints:
+                logging.warning("Discarding message (%s): Unknown partition '%s'", time, k)
+                continue
+            if type(v) != list:
+                logging.warning("Discarding message (%s): Value '%s' is not a list", time, v)
+                continue
+            for item in v:
+                if type(item) == str:
+                    logging.debug("Accepted message %s:%s created at %s",
+                                  k, v, element['time'])
+                    acc[k].add(item)
+                else:
+                    logging.warning("Discarding item '%s' in (%s - %s:%s): not a str",
+                                 item, time, k, v)
+        return acc
+    return reduce(_merger, messages, hints)
+
+def consume(function, results):
+    with Stopwatch() as stopwatch:
+        hints = function()
+    results.put((stopwatch.elapsed,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 sum(len(names) for names in hints.values())))
+
+def main():
+    opts = parse_cmdline_args()
+    path = create_sandbox("update_hints")
+    for name, function, encode in (
+            ('streaming', fetch_update_hints, _encode_hint),
+            ('legacy', legacy_fetch_update_hints, encode_legacy_hint)):
+        with Stopwatch() as filling:
+            fill_queue(opts.messages, opts.repositories, encode)
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=consume,
+                                          args=(function, results))
+        process.start()
+        # The results are tiny, so they can't keep the child from exiting
+        process.join()
+        if process.exitcode != 0:
+            print("%s consumer failed (exit code %d)" %
+                  (name, process.exitcode), file=sys.stderr)
+            destroy_sandbox(path)
+            return 1
+        elapsed, maxrss, hinted = results.get()
+        print("%-10s %d messages (queued in %.1f s) consumed in %.1f s, "
+              "%d repositories hinted, peak RSS %d MiB" %
+              (name, opts.messages, filling.elapsed, elapsed, hinted,
+               maxrss // 1024))
+    destroy_sandbox(path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())